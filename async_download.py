@@ -0,0 +1,289 @@
+import os
+import asyncio
+import metrics
+from typing import Iterable
+from gallery_info_from_id import GalleryInfo
+from url_from_file_info import GGJs, GGJsProvider, resolve_gg
+from fetch_image_from_url import image_request_headers
+from http_session import get_config, rewrite_url
+from gallery_index import GalleryIndex
+from download_manifest import DownloadManifest, is_gallery_complete
+from hitomi_util import get_gallery_info, urls_form_id, prepare_save_dir, image_save_path, find_saved_page
+try:
+    import aiohttp
+except ImportError: # aiohttpは非同期版を使う場合のみ必要(requirements-async.txt)
+    aiohttp = None
+
+#http_sessionのRetry(total=retry_num)が再試行する接続エラー・タイムアウト・受信途中の切断
+_RETRYABLE_ERRORS: tuple[type[BaseException], ...] = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) if aiohttp is not None else ()
+
+#受信したchunkを.partに書き込み、file_pathを指定すれば完了としてリネームする
+def _write_part(part_path: str, chunks: list[bytes], append: bool, file_path: str|None=None) -> str:
+    with open(part_path, 'ab' if append else 'wb') as f:
+        f.writelines(chunks)
+    if file_path is None:
+        return part_path
+    os.replace(part_path, file_path)
+    return file_path
+
+class AsyncImageDownloader():
+    """
+    aiohttpで画像を並行ダウンロードする。
+    ホストごとの同時接続数(per_host_limit)と全体の同時リクエスト数(max_in_flight)を制限し、
+    ファイルの書き込みは別スレッドで行うのでイベントループを止めない
+    """
+    def __init__(self, per_host_limit: int=16, max_in_flight: int=64, retry_num: int|None=None) -> None:
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for async download (pip install -r requirements-async.txt)')
+        config = get_config()
+        self.retry_num = config.retry_num if retry_num is None else retry_num
+        self.backoff_factor = config.backoff_factor
+        self.status_forcelist = config.status_forcelist
+        self.timeout = aiohttp.ClientTimeout(sock_connect=config.timeout[0], sock_read=config.timeout[1])
+        self.connector = aiohttp.TCPConnector(limit=max_in_flight, limit_per_host=per_host_limit)
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.session = aiohttp.ClientSession(connector=self.connector, timeout=self.timeout)
+
+    async def close(self) -> None:
+        await self.session.close()
+
+    async def __aenter__(self) -> 'AsyncImageDownloader':
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.close()
+
+    async def fetch_image(self, gallery_id: int, url: str) -> bytes:
+        headers = image_request_headers(gallery_id)
+        attempt = 0
+        while True:
+            try:
+                async with self.session.get(rewrite_url(url), headers=headers) as response:
+                    #http_sessionと同じリトライ方針(status_forcelistのみ指数バックオフで再試行)
+                    retryable = response.status in self.status_forcelist and attempt < self.retry_num
+                    if not retryable:
+                        try:
+                            response.raise_for_status()
+                        except aiohttp.ClientResponseError as e:
+                            metrics.message('error', 'Failed to fetch image data')
+                            raise e
+                        return await response.read()
+            except _RETRYABLE_ERRORS as e:
+                #urllib3のRetryと同じく、接続エラー・タイムアウトもretry_num回まで再試行する
+                if attempt >= self.retry_num:
+                    metrics.message('error', 'Failed to fetch image data')
+                    raise e
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def fetch_image_to_file(self, gallery_id: int, url: str, file_path: str, chunk_size: int=64*1024, flush_size: int=2**20) -> str:
+        """fetch_image_to_fileの非同期版。受信した本文をflush_sizeごとに別スレッドで一時ファイル(.part)に書き込み、file_pathへリネームする
+        メモリに溜めるのは1リクエストあたりflush_sizeまで。
+        以前の.partが残っていれば(中断・受信途中の接続エラー)Rangeリクエストで続きから取得する
+        """
+        part_path = file_path + '.part'
+        attempt = 0
+        while True:
+            headers = image_request_headers(gallery_id)
+            resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if resume_from:
+                headers['range'] = f'bytes={resume_from}-'
+                headers['accept-encoding'] = 'identity'
+            try:
+                async with self.session.get(rewrite_url(url), headers=headers) as response:
+                    if resume_from and response.status == 416:
+                        #.partが壊れている(サーバー上のサイズ以上ある)ので最初から取得し直す
+                        await asyncio.to_thread(os.remove, part_path)
+                        continue
+                    retryable = response.status in self.status_forcelist and attempt < self.retry_num
+                    if not retryable:
+                        try:
+                            response.raise_for_status()
+                        except aiohttp.ClientResponseError as e:
+                            metrics.message('error', 'Failed to fetch image data')
+                            raise e
+                        #206なら続きを追記、200ならサーバーがRangeを無視したので最初から書き直す
+                        append = resume_from > 0 and response.status == 206
+                        chunks: list[bytes] = []
+                        buffered = 0
+                        try:
+                            async for chunk in response.content.iter_chunked(chunk_size):
+                                chunks.append(chunk)
+                                buffered += len(chunk)
+                                if buffered >= flush_size:
+                                    await asyncio.to_thread(_write_part, part_path, chunks, append)
+                                    append = True
+                                    chunks = []
+                                    buffered = 0
+                        except _RETRYABLE_ERRORS:
+                            #受信途中で切れた場合も受信した分を.partに書き込み、次の試行で続きから取得する
+                            await asyncio.to_thread(_write_part, part_path, chunks, append)
+                            raise
+                        return await asyncio.to_thread(_write_part, part_path, chunks, append, file_path)
+            except _RETRYABLE_ERRORS as e:
+                if attempt >= self.retry_num:
+                    metrics.message('error', 'Failed to fetch image data')
+                    raise e
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def save_image(self, gallery_id: int, index: int, url: str, save_path: str) -> tuple[int, str]:
+        #全体の同時リクエスト数を制限
+        async with self.in_flight:
+            return index, await self.fetch_image_to_file(gallery_id, url, save_path)
+
+    async def save_gallery(self, gallery_id: int, gallery_info: GalleryInfo|None=None, gg: GGJs|GGJsProvider|None=None, save_dir: str|None=None, save_json: bool=True, gallery_index: GalleryIndex|None=None) -> None:
+        save_root = save_dir if save_dir is not None else os.getcwd()
+        #save_all_image_data_from_idと同じく、manifestどおりに全ページが揃っていれば作品情報もgg.jsも取得せずに終了
+        if await asyncio.to_thread(is_gallery_complete, save_root, gallery_id):
+            return
+        if gallery_info is None:
+            gallery_info = await asyncio.to_thread(get_gallery_info, gallery_id)
+        #gg.jsの取得が必要な場合にイベントループを止めないよう別スレッドで期限内のGGJsを受け取る
+        resolved_gg = await asyncio.to_thread(resolve_gg, gg)
+        urls = urls_form_id(gallery_id, gallery_info, resolved_gg)
+        save_dir = await asyncio.to_thread(prepare_save_dir, gallery_id, gallery_info, save_root, save_json, gallery_index)
+        manifest = DownloadManifest.load(save_dir, gallery_id) or DownloadManifest(gallery_id=gallery_id, page_num=len(urls))
+        manifest.page_num = len(urls)
+        existing_file_names = set(await asyncio.to_thread(os.listdir, save_dir))
+
+        tasks: list[asyncio.Task[tuple[int, str]]] = []
+        for page_index, url in enumerate(urls):
+            save_path = image_save_path(save_dir, gallery_id, page_index, url)
+            #保存済みのページはリクエストしない
+            saved_path = find_saved_page([('', url, save_path)], existing_file_names)
+            if saved_path is not None:
+                if page_index not in manifest.pages:
+                    manifest.record(page_index, os.path.basename(saved_path), os.path.getsize(saved_path), gallery_info.files_info[page_index].hash)
+                continue
+            tasks.append(asyncio.create_task(self.save_image(gallery_id, page_index, url, save_path)))
+        try:
+            with metrics.progress(f'ダウンロード中: {gallery_id}({gallery_info.japanese_title or gallery_info.title})', len(tasks)) as progress:
+                for task in asyncio.as_completed(tasks):
+                    page_index, save_path = await task
+                    manifest.record(page_index, os.path.basename(save_path), os.path.getsize(save_path), gallery_info.files_info[page_index].hash)
+                    progress.update()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.to_thread(manifest.save, save_dir)
+
+#作品に含まれる画像をすべて非同期でダウンロード
+async def async_save_all_image_data_from_id(gallery_id: int, gallery_info: GalleryInfo|None=None, gg: GGJs|GGJsProvider|None=None, save_dir: str|None=None, save_json: bool=True, per_host_limit: int=16, max_in_flight: int=64, gallery_index: GalleryIndex|None=None) -> None:
+    """save_all_image_data_from_idの非同期版
+    保存済みのページはリクエストせず、中断された.partはRangeリクエストで続きから取得する
+    Args:
+        gallery_id (int): 作品id
+        gallery_info (GalleryInfo|None): {gallery_id}.jsをparseしたGalleryInfo Defaults to None.
+        gg (GGJs|GGJsProvider|None): gg.jsをparseしたオブジェクト。指定しない場合は共有のGGJsProvider Defaults to None.
+        save_dir (str|None): 保存先ディレクトリ。指定しない場合はカレントディレクトリに保存される Defaults to None.
+        per_host_limit (int): ホスト(a1./w1. など)ごとの同時接続数 Defaults to 16.
+        max_in_flight (int): 全体の同時リクエスト数 Defaults to 64.
+        gallery_index (GalleryIndex|None): 作品情報を登録する検索用の索引 Defaults to None.
+    """
+    async with AsyncImageDownloader(per_host_limit=per_host_limit, max_in_flight=max_in_flight) as downloader:
+        await downloader.save_gallery(gallery_id, gallery_info, gg, save_dir, save_json, gallery_index)
+
+#複数の作品を1つのセッション・同時実行数制限を共有して非同期でダウンロード
+async def async_save_all_image_data_from_ids(gallery_ids: Iterable[int], gg: GGJs|GGJsProvider|None=None, save_dir: str|None=None, save_json: bool=True, per_host_limit: int=16, max_in_flight: int=64, gallery_index: GalleryIndex|None=None) -> None:
+    """複数の作品を並行してダウンロードする
+    Args:
+        gallery_ids (Iterable[int]): 作品idのリスト
+        gg (GGJs|GGJsProvider|None): gg.jsをparseしたオブジェクト。指定しない場合は共有のGGJsProviderを全作品で使う Defaults to None.
+        save_dir (str|None): 保存先ディレクトリ。指定しない場合はカレントディレクトリに保存される Defaults to None.
+        per_host_limit (int): ホストごとの同時接続数 Defaults to 16.
+        max_in_flight (int): 全体の同時リクエスト数 Defaults to 64.
+        gallery_index (GalleryIndex|None): 作品情報を登録する検索用の索引 Defaults to None.
+    """
+    async with AsyncImageDownloader(per_host_limit=per_host_limit, max_in_flight=max_in_flight) as downloader:
+        await asyncio.gather(*(downloader.save_gallery(gallery_id, gg=gg, save_dir=save_dir, save_json=save_json, gallery_index=gallery_index) for gallery_id in gallery_ids))
+
+def test(page_num: int=40) -> None:
+    """受信途中で接続が切れても.partの続きから取得し、再実行時は保存済みのページをリクエストしないことを確認する"""
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+
+    image_data = os.urandom(256 * 1024)
+    gallery_id = 1
+    gallery_info = gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, page_num))
+    gg = parse_gg(synthetic_gg_js())
+    backoff_factor = http_session.get_config().backoff_factor
+    with StubServer(fallback=lambda path: (200, image_data, {}), drop_rate=0.3) as server, tempfile.TemporaryDirectory() as save_dir:
+        http_session.configure_transport(url_rewriter=server.rewrite_url, backoff_factor=0)
+        try:
+            asyncio.run(async_save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir))
+            assert server.dropped_count > 0
+            gallery_dir = next(os.scandir(save_dir)).path
+            page_paths = sorted(entry.path for entry in os.scandir(gallery_dir) if entry.name.endswith('.webp') or entry.name.endswith('.avif'))
+            assert len(page_paths) == page_num and all(open(path, 'rb').read() == image_data for path in page_paths)
+            assert not any(name.endswith('.part') for name in os.listdir(gallery_dir))
+            dropped_count = server.dropped_count
+
+            #manifestどおりに揃っていればリクエストしない
+            server.reset_counts()
+            asyncio.run(async_save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir))
+            assert server.request_count == 0
+
+            #manifestがなくても保存済みのページはリクエストせず、残っていた.partは続きから取得する
+            os.remove(DownloadManifest.path_from_save_dir(gallery_dir, gallery_id))
+            os.replace(page_paths[0], page_paths[0] + '.part')
+            with open(page_paths[0] + '.part', 'r+b') as f:
+                f.truncate(len(image_data) // 4)
+            server.drop_rate = 0.0
+            server.reset_counts()
+            asyncio.run(async_save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir))
+            assert server.request_count == 1 and open(page_paths[0], 'rb').read() == image_data
+
+            #受信中もflush_sizeごとに.partへ書き込まれ、本文全体をメモリに溜めない
+            server.bandwidth = 1024 * 1024
+            async def fetch_while_watching(file_path: str) -> int:
+                part_sizes: list[int] = []
+                async with AsyncImageDownloader() as downloader:
+                    task = asyncio.create_task(downloader.fetch_image_to_file(gallery_id, 'https://a1.gold-usergeneratedcontent.net/stream.webp', file_path, flush_size=32 * 1024))
+                    while not task.done():
+                        if os.path.exists(file_path + '.part'):
+                            part_sizes.append(os.path.getsize(file_path + '.part'))
+                        await asyncio.sleep(0.02)
+                    await task
+                return max(part_sizes, default=0)
+            stream_path = os.path.join(save_dir, 'stream.webp')
+            max_part_size = asyncio.run(fetch_while_watching(stream_path))
+            assert 0 < max_part_size < len(image_data) and open(stream_path, 'rb').read() == image_data, max_part_size
+            print(f'{page_num} pages, dropped {dropped_count} responses, resumed 1 .part with 1 request, .part reached {max_part_size} bytes before completion')
+        finally:
+            http_session.configure_transport(url_rewriter=None, backoff_factor=backoff_factor)
+
+def bench(image_num: int=300, image_size: int=256*1024, latency: float=0.05) -> None:
+    """ローカルのスタブサーバーに対してスレッド版と非同期版の images/s を比較する"""
+    import time
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id
+
+    image_data = b'\0' * image_size
+    gallery_id = 1
+    gallery_info = gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, image_num))
+    gg = parse_gg(synthetic_gg_js())
+    with StubServer(fallback=lambda path: (200, image_data, {}), latency=latency) as server:
+        http_session.configure_transport(url_rewriter=server.rewrite_url)
+        try:
+            for label in ('thread', 'async'):
+                with tempfile.TemporaryDirectory() as save_dir:
+                    start = time.perf_counter()
+                    if label == 'thread':
+                        save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir)
+                    else:
+                        asyncio.run(async_save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir))
+                    elapsed = time.perf_counter() - start
+                print(f'{label}: {image_num} images in {elapsed:.2f}s ({image_num / elapsed:.1f} images/s, {image_num * image_size / elapsed / 2**20:.1f} MB/s)')
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,255 @@
+import os
+import time
+import itertools
+import threading
+import metrics
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor, Future
+from gallery_info_from_id import GalleryInfo
+from url_from_file_info import parse_gg, GGJs, GGJsProvider
+from download_manifest import DownloadManifest, is_gallery_complete
+from gallery_cache import GalleryCache
+from gallery_index import GalleryIndex
+from content_store import ContentStore, ContentStoreStats
+from rate_control import RateController
+from image_format import FormatNegotiator
+from hitomi_util import get_gallery_info, page_variants_from_id, page_fetcher, prepare_save_dir, image_save_path, find_saved_page
+
+@dataclass
+class GalleryDownloadStats:
+    gallery_id: int
+    page_num: int = 0
+    downloaded: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+    error: str|None = None
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.finished - self.started, 1e-9)
+
+    @property
+    def images_per_sec(self) -> float:
+        return self.downloaded / self.elapsed
+
+    @property
+    def mb_per_sec(self) -> float:
+        return self.bytes / self.elapsed / 2**20
+
+@dataclass
+class BatchDownloadReport:
+    galleries: dict[int, GalleryDownloadStats] = field(default_factory=dict)
+    started: float = 0.0
+    finished: float = 0.0
+    gg_refresh_count: int = 0
+    requests_saved: int = 0
+    bytes_saved: int = 0
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.finished - self.started, 1e-9)
+
+    @property
+    def downloaded(self) -> int:
+        return sum(stats.downloaded for stats in self.galleries.values())
+
+    @property
+    def bytes(self) -> int:
+        return sum(stats.bytes for stats in self.galleries.values())
+
+    @property
+    def images_per_sec(self) -> float:
+        return self.downloaded / self.elapsed
+
+    @property
+    def mb_per_sec(self) -> float:
+        return self.bytes / self.elapsed / 2**20
+
+    def summary(self) -> str:
+        failed = [gallery_id for gallery_id, stats in self.galleries.items() if stats.error or stats.failed]
+        return (f'{len(self.galleries)} galleries, {self.downloaded} images, {self.bytes / 2**20:.1f} MB in {self.elapsed:.2f}s '
+                f'({self.images_per_sec:.1f} images/s, {self.mb_per_sec:.1f} MB/s), gg.js refreshed {self.gg_refresh_count} times, '
+                f'saved by content store: {self.requests_saved} requests ({self.bytes_saved / 2**20:.1f} MB), failed: {failed}')
+
+class _GalleryJob():
+    """1作品分の進捗。画像ワーカーのコールバックから更新される"""
+    def __init__(self, gallery_id: int, gallery_info: GalleryInfo, save_dir: str, page_num: int, stats: GalleryDownloadStats) -> None:
+        self.gallery_id = gallery_id
+        self.gallery_info = gallery_info
+        self.save_dir = save_dir
+        self.stats = stats
+        self.manifest = DownloadManifest.load(save_dir, gallery_id) or DownloadManifest(gallery_id=gallery_id, page_num=page_num)
+        self.manifest.page_num = page_num
+        self.remaining = 0
+        self.lock = threading.Lock()
+
+def download_galleries(gallery_ids: Iterable[int], save_dir: str|None=None, save_json: bool=True, max_worker: int=8, prefetch_ahead: int=4, max_pending: int|None=None, gg: GGJs|GGJsProvider|None=None, cache: GalleryCache|None=None, gallery_index: GalleryIndex|None=None, store: ContentStore|None=None, rate_controller: RateController|None=None, format_negotiator: FormatNegotiator|None=None, show_progress: bool=True) -> BatchDownloadReport:
+    """複数の作品を1つの画像キューでダウンロードする
+    作品情報({gallery_id}.js)の取得は別スレッドで先行して行い、全作品の画像を共有のワーカーに流すので、作品の切り替わりでワーカーが空かない。
+    gg.jsはGGJsProviderで全作品に共有し、期限切れになる前に1回だけ取得し直す
+
+    Args:
+        gallery_ids (Iterable[int]): 作品idのリスト(重複したidは最初の1件だけダウンロードする)
+        save_dir (str|None): 保存先ディレクトリ。指定しない場合はカレントディレクトリに保存される Defaults to None.
+        save_json (bool): 作品フォルダにGalleryInfoのjsonを保存する Defaults to True.
+        max_worker (int): 画像ダウンロードのワーカー数(rate_controllerを指定した場合はその上限が優先) Defaults to 8.
+        prefetch_ahead (int): 作品情報を先行して取得する作品数 Defaults to 4.
+        max_pending (int|None): キューに積む画像数の上限。指定しない場合はmax_workerの4倍 Defaults to None.
+        gg (GGJs|GGJsProvider|None): 最初に使うgg.js(GGJsProviderならそのまま共有する)。期限切れ前に取得し直す Defaults to None.
+        cache (GalleryCache|None): 作品情報のキャッシュ Defaults to None.
+        gallery_index (GalleryIndex|None): 作品情報を登録する検索用の索引 Defaults to None.
+        store (ContentStore|None): 画像をhashごとに1回だけ保存するストア。保存済みのhashはリクエストしない Defaults to None.
+        rate_controller (RateController|None): 同時実行数とホストごとのレートを429/5xx・レイテンシに合わせて調整する Defaults to None.
+        format_negotiator (FormatNegotiator|None): ページの画像形式をFormatPolicyの順に選び、失敗したら次の形式で取得し直す Defaults to None.
+        show_progress (bool): metrics.progressで進捗を通知する(既定のConsoleObserverならtqdmで表示) Defaults to True.
+
+    Returns:
+        BatchDownloadReport: 作品ごとと全体のスループット
+    """
+    save_root = save_dir if save_dir is not None else os.getcwd()
+    report = BatchDownloadReport(started=time.perf_counter())
+    gg_provider = gg if isinstance(gg, GGJsProvider) else GGJsProvider(gg=gg)
+    if rate_controller is not None:
+        #同時実行数はrate_controllerが調整するので、ワーカーはその上限まで用意する
+        max_worker = rate_controller.max_worker
+    pending = threading.BoundedSemaphore(max_pending or max_worker * 4)
+    initial_refresh_count = gg_provider.refresh_count
+    #store.statsは他の実行とも共有されるので、この実行の分は別に集計する
+    store_stats = ContentStoreStats()
+
+    def fetch_gallery_info(gallery_id: int) -> GalleryInfo|None:
+        #保存済みの作品は作品情報も取得しない
+        if is_gallery_complete(save_root, gallery_id):
+            return None
+        return get_gallery_info(gallery_id, cache)
+
+    def on_page_done(job: _GalleryJob, index: int, future: Future[str]) -> None:
+        pending.release()
+        with job.lock:
+            try:
+                #format_negotiatorが次の形式で取得した場合は保存先の拡張子が変わるので、返された保存先を記録する
+                save_path = future.result()
+                size = os.path.getsize(save_path)
+                job.stats.downloaded += 1
+                job.stats.bytes += size
+                job.manifest.record(index, os.path.basename(save_path), size, job.gallery_info.files_info[index].hash)
+            except Exception as e:
+                job.stats.failed += 1
+                job.stats.error = job.stats.error or repr(e)
+            job.remaining -= 1
+            if job.remaining == 0:
+                job.stats.finished = time.perf_counter()
+                job.manifest.save(job.save_dir)
+        if progress is not None:
+            progress.update(1)
+
+    #同じ作品idが複数あると同じフォルダへ同時に保存し、reportも上書きされるので、順番を保って重複を除く
+    gallery_ids = list(dict.fromkeys(gallery_ids))
+    progress = metrics.progress(f'ダウンロード中: {len(gallery_ids)} galleries', unit='image') if show_progress else None
+    with ThreadPoolExecutor(max_workers=prefetch_ahead, thread_name_prefix='prefetch') as prefetch_executor, \
+            ThreadPoolExecutor(max_workers=max_worker, thread_name_prefix='image') as image_executor:
+        #作品情報の取得はprefetch_ahead件まで先行させる
+        gallery_id_iter = iter(gallery_ids)
+        info_futures: deque[tuple[int, Future[GalleryInfo|None]]] = deque()
+        for gallery_id in itertools.islice(gallery_id_iter, prefetch_ahead):
+            info_futures.append((gallery_id, prefetch_executor.submit(fetch_gallery_info, gallery_id)))
+        while info_futures:
+            gallery_id, info_future = info_futures.popleft()
+            for next_gallery_id in itertools.islice(gallery_id_iter, 1):
+                info_futures.append((next_gallery_id, prefetch_executor.submit(fetch_gallery_info, next_gallery_id)))
+            stats = GalleryDownloadStats(gallery_id=gallery_id, started=time.perf_counter())
+            report.galleries[gallery_id] = stats
+            try:
+                gallery_info = info_future.result()
+                if gallery_info is None:
+                    stats.finished = time.perf_counter()
+                    continue
+                page_variants = page_variants_from_id(gallery_id, gallery_info, gg_provider, format_negotiator)
+                gallery_dir = prepare_save_dir(gallery_id, gallery_info, save_root, save_json, gallery_index)
+            except Exception as e:
+                stats.error = repr(e)
+                stats.finished = time.perf_counter()
+                continue
+
+            job = _GalleryJob(gallery_id, gallery_info, gallery_dir, len(page_variants), stats)
+            stats.page_num = len(page_variants)
+            existing_file_names = set(os.listdir(gallery_dir))
+            page_jobs: list[tuple[int, list[tuple[str, str, str]]]] = []
+            for index, variants in enumerate(page_variants):
+                variant_paths = [(image_format, url, image_save_path(gallery_dir, gallery_id, index, url)) for image_format, url in variants]
+                #いずれかの形式で保存済みならリクエストしない
+                saved_path = find_saved_page(variant_paths, existing_file_names)
+                if saved_path is not None:
+                    stats.skipped += 1
+                    if index not in job.manifest.pages:
+                        job.manifest.record(index, os.path.basename(saved_path), os.path.getsize(saved_path), gallery_info.files_info[index].hash)
+                    continue
+                page_jobs.append((index, variant_paths))
+            if not page_jobs:
+                job.manifest.save(gallery_dir)
+                stats.finished = time.perf_counter()
+                continue
+            job.remaining = len(page_jobs)
+            if progress is not None:
+                progress.add_total(len(page_jobs))
+            fetch_page = page_fetcher(gallery_id, gallery_info, False, store, rate_controller, format_negotiator, store_stats)
+            for index, variant_paths in page_jobs:
+                #キューが埋まっている間は待つ(その間も作品情報の先行取得は進む)
+                pending.acquire()
+                future = image_executor.submit(fetch_page, index, variant_paths)
+                future.add_done_callback(lambda future, job=job, index=index: on_page_done(job, index, future))
+    if progress is not None:
+        progress.close()
+    report.finished = time.perf_counter()
+    report.gg_refresh_count = gg_provider.refresh_count - initial_refresh_count
+    report.requests_saved = store_stats.requests_saved
+    report.bytes_saved = store_stats.bytes_saved
+    return report
+
+def bench(gallery_num: int=100, page_num: int=10, image_size: int=64*1024, latency: float=0.02, max_worker: int=5) -> None:
+    """スタブサーバーが返す合成作品100件で、作品ごとのsave_all_image_data_from_idとdownload_galleriesを同じワーカー数で比較する"""
+    import tempfile
+    import email.utils
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import synthetic_gallery_js
+    from url_from_file_info import synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id
+
+    image_data = b'\0' * image_size
+    gg_js = synthetic_gg_js().encode()
+    def fallback(path: str) -> tuple[int, bytes, dict[str, str]]:
+        headers = {'Expires': email.utils.formatdate(time.time() + 3600, usegmt=True)}
+        if path.endswith('/gg.js'):
+            return (200, gg_js, headers)
+        if '/galleries/' in path:
+            gallery_id = int(os.path.basename(path).split('.')[0])
+            return (200, synthetic_gallery_js(gallery_id, page_num).encode(), headers)
+        return (200, image_data, {})
+
+    gallery_ids = list(range(1, gallery_num + 1))
+    with StubServer(fallback=fallback, latency=latency) as server:
+        http_session.configure_transport(url_rewriter=server.rewrite_url)
+        try:
+            with tempfile.TemporaryDirectory() as save_dir:
+                start = time.perf_counter()
+                gg = parse_gg()
+                for gallery_id in gallery_ids:
+                    save_all_image_data_from_id(gallery_id, gg=gg, save_dir=save_dir)
+                elapsed = time.perf_counter() - start
+                print(f'per gallery: {gallery_num * page_num} images in {elapsed:.2f}s ({gallery_num * page_num / elapsed:.1f} images/s)')
+            with tempfile.TemporaryDirectory() as save_dir:
+                report = download_galleries(gallery_ids, save_dir=save_dir, max_worker=max_worker, show_progress=False)
+                print(f'download_galleries: {report.summary()}')
+                slowest = max(report.galleries.values(), key=lambda stats: stats.elapsed)
+                print(f'slowest gallery: {slowest.gallery_id} {slowest.images_per_sec:.1f} images/s')
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,286 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import platform
+import functools
+import statistics
+import email.utils
+import multiprocessing
+from dataclasses import dataclass, asdict, field
+from typing import Any
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import http_session
+from stub_server import StubServer, StubResponse
+from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+from url_from_file_info import parse_gg, synthetic_gg_js, GGJsProvider
+from fetch_image_from_url import fetch_image_from_url
+from hitomi_util import urls_form_id, prepare_save_dir, image_save_path, write_image_data, save_all_image_data_from_id
+from batch_download import download_galleries
+try:
+    import resource
+except ImportError: # Windowsにはないので、その場合はピークRSSを記録しない
+    resource = None
+
+RESULT_VERSION = 1
+SCENARIOS = ('stages', 'save_all_image_data_from_id', 'download_galleries')
+
+@dataclass(frozen=True)
+class CdnConfig:
+    """ローカルCDNシミュレータの設定(作品idは1からgallery_numまで)"""
+    gallery_num: int = 20
+    page_num: int = 20
+    image_size: int = 128 * 1024
+    # 各応答の遅延(秒)と1応答あたりの転送速度(bytes/s、Noneなら制限しない)
+    latency: float = 0.02
+    bandwidth: float|None = None
+    # この割合のリクエストに503を返す
+    error_rate: float = 0.0
+    # gg.js・{gallery_id}.jsのExpires(現在からの秒数。負なら期限切れ)
+    gg_expires_in: float = 3600.0
+    gallery_expires_in: float = 3600.0
+    seed: int = 0
+
+class CdnSimulator(StubServer):
+    """
+    ltn.gold-usergeneratedcontent.netのgg.js・galleries/{gallery_id}.jsと、画像のサブドメイン(a1./w1. など)を模倣するスタブサーバー。
+    gg.jsと作品情報は実物と同じ形式の合成jsで、Expiresヘッダを付けて返す
+    """
+    def __init__(self, config: CdnConfig) -> None:
+        super().__init__(fallback=self._route, latency=config.latency, bandwidth=config.bandwidth, error_rate=config.error_rate, seed=config.seed)
+        self.config = config
+        self._gg_js = synthetic_gg_js(seed=config.seed).encode()
+        self._image_data = random.Random(config.seed).randbytes(config.image_size)
+        self._gallery_js: dict[int, bytes] = {}
+
+    @staticmethod
+    def _expires(expires_in: float) -> dict[str, str]:
+        return {'Expires': email.utils.formatdate(time.time() + expires_in, usegmt=True)}
+
+    def _route(self, path: str) -> StubResponse|None:
+        host, _, file_path = path.lstrip('/').partition('/')
+        if host == 'ltn.gold-usergeneratedcontent.net':
+            if file_path == 'gg.js':
+                return (200, self._gg_js, self._expires(self.config.gg_expires_in))
+            gallery_match = re.fullmatch(r'galleries/(\d+)\.js', file_path)
+            if gallery_match is None or not 1 <= int(gallery_match.group(1)) <= self.config.gallery_num:
+                return None
+            gallery_id = int(gallery_match.group(1))
+            gallery_js = self._gallery_js.get(gallery_id)
+            if gallery_js is None:
+                gallery_js = self._gallery_js[gallery_id] = synthetic_gallery_js(gallery_id, self.config.page_num, seed=self.config.seed + gallery_id).encode()
+            return (200, gallery_js, self._expires(self.config.gallery_expires_in))
+        if host.endswith('.gold-usergeneratedcontent.net'):
+            return (200, self._image_data, {})
+        return None
+
+#スタブサーバーへの差し替え(別プロセスに渡せるようにトップレベルに置く)
+def _rewrite_to(base_url: str, url: str) -> str:
+    _, _, rest = url.partition('://')
+    return f'{base_url}/{rest}'
+
+def peak_rss_bytes() -> int|None:
+    if resource is None:
+        return None
+    # LinuxはKiB、macOSはbytes
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+class StageTimer():
+    """段階ごとの所要時間を記録する(ワーカースレッドから呼ばれても良い)"""
+    def __init__(self) -> None:
+        self.durations: dict[str, list[float]] = {}
+
+    def time(self, stage: str, func: Any, *args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            #list.appendはスレッドセーフ
+            self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def summary(self) -> dict[str, dict[str, float|int]]:
+        result: dict[str, dict[str, float|int]] = {}
+        for stage, durations in self.durations.items():
+            ordered = sorted(durations)
+            result[stage] = {
+                'calls': len(durations),
+                'total_s': sum(durations),
+                'mean_ms': statistics.fmean(durations) * 1000,
+                'p50_ms': ordered[len(ordered) // 2] * 1000,
+                'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return result
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    images: int = 0
+    bytes: int = 0
+    elapsed_s: float = 0.0
+    images_per_sec: float = 0.0
+    mb_per_sec: float = 0.0
+    peak_rss_mb: float|None = None
+    failed: int = 0
+    # 段階ごとの所要時間(stagesのみ)。fetch・writeはワーカースレッドの合計なので経過時間より長くなる
+    stages: dict[str, dict[str, float|int]] = field(default_factory=dict)
+
+def _stages(gallery_ids: list[int], save_dir: str, max_worker: int, result: ScenarioResult) -> None:
+    #save_all_image_data_from_id(stream=False)と同じ処理を段階ごとに計測する
+    timer = StageTimer()
+    gg = timer.time('parse_gg', parse_gg)
+    def fetch_and_write(gallery_id: int, url: str, save_path: str) -> int:
+        image_data = timer.time('fetch_image_from_url', fetch_image_from_url, gallery_id, url)
+        timer.time('write', write_image_data, image_data, save_path)
+        return len(image_data)
+    with ThreadPoolExecutor(max_workers=max_worker) as executor:
+        for gallery_id in gallery_ids:
+            gallery_info = timer.time('gallery_info_from_id', gallery_info_from_id, gallery_id)
+            urls = timer.time('urls_form_id', urls_form_id, gallery_id, gallery_info, gg)
+            gallery_dir = prepare_save_dir(gallery_id, gallery_info, save_dir)
+            futures = [executor.submit(fetch_and_write, gallery_id, url, image_save_path(gallery_dir, gallery_id, index, url)) for index, url in enumerate(urls)]
+            for future in futures:
+                try:
+                    result.bytes += future.result()
+                    result.images += 1
+                except Exception:
+                    result.failed += 1
+    result.stages = timer.summary()
+
+def _save_all_image_data_from_id(gallery_ids: list[int], save_dir: str, max_worker: int, result: ScenarioResult) -> None:
+    gg = GGJsProvider()
+    for gallery_id in gallery_ids:
+        try:
+            save_all_image_data_from_id(gallery_id, gg=gg, save_dir=save_dir, max_worker=max_worker)
+        except Exception:
+            result.failed += 1
+    for root, _, file_names in os.walk(save_dir):
+        for file_name in file_names:
+            if not file_name.endswith('.json'):
+                result.images += 1
+                result.bytes += os.path.getsize(os.path.join(root, file_name))
+
+def _download_galleries(gallery_ids: list[int], save_dir: str, max_worker: int, result: ScenarioResult) -> None:
+    report = download_galleries(gallery_ids, save_dir=save_dir, max_worker=max_worker, show_progress=False)
+    result.images = report.downloaded
+    result.bytes = report.bytes
+    result.failed = sum(stats.failed + (1 if stats.error else 0) for stats in report.galleries.values())
+
+_scenario_funcs = {'stages': _stages, 'save_all_image_data_from_id': _save_all_image_data_from_id, 'download_galleries': _download_galleries}
+
+#1つのシナリオを実行(ピークRSSをシナリオごとに測るため別プロセスで呼ばれる)
+def run_scenario(scenario: str, base_url: str, gallery_num: int, max_worker: int, backoff_factor: float) -> dict[str, Any]:
+    import tempfile
+    http_session.configure_transport(url_rewriter=functools.partial(_rewrite_to, base_url), pool_maxsize=max(16, max_worker), backoff_factor=backoff_factor)
+    result = ScenarioResult(scenario=scenario)
+    gallery_ids = list(range(1, gallery_num + 1))
+    with tempfile.TemporaryDirectory() as save_dir:
+        start = time.perf_counter()
+        _scenario_funcs[scenario](gallery_ids, save_dir, max_worker, result)
+        result.elapsed_s = time.perf_counter() - start
+    result.images_per_sec = result.images / max(result.elapsed_s, 1e-9)
+    result.mb_per_sec = result.bytes / max(result.elapsed_s, 1e-9) / 2**20
+    peak_rss = peak_rss_bytes()
+    result.peak_rss_mb = peak_rss / 2**20 if peak_rss is not None else None
+    return asdict(result)
+
+def run_benchmark(config: CdnConfig|None=None, scenarios: tuple[str, ...]=SCENARIOS, max_worker: int=8, backoff_factor: float=0.05, isolate: bool=True) -> dict[str, Any]:
+    """CDNシミュレータに対して各シナリオを実行し、JSONにできる結果を返す
+
+    Args:
+        config (CdnConfig|None): CDNシミュレータの設定 Defaults to None.
+        scenarios (tuple[str, ...]): 実行するシナリオ(stages: 段階ごとの計測, save_all_image_data_from_id: 作品ごと, download_galleries: 一括) Defaults to SCENARIOS.
+        max_worker (int): 画像ダウンロードのワーカー数 Defaults to 8.
+        backoff_factor (float): error_rateで返す503をリトライするときの待ち時間の係数 Defaults to 0.05.
+        isolate (bool): シナリオごとに別プロセスで実行する(ピークRSSがシナリオごとになり、サーバーとGILを取り合わない) Defaults to True.
+
+    Returns:
+        dict[str, Any]: 設定・環境・シナリオごとの結果
+    """
+    config = config or CdnConfig()
+    results: dict[str, Any] = {}
+    with CdnSimulator(config) as server:
+        for scenario in scenarios:
+            server.reset_counts()
+            args = (scenario, server.base_url, config.gallery_num, max_worker, backoff_factor)
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(run_scenario, *args).result()
+            else:
+                try:
+                    result = run_scenario(*args)
+                finally:
+                    http_session.configure_transport(url_rewriter=None)
+            result['server'] = {'requests': server.request_count, 'connections': server.connection_count, 'injected_errors': server.error_count}
+            results[scenario] = result
+    return {
+        'version': RESULT_VERSION,
+        'timestamp': time.time(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'cdn': asdict(config),
+        'max_worker': max_worker,
+        'isolate': isolate,
+        'scenarios': results,
+    }
+
+def format_result(result: dict[str, Any]) -> str:
+    lines = []
+    for scenario, scenario_result in result['scenarios'].items():
+        peak_rss = f'{scenario_result["peak_rss_mb"]:.1f} MB' if scenario_result['peak_rss_mb'] is not None else 'n/a'
+        lines.append(f'{scenario}: {scenario_result["images"]} images in {scenario_result["elapsed_s"]:.2f}s '
+                     f'({scenario_result["images_per_sec"]:.1f} images/s, {scenario_result["mb_per_sec"]:.1f} MB/s), peak RSS {peak_rss}, '
+                     f'failed: {scenario_result["failed"]}, requests: {scenario_result["server"]["requests"]}')
+        for stage, stage_result in scenario_result['stages'].items():
+            lines.append(f'    {stage}: {stage_result["calls"]} calls, total {stage_result["total_s"]:.3f}s, mean {stage_result["mean_ms"]:.2f}ms, p95 {stage_result["p95_ms"]:.2f}ms')
+    return '\n'.join(lines)
+
+#2回の結果を比較(images/s・MB/s・ピークRSS・段階ごとの平均時間の比)
+def compare_results(base: dict[str, Any], current: dict[str, Any]) -> str:
+    def ratio(before: float|None, after: float|None) -> str:
+        if not before or after is None:
+            return 'n/a'
+        return f'x{after / before:.2f}'
+    lines = []
+    for scenario, current_result in current['scenarios'].items():
+        base_result = base['scenarios'].get(scenario)
+        if base_result is None:
+            continue
+        lines.append(f'{scenario}: images/s {base_result["images_per_sec"]:.1f} -> {current_result["images_per_sec"]:.1f} ({ratio(base_result["images_per_sec"], current_result["images_per_sec"])}), '
+                     f'MB/s {ratio(base_result["mb_per_sec"], current_result["mb_per_sec"])}, peak RSS {ratio(base_result["peak_rss_mb"], current_result["peak_rss_mb"])}')
+        for stage, stage_result in current_result['stages'].items():
+            base_stage = base_result['stages'].get(stage)
+            if base_stage is not None:
+                lines.append(f'    {stage}: mean {base_stage["mean_ms"]:.2f}ms -> {stage_result["mean_ms"]:.2f}ms ({ratio(base_stage["mean_ms"], stage_result["mean_ms"])})')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='ローカルのCDNシミュレータに対してダウンロード処理全体を計測する')
+    parser.add_argument('--galleries', type=int, default=CdnConfig.gallery_num)
+    parser.add_argument('--pages', type=int, default=CdnConfig.page_num)
+    parser.add_argument('--image-size', type=int, default=CdnConfig.image_size, help='画像1枚のバイト数')
+    parser.add_argument('--latency', type=float, default=CdnConfig.latency, help='各応答の遅延(秒)')
+    parser.add_argument('--bandwidth', type=float, default=None, help='1応答あたりの転送速度(bytes/s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503を返すリクエストの割合')
+    parser.add_argument('--gg-expires-in', type=float, default=CdnConfig.gg_expires_in, help='gg.jsのExpires(現在からの秒数)')
+    parser.add_argument('--gallery-expires-in', type=float, default=CdnConfig.gallery_expires_in, help='{gallery_id}.jsのExpires(現在からの秒数)')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='実行するシナリオ(複数指定可。省略時はすべて)')
+    parser.add_argument('--no-isolate', action='store_true', help='シナリオを同じプロセスで実行する')
+    parser.add_argument('--output', help='結果のJSONを書き出すパス')
+    parser.add_argument('--compare', help='比較する以前の結果のJSON')
+    args = parser.parse_args()
+
+    cdn_config = CdnConfig(gallery_num=args.galleries, page_num=args.pages, image_size=args.image_size, latency=args.latency, bandwidth=args.bandwidth,
+                           error_rate=args.error_rate, gg_expires_in=args.gg_expires_in, gallery_expires_in=args.gallery_expires_in)
+    benchmark_result = run_benchmark(cdn_config, tuple(args.scenario or SCENARIOS), args.workers, isolate=not args.no_isolate)
+    print(format_result(benchmark_result))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(benchmark_result, f, ensure_ascii=False, indent=4)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print(compare_results(json.load(f), benchmark_result))
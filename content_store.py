@@ -0,0 +1,134 @@
+import os
+import shutil
+import threading
+import metrics
+from dataclasses import dataclass
+from typing import Callable
+from fetch_image_from_url import fetch_image_to_file
+
+@dataclass
+class ContentStoreStats:
+    stored: int = 0
+    stored_bytes: int = 0
+    requests_saved: int = 0
+    bytes_saved: int = 0
+
+    def summary(self) -> str:
+        return f'stored {self.stored} blobs ({self.stored_bytes / 2**20:.1f} MB), saved {self.requests_saved} requests ({self.bytes_saved / 2**20:.1f} MB)'
+
+class ContentStore():
+    """
+    画像をFileInfo.hashごとに1回だけ保存するストア。
+    作品フォルダにはストアの実体へのハードリンク(作成できなければコピー)を置き、保存済みのhashはリクエストせずにリンクする。
+    同じ元画像でもwebp/avifなど形式ごとに内容が違うので、hashと拡張子の組で区別する
+    """
+    def __init__(self, store_dir: str) -> None:
+        """
+        Args:
+            store_dir (str): 実体の保存先(作品フォルダと同じファイルシステムならハードリンクになる)
+        """
+        self.store_dir = store_dir
+        self.stats = ContentStoreStats()
+        self._lock = threading.Lock()
+        #取得中の実体。同じhashを複数の作品から同時に取得しないよう、2件目以降は完了を待ってリンクする
+        self._in_flight: dict[str, threading.Event] = {}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def blob_path(self, file_hash: str, ext: str) -> str:
+        return os.path.join(self.store_dir, file_hash[:2], f'{file_hash}{ext}')
+
+    def _link(self, blob_path: str, save_path: str) -> None:
+        if os.path.exists(save_path):
+            os.remove(save_path)
+        try:
+            os.link(blob_path, save_path)
+        except OSError:
+            #別のファイルシステム・ハードリンク非対応ならコピーする
+            shutil.copyfile(blob_path, save_path)
+
+    def fetch_to_file(self, gallery_id: int, url: str, save_path: str, file_hash: str, expected_hash: str|None=None, fetch: Callable[[int, str, str, str|None], str]=fetch_image_to_file, run_stats: ContentStoreStats|None=None) -> str:
+        """fetch_image_to_fileと同じだが、保存済みのhashならネットワークにアクセスせずリンクする
+
+        Args:
+            gallery_id (int): 作品id
+            url (str): 画像のurl
+            save_path (str): 作品フォルダ内の保存先
+            file_hash (str): FileInfo.hash
+            expected_hash (str|None): 指定するとSHA-256を照合する(元画像の場合のみ) Defaults to None.
+            fetch (Callable): 実体を取得する関数(RateController.fetch_image_to_fileなど) Defaults to fetch_image_to_file.
+            run_stats (ContentStoreStats|None): store.statsに加えて集計する、1回の実行分の統計 Defaults to None.
+
+        Returns:
+            str: save_path
+        """
+        blob_path = self.blob_path(file_hash, os.path.splitext(url)[-1])
+        while True:
+            with self._lock:
+                if os.path.exists(blob_path):
+                    size = os.path.getsize(blob_path)
+                    for stats in (self.stats, run_stats):
+                        if stats is not None:
+                            stats.requests_saved += 1
+                            stats.bytes_saved += size
+                    metrics.inc('content_store_total', result='hit')
+                    break
+                event = self._in_flight.get(blob_path)
+                if event is None:
+                    event = self._in_flight[blob_path] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                event.wait()
+                continue
+            try:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                fetch(gallery_id, url, blob_path, expected_hash)
+                size = os.path.getsize(blob_path)
+                with self._lock:
+                    for stats in (self.stats, run_stats):
+                        if stats is not None:
+                            stats.stored += 1
+                            stats.stored_bytes += size
+                metrics.inc('content_store_total', result='stored')
+            finally:
+                with self._lock:
+                    del self._in_flight[blob_path]
+                event.set()
+            break
+        self._link(blob_path, save_path)
+        return save_path
+
+def test(page_num: int=20) -> None:
+    """同じページを持つ2作品を保存し、2作品目は画像をリクエストせず同じ実体にリンクされることを確認する"""
+    import tempfile
+    import http_session
+    from dataclasses import astuple
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id
+
+    image_data = os.urandom(32 * 1024)
+    gg = parse_gg(synthetic_gg_js())
+    #翻訳版・再アップロードを想定し、同じseedで同じfilesを持つ2作品
+    gallery_infos = {gallery_id: gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, page_num, seed=1)) for gallery_id in (1, 2)}
+    with StubServer(fallback=lambda path: (200, image_data, {})) as server, tempfile.TemporaryDirectory() as save_dir:
+        http_session.configure_transport(url_rewriter=server.rewrite_url)
+        try:
+            store = ContentStore(os.path.join(save_dir, 'store'))
+            run_stats = [save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, store=store) for gallery_id, gallery_info in gallery_infos.items()]
+            assert server.request_count == page_num
+            #実行ごとの統計: 1作品目はすべて保存し、2作品目はすべてリンクする
+            assert astuple(run_stats[0]) == (page_num, page_num * len(image_data), 0, 0), run_stats[0]
+            assert astuple(run_stats[1]) == (0, 0, page_num, page_num * len(image_data)), run_stats[1]
+            assert store.stats.stored == page_num and store.stats.requests_saved == page_num
+            gallery_dirs = sorted(os.path.join(save_dir, name) for name in os.listdir(save_dir) if name != 'store')
+            first_page, second_page = (os.path.join(gallery_dir, sorted(name for name in os.listdir(gallery_dir) if name.endswith('.webp') or name.endswith('.avif'))[0]) for gallery_dir in gallery_dirs)
+            assert os.path.samefile(first_page, second_page)
+            print(f'requests: {server.request_count}, {store.stats.summary()}')
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+
+if __name__ == '__main__':
+    test()
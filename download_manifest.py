@@ -0,0 +1,70 @@
+import os
+import json
+from dataclasses import dataclass, field, asdict
+
+@dataclass
+class PageRecord:
+    name: str
+    size: int
+    # 元画像のFileInfo.hash(どのページかを示す)。保存したavif/webpなどのファイル自体のhashではない
+    source_hash: str
+
+@dataclass
+class DownloadManifest:
+    """
+    作品フォルダに保存する、ダウンロード済みページの記録。
+    全ページが記録済みで画像ファイルも揃っていれば、再実行時にネットワークへアクセスせずに終了できる
+    """
+    gallery_id: int
+    page_num: int
+    pages: dict[int, PageRecord] = field(default_factory=dict)
+
+    @staticmethod
+    def path_from_save_dir(save_dir: str, gallery_id: int) -> str:
+        return os.path.join(save_dir, f'{gallery_id:08}.manifest.json')
+
+    @classmethod
+    def load(cls, save_dir: str, gallery_id: int) -> 'DownloadManifest|None':
+        try:
+            with open(cls.path_from_save_dir(save_dir, gallery_id), 'r', encoding='utf-8') as f:
+                manifest_json = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        #以前のmanifestはsource_hashをhashとして記録している
+        pages = {int(index): PageRecord(name=page['name'], size=page['size'], source_hash=page.get('source_hash', page.get('hash', ''))) for index, page in manifest_json['pages'].items()}
+        return cls(gallery_id=manifest_json['gallery_id'], page_num=manifest_json['page_num'], pages=pages)
+
+    def save(self, save_dir: str) -> None:
+        manifest_path = self.path_from_save_dir(save_dir, self.gallery_id)
+        #途中で止まっても壊れたmanifestが残らないように一時ファイルからリネームする
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(asdict(self), f, ensure_ascii=False)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def record(self, index: int, name: str, size: int, source_hash: str) -> None:
+        self.pages[index] = PageRecord(name=name, size=size, source_hash=source_hash)
+
+    def is_complete(self, existing_file_names: set[str]) -> bool:
+        return len(self.pages) >= self.page_num and all(page.name in existing_file_names for page in self.pages.values())
+
+#保存先ディレクトリから作品フォルダ({gallery_id:08}_タイトル)を探す
+def find_gallery_dir(save_dir: str, gallery_id: int) -> str|None:
+    prefix = f'{gallery_id:08}_'
+    try:
+        with os.scandir(save_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and entry.is_dir():
+                    return entry.path
+    except FileNotFoundError:
+        pass
+    return None
+
+#再実行時、manifestどおりに全ページが揃っているか(ネットワークアクセスなしで判定)
+def is_gallery_complete(save_dir: str, gallery_id: int) -> bool:
+    gallery_dir = find_gallery_dir(save_dir, gallery_id)
+    if gallery_dir is None:
+        return False
+    manifest = DownloadManifest.load(gallery_dir, gallery_id)
+    if manifest is None:
+        return False
+    return manifest.is_complete(set(os.listdir(gallery_dir)))
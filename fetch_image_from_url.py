@@ -1,9 +1,23 @@
+import os
+import time
 import random
+import hashlib
 import requests
+import metrics
 import ua_generator # type: ignore
-from urllib3.util import Retry
-from requests.adapters import HTTPAdapter
 from enum import Enum
+from urllib.parse import urlsplit
+from http_session import http_get
+
+class ImageHashMismatch(Exception):
+    def __init__(self, url: str, expected_hash: str, actual_hash: str) -> None:
+        super().__init__(self)
+        self.url = url
+        self.expected_hash = expected_hash
+        self.actual_hash = actual_hash
+
+    def __str__(self):
+        return f'SHA-256 mismatch: {self.url} (expected {self.expected_hash}, got {self.actual_hash})'
 
 class Device(Enum):
     DESKTOP = "desktop"
@@ -20,9 +34,8 @@ class Browser(Enum):
     FIREFOX = 'firefox'
     SAFARI = 'safari'
 
-#作品idと画像urlから作品を取得
-def fetch_image_from_url(gallery_id: int, url: str, retry_num: int=5) -> bytes:
-    
+#画像リクエスト用の偽装ヘッダを作成
+def image_request_headers(gallery_id: int) -> dict[str, str]:
     #例のヘッダ
     headers = {
         'accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
@@ -65,19 +78,95 @@ def fetch_image_from_url(gallery_id: int, url: str, retry_num: int=5) -> bytes:
         if header_key in ua_dict:
             headers[header_key] = ua_dict[header_key]
     #print(headers)
+    return headers
 
+#作品idと画像urlから作品を取得
+def fetch_image_from_url(gallery_id: int, url: str, retry_num: int|None=None) -> bytes:
+    headers = image_request_headers(gallery_id)
     try:
-        session = requests.Session()
-        retry = Retry(total=retry_num, backoff_factor=1, status_forcelist=[502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('https://', adapter)
-        response = session.get(url, headers=headers, timeout=(10, 30))
+        #接続プールとリトライ方針は全ワーカーで共有する(retry_numを省略した場合はhttp_sessionの設定)
+        response = http_get(url, headers=headers, retry_num=retry_num)
         response.raise_for_status()
+        metrics.observe('image_size_bytes', len(response.content), host=urlsplit(url).netloc)
         return response.content
     
     except requests.HTTPError as e:
-        print('Failed to fetch image data')
+        metrics.message('error', 'Failed to fetch image data')
+        raise e
+
+#作品idと画像urlから作品を取得し、メモリに溜めずにファイルへ書き込む
+def fetch_image_to_file(gallery_id: int, url: str, file_path: str, expected_hash: str|None=None, chunk_size: int=64*1024, retry_num: int|None=None) -> str:
+    """画像をchunk_sizeずつ一時ファイル(.part)に書き込み、完了後にfile_pathへリネームする
+    以前の.partが残っていればRangeリクエストで続きから取得する
+
+    Args:
+        gallery_id (int): 作品id
+        url (str): 画像url
+        file_path (str): 保存先パス
+        expected_hash (str|None): 指定した場合、受信しながらSHA-256を計算して照合する Defaults to None.
+        chunk_size (int): 一度に読み込むバイト数。メモリ上に保持するのはこのサイズまで Defaults to 64*1024.
+        retry_num (int|None): リトライ回数。指定しない場合はhttp_sessionの設定 Defaults to None.
+
+    Raises:
+        ImageHashMismatch: 受信した画像のSHA-256がexpected_hashと一致しない
+
+    Returns:
+        str: 保存先パス
+    """
+    headers = image_request_headers(gallery_id)
+    part_path = file_path + '.part'
+    sha256 = hashlib.sha256() if expected_hash else None
+    #中断された.partがあればRangeリクエストで続きから取得する
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if resume_from:
+        headers['range'] = f'bytes={resume_from}-'
+        headers['accept-encoding'] = 'identity'
+    try:
+        with http_get(url, headers=headers, retry_num=retry_num, stream=True) as response:
+            if resume_from and response.status_code == 416:
+                #.partが壊れている(サーバー上のサイズ以上ある)ので最初から取得し直す
+                os.remove(part_path)
+                return fetch_image_to_file(gallery_id, url, file_path, expected_hash, chunk_size, retry_num)
+            response.raise_for_status()
+            #206なら続きを追記、200ならサーバーがRangeを無視したので最初から書き直す
+            is_resumed = resume_from > 0 and response.status_code == 206
+            if is_resumed and sha256 is not None:
+                with open(part_path, 'rb') as f:
+                    while chunk := f.read(chunk_size):
+                        sha256.update(chunk)
+            #通知先がなければchunkごとの計測をしない
+            record_metrics = metrics.enabled()
+            transfer_started = time.perf_counter()
+            write_seconds = 0.0
+            received = 0
+            with open(part_path, 'ab' if is_resumed else 'wb', buffering=chunk_size) as f:
+                if record_metrics:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        write_started = time.perf_counter()
+                        f.write(chunk)
+                        write_seconds += time.perf_counter() - write_started
+                        received += len(chunk)
+                        if sha256 is not None:
+                            sha256.update(chunk)
+                else:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        if sha256 is not None:
+                            sha256.update(chunk)
+            if record_metrics:
+                host = urlsplit(url).netloc
+                metrics.observe('image_transfer_seconds', time.perf_counter() - transfer_started, host=host)
+                metrics.observe('image_size_bytes', received, host=host)
+                metrics.observe('disk_write_seconds', write_seconds)
+    except requests.HTTPError as e:
+        #次の形式・再試行で取得できることがあるので、最終的な失敗は呼び出し元が報告する
+        metrics.message('debug', f'Failed to fetch image data: {url}\n{e}')
         raise e
+    if sha256 is not None and expected_hash is not None and sha256.hexdigest() != expected_hash:
+        os.remove(part_path)
+        raise ImageHashMismatch(url, expected_hash, sha256.hexdigest())
+    os.replace(part_path, file_path)
+    return file_path
 
 def test():
     pass
@@ -0,0 +1,254 @@
+import os
+import zlib
+import struct
+import zipfile
+import metrics
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Iterable
+from xml.etree import ElementTree
+from gallery_info_from_id import GalleryInfo
+
+COMIC_INFO_NAME = 'ComicInfo.xml'
+ARCHIVE_EXT = '.cbz'
+
+# ComicInfo.xmlのLanguageISO(hitomi.laの言語名から)
+_language_iso = {'japanese': 'ja', 'english': 'en', 'chinese': 'zh', 'korean': 'ko', 'spanish': 'es', 'french': 'fr', 'german': 'de', 'russian': 'ru', 'italian': 'it', 'portuguese': 'pt', 'thai': 'th', 'vietnamese': 'vi', 'indonesian': 'id'}
+
+#作品情報をComicInfo.xml(ComicRack形式。多くのcbzリーダーが読む)に変換
+def comic_info_xml(gallery_id: int, gallery_info: GalleryInfo, page_num: int) -> bytes:
+    root = ElementTree.Element('ComicInfo')
+    def add(key: str, value: str|int) -> None:
+        if value != '' and value is not None:
+            ElementTree.SubElement(root, key).text = str(value)
+    add('Title', gallery_info.japanese_title or gallery_info.title)
+    add('Series', ', '.join(parody.parody for parody in gallery_info.parodies))
+    add('Writer', ', '.join(artist.artist for artist in gallery_info.artists))
+    add('Publisher', ', '.join(group.group for group in gallery_info.groups))
+    add('Genre', gallery_info.type)
+    add('Characters', ', '.join(character.character for character in gallery_info.characters))
+    add('Tags', ', '.join(f'female:{tag.tag}' if tag.female else f'male:{tag.tag}' if tag.male else tag.tag for tag in gallery_info.tags))
+    add('LanguageISO', _language_iso.get(gallery_info.language, ''))
+    add('Web', f'https://hitomi.la/galleries/{gallery_id}.html')
+    add('PageCount', page_num)
+    add('Notes', f'gallery_id: {gallery_id}')
+    return ElementTree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+#保存先ディレクトリから作品のアーカイブ({gallery_id:08}_タイトル.cbz)を探す
+def find_gallery_archive(save_dir: str, gallery_id: int) -> str|None:
+    prefix = f'{gallery_id:08}_'
+    try:
+        with os.scandir(save_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and entry.name.endswith(ARCHIVE_EXT) and entry.is_file():
+                    return entry.path
+    except FileNotFoundError:
+        pass
+    return None
+
+#再実行時、アーカイブに全ページが揃っているか(central directoryとComicInfo.xmlのPageCountだけで判定)
+def is_archive_complete(save_dir: str, gallery_id: int) -> bool:
+    archive_path = find_gallery_archive(save_dir, gallery_id)
+    if archive_path is None:
+        return False
+    try:
+        with zipfile.ZipFile(archive_path) as zip_file:
+            names = zip_file.namelist()
+            if COMIC_INFO_NAME not in names:
+                return False
+            page_count = ElementTree.fromstring(zip_file.read(COMIC_INFO_NAME)).findtext('PageCount')
+    except (zipfile.BadZipFile, ElementTree.ParseError, OSError):
+        return False
+    return page_count is not None and len(page_names(names, gallery_id)) >= int(page_count)
+
+#アーカイブ内のページ({gallery_id:08}_{index:05}.拡張子)の名前
+def page_names(names: Iterable[str], gallery_id: int) -> list[str]:
+    prefix = f'{gallery_id:08}_'
+    return [name for name in names if name.startswith(prefix) and not name.endswith('.json')]
+
+class GalleryArchive():
+    """
+    作品を1つのcbz(ZIP)にまとめる。画像は圧縮済みなのでSTOREDで格納する。
+    既存のアーカイブはcentral directoryから格納済みのページを読み取り、続きを追記する(central directoryがなければローカルファイルヘッダから取り出す)。
+    取得中のページは{アーカイブ}.pages/に一時ファイルとして置き、ページ順に格納したら削除する
+    """
+    def __init__(self, archive_path: str) -> None:
+        self.path = archive_path
+        self.pages_dir = archive_path + '.pages'
+        self._zip = self._open()
+        self.names = set(self._zip.namelist())
+        os.makedirs(self.pages_dir, exist_ok=True)
+
+    def _open(self) -> zipfile.ZipFile:
+        if not os.path.exists(self.path):
+            return zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED)
+        #'a'はZIPとして読めないファイルの末尾に新しいZIPを追記してしまう(格納済みのページが読めなくなる)ので、先に読めるか確かめる
+        try:
+            zipfile.ZipFile(self.path).close()
+        except zipfile.BadZipFile:
+            #central directoryを書く前に強制終了したもの。格納済みのページをローカルファイルヘッダから取り出す
+            recovered = self._recover()
+            metrics.message('warning', f'Broken archive, recovered {recovered} entries: {self.path}')
+        return zipfile.ZipFile(self.path, 'a', zipfile.ZIP_STORED)
+
+    def _recover(self) -> int:
+        """先頭からローカルファイルヘッダを順に読み、最後まで書き込まれたエントリだけで一時ファイルにアーカイブを作り直して置き換える
+
+        Returns:
+            int: 取り出したエントリ数
+        """
+        recover_path = self.path + '.recover'
+        recovered = 0
+        try:
+            with open(self.path, 'rb') as f, zipfile.ZipFile(recover_path, 'w', zipfile.ZIP_STORED) as recovered_zip:
+                while len(header := f.read(zipfile.sizeFileHeader)) == zipfile.sizeFileHeader:
+                    signature, _, _, flag_bits, compress_type, dos_time, dos_date, crc, compress_size, file_size, name_len, extra_len = struct.unpack(zipfile.structFileHeader, header)
+                    #書き込むのはサイズがヘッダにあるSTOREDのエントリだけなので、それ以外(central directoryなど)に達したら終わり
+                    if signature != zipfile.stringFileHeader or flag_bits & 0x08 or compress_type != zipfile.ZIP_STORED or compress_size != file_size:
+                        break
+                    name_bytes = f.read(name_len)
+                    f.seek(extra_len, os.SEEK_CUR)
+                    data = f.read(compress_size)
+                    #書き込み途中で切れたエントリ
+                    if len(name_bytes) < name_len or len(data) < compress_size or zlib.crc32(data) != crc:
+                        break
+                    info = zipfile.ZipInfo(name_bytes.decode('utf-8' if flag_bits & 0x800 else 'cp437'), ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F, dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2))
+                    info.external_attr = 0o600 << 16
+                    recovered_zip.writestr(info, data)
+                    recovered += 1
+            os.replace(recover_path, self.path)
+        except BaseException:
+            if os.path.exists(recover_path):
+                os.remove(recover_path)
+            raise
+        return recovered
+
+    def __enter__(self) -> 'GalleryArchive':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        #central directoryを書き込む(例外で中断した場合もここまでのページは次回読み取れる)
+        self._zip.close()
+        try:
+            os.rmdir(self.pages_dir)
+        except OSError:
+            #取得途中の一時ファイルが残っている場合は次回に使う
+            pass
+
+    def write_bytes(self, name: str, data: bytes) -> None:
+        if name in self.names:
+            return
+        self._zip.writestr(name, data)
+        self.names.add(name)
+
+    def write_file(self, file_path: str, name: str|None=None) -> str:
+        """一時ファイルを格納して削除する"""
+        name = name or os.path.basename(file_path)
+        if name not in self.names:
+            self._zip.write(file_path, name)
+            self.names.add(name)
+        os.remove(file_path)
+        return name
+
+    def write_in_order(self, indexes: Iterable[int], submit: Callable[[int], Future[str]], window: int, on_written: Callable[[int, str], None]|None=None) -> None:
+        """indexesの順に取得を開始し、取得が終わった順ではなくページ順に格納する
+        取得中と格納待ちのページはwindow件までなので、一時ファイルが溜まり続けない
+
+        Args:
+            indexes (Iterable[int]): 取得するページ番号(昇順)
+            submit (Callable[[int], Future[str]]): ページの取得を開始し、一時ファイルのパスを返すFutureを返す
+            window (int): 同時に取得中・格納待ちにするページ数の上限
+            on_written (Callable[[int, str], None]|None): ページを格納するたびに(ページ番号, 格納名)で呼ぶ Defaults to None.
+        """
+        in_flight: deque[tuple[int, Future[str]]] = deque()
+        def write_head() -> None:
+            index, future = in_flight.popleft()
+            name = self.write_file(future.result())
+            if on_written is not None:
+                on_written(index, name)
+        try:
+            for index in indexes:
+                if len(in_flight) >= window:
+                    write_head()
+                in_flight.append((index, submit(index)))
+            while in_flight:
+                write_head()
+        finally:
+            for _, future in in_flight:
+                future.cancel()
+
+def test(page_num: int=30) -> None:
+    """取得が終わる順番がばらばらでもページ順に格納され、中断後は格納済みのページをリクエストしないことを確認する"""
+    import random
+    import time
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id
+
+    gg = parse_gg(synthetic_gg_js())
+    gallery_id = 1
+    gallery_info = gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, page_num))
+    rng = random.Random(0)
+    fail_from: int|None = page_num // 2
+    request_paths: list[str] = []
+    def fallback(path: str) -> tuple[int, bytes, dict[str, str]]|None:
+        request_paths.append(path)
+        time.sleep(rng.random() * 0.02)
+        #1回目は後半のページを404にして中断させる
+        index = next(index for index, file_info in enumerate(gallery_info.files_info) if file_info.hash in path)
+        if fail_from is not None and index >= fail_from:
+            return None
+        return (200, f'page {index}'.encode() * 100, {})
+    retry_num = http_session.get_config().retry_num
+    with StubServer(fallback=fallback) as server, tempfile.TemporaryDirectory() as save_dir:
+        http_session.configure_transport(url_rewriter=server.rewrite_url, retry_num=0)
+        try:
+            try:
+                save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, archive=True)
+                raise AssertionError('expected 404')
+            except Exception as e:
+                if isinstance(e, AssertionError):
+                    raise
+            archive_path = find_gallery_archive(save_dir, gallery_id)
+            assert archive_path is not None and not is_archive_complete(save_dir, gallery_id)
+            with zipfile.ZipFile(archive_path) as zip_file:
+                written = page_names(zip_file.namelist(), gallery_id)
+            assert 0 < len(written) <= fail_from and written == sorted(written), written
+            #central directoryを書く前に強制終了した状態(最後のエントリは書きかけ)にする
+            with zipfile.ZipFile(archive_path) as zip_file:
+                central_directory_offset = zip_file.start_dir
+            with open(archive_path, 'r+b') as f:
+                f.seek(central_directory_offset)
+                f.write(zipfile.stringFileHeader + b'\0' * 10)
+                f.truncate()
+            assert not is_archive_complete(save_dir, gallery_id)
+
+            fail_from = None
+            request_paths.clear()
+            save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, archive=True)
+            assert len(request_paths) == page_num - len(written), len(request_paths)
+            assert is_archive_complete(save_dir, gallery_id)
+            with zipfile.ZipFile(archive_path) as zip_file:
+                names = zip_file.namelist()
+                pages = page_names(names, gallery_id)
+                assert pages == sorted(pages) and len(pages) == page_num
+                assert all(info.compress_type == zipfile.ZIP_STORED for info in zip_file.infolist())
+                assert zip_file.read(pages[3]) == b'page 3' * 100
+                assert ElementTree.fromstring(zip_file.read(COMIC_INFO_NAME)).findtext('PageCount') == str(page_num)
+                assert f'{gallery_id:08}.json' in names
+            assert os.listdir(save_dir) == [os.path.basename(archive_path)]
+            request_paths.clear()
+            save_all_image_data_from_id(gallery_id, save_dir=save_dir, archive=True)
+            assert not request_paths
+            print(f'{archive_path}: {len(names)} entries, resumed after {len(written)} pages')
+        finally:
+            http_session.configure_transport(url_rewriter=None, retry_num=retry_num)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import pickle
+import tempfile
+import threading
+import requests
+import metrics
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Mapping
+from gallery_info_from_id import GalleryInfo, parse_gallery_js, gallery_js_url, parse_expires, gallery_expire_checker
+from http_session import http_get
+
+#GalleryInfoの保存形式(__slots__化などでpickleの中身が変わったら上げる)
+_PICKLE_FORMAT = 2
+
+class GalleryCacheMiss(Exception):
+    def __init__(self, gallery_id: int) -> None:
+        super().__init__(self)
+        self.gallery_id = gallery_id
+
+    def __str__(self):
+        return f'{self.gallery_id}.js is not cached (offline mode)'
+
+@dataclass
+class GalleryCacheEntry:
+    gallery_id: int
+    expires_at: float|None
+    etag: str|None
+    last_modified: str|None
+    size: int
+
+def _expires_at_from_headers(headers: Mapping[str, str]) -> float|None:
+    time_str_may_be_gmt = headers.get('Expires')
+    if not time_str_may_be_gmt:
+        return None
+    try:
+        return parse_expires(time_str_may_be_gmt)
+    except (ValueError, OverflowError):
+        return None
+
+class GalleryCache():
+    """
+    {gallery_id}.jsの生のjsとparseしたGalleryInfoをディスクに保存するキャッシュ。
+    Expiresまではネットワークにアクセスせず、期限切れ後はETag/Last-Modifiedで条件付きリクエストを行う。
+    合計サイズがmax_bytesを超えると、最後に使われたのが古いものから削除する
+    """
+    def __init__(self, cache_dir: str, max_bytes: int=512*2**20, offline: bool=False, columnar: bool=False) -> None:
+        """
+        Args:
+            cache_dir (str): キャッシュの保存先ディレクトリ
+            max_bytes (int): キャッシュの合計サイズの上限 Defaults to 512MiB.
+            offline (bool): キャッシュのみを使い、ネットワークにアクセスしない(期限切れでも返す) Defaults to False.
+            columnar (bool): ファイル情報をFilesTable(列ごとの表)で保持する Defaults to False.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.columnar = columnar
+        self.hit_count = 0
+        self.revalidated_count = 0
+        self.miss_count = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        #gallery_id -> サイズ を最終アクセスが古い順に持つ(削除のたびにディレクトリを走査しないため)
+        self._lru: OrderedDict[int, int] = OrderedDict()
+        for _, gallery_id in sorted(self._scan_mtimes()):
+            self._lru[gallery_id] = self._entry_size(gallery_id)
+        self._total_bytes = sum(self._lru.values())
+
+    def _path(self, gallery_id: int, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f'{int(gallery_id)}{suffix}')
+
+    def _cached_ids(self) -> list[int]:
+        return [int(name.removesuffix('.meta.json')) for name in os.listdir(self.cache_dir) if name.endswith('.meta.json')]
+
+    def _scan_mtimes(self) -> list[tuple[float, int]]:
+        #meta.jsonのmtimeが最終アクセス時刻
+        mtimes: list[tuple[float, int]] = []
+        for gallery_id in self._cached_ids():
+            try:
+                mtimes.append((os.path.getmtime(self._path(gallery_id, '.meta.json')), gallery_id))
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    def _entry_size(self, gallery_id: int) -> int:
+        size = 0
+        for suffix in ('.js', '.pickle', '.meta.json'):
+            try:
+                size += os.path.getsize(self._path(gallery_id, suffix))
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        #一時ファイル名を書き込みごとに変えて、同じファイルへの同時書き込みが混ざらないようにする
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def load_entry(self, gallery_id: int) -> GalleryCacheEntry|None:
+        try:
+            with open(self._path(gallery_id, '.meta.json'), 'r', encoding='utf-8') as f:
+                return GalleryCacheEntry(**json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            return None
+
+    def load_js_bytes(self, gallery_id: int) -> bytes|None:
+        try:
+            with open(self._path(gallery_id, '.js'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _load_gallery_info(self, entry: GalleryCacheEntry) -> GalleryInfo|None:
+        try:
+            with open(self._path(entry.gallery_id, '.pickle'), 'rb') as f:
+                pickle_format, gallery_info = pickle.load(f)
+            if pickle_format != _PICKLE_FORMAT:
+                raise pickle.UnpicklingError(f'unsupported cache format: {pickle_format}')
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError, AttributeError, TypeError, ValueError):
+            #parse済みのものが読めなければ生のjsからparseし直す
+            js_bytes = self.load_js_bytes(entry.gallery_id)
+            if js_bytes is None:
+                return None
+            gallery_info = parse_gallery_js(js_bytes, self.columnar)
+        gallery_info.expires_at = entry.expires_at
+        gallery_info.is_expire = gallery_expire_checker(entry.gallery_id, entry.expires_at)
+        #最終アクセス時刻(LRU)としてmeta.jsonのmtimeを更新する
+        with self._lock:
+            try:
+                os.utime(self._path(entry.gallery_id, '.meta.json'))
+            except FileNotFoundError:
+                pass
+            if entry.gallery_id in self._lru:
+                self._lru.move_to_end(entry.gallery_id)
+        return gallery_info
+
+    def _store(self, gallery_id: int, js_bytes: bytes, response: requests.Response) -> GalleryInfo:
+        #生のjsはデコードせずにbytesのままparse・保存する
+        gallery_info = parse_gallery_js(js_bytes, self.columnar)
+        #is_expireはpickleできないので外して保存する
+        gallery_info.is_expire = None
+        pickle_bytes = pickle.dumps((_PICKLE_FORMAT, gallery_info), protocol=pickle.HIGHEST_PROTOCOL)
+        entry = GalleryCacheEntry(gallery_id=int(gallery_id), expires_at=_expires_at_from_headers(response.headers), etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'), size=0)
+        entry.size = len(js_bytes) + len(pickle_bytes)
+        meta_bytes = json.dumps(asdict(entry)).encode('utf-8')
+        with self._lock:
+            self._total_bytes -= self._lru.pop(int(gallery_id), 0)
+            self._write_atomic(self._path(gallery_id, '.js'), js_bytes)
+            self._write_atomic(self._path(gallery_id, '.pickle'), pickle_bytes)
+            self._write_atomic(self._path(gallery_id, '.meta.json'), meta_bytes)
+            size = self._entry_size(gallery_id)
+            self._lru[int(gallery_id)] = size
+            self._total_bytes += size
+            self._evict(keep=int(gallery_id))
+        gallery_info.expires_at = entry.expires_at
+        gallery_info.is_expire = gallery_expire_checker(gallery_id, entry.expires_at)
+        return gallery_info
+
+    def _evict(self, keep: int) -> None:
+        #最終アクセスが古い順に削除(keepは末尾にあるので最後まで残る)
+        while self._total_bytes > self.max_bytes and self._lru:
+            gallery_id = next(iter(self._lru))
+            if gallery_id == keep:
+                break
+            self._total_bytes -= self._lru.pop(gallery_id)
+            self._remove(gallery_id)
+
+    def _remove(self, gallery_id: int) -> None:
+        for suffix in ('.meta.json', '.js', '.pickle'):
+            try:
+                os.remove(self._path(gallery_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def remove(self, gallery_id: int) -> None:
+        with self._lock:
+            self._total_bytes -= self._lru.pop(int(gallery_id), 0)
+            self._remove(gallery_id)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def gallery_info(self, gallery_id: int) -> GalleryInfo:
+        """キャッシュを使って作品情報を取得する
+
+        Args:
+            gallery_id (int): 作品id
+
+        Raises:
+            GalleryCacheMiss: オフラインモードでキャッシュがない
+            e: 作品情報の取得に失敗
+
+        Returns:
+            GalleryInfo: 作品情報をまとめたdataclass
+        """
+        entry = self.load_entry(gallery_id)
+        if entry is not None and (self.offline or (entry.expires_at is not None and time.time() < entry.expires_at)):
+            gallery_info = self._load_gallery_info(entry)
+            if gallery_info is not None:
+                with self._lock:
+                    self.hit_count += 1
+                metrics.inc('gallery_cache_total', result='hit')
+                return gallery_info
+        if self.offline:
+            raise GalleryCacheMiss(gallery_id)
+
+        #期限切れならETag/Last-Modifiedで条件付きリクエスト
+        headers: dict[str, str] = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            response = http_get(gallery_js_url(gallery_id), headers=headers)
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            metrics.message('error', f'Failed to fetch {str(gallery_id)}.js')
+            raise e
+        if response.status_code == 304 and entry is not None:
+            entry.expires_at = _expires_at_from_headers(response.headers) or entry.expires_at
+            entry.etag = response.headers.get('ETag', entry.etag)
+            entry.last_modified = response.headers.get('Last-Modified', entry.last_modified)
+            meta_bytes = json.dumps(asdict(entry)).encode('utf-8')
+            with self._lock:
+                self._write_atomic(self._path(gallery_id, '.meta.json'), meta_bytes)
+            gallery_info = self._load_gallery_info(entry)
+            if gallery_info is not None:
+                with self._lock:
+                    self.revalidated_count += 1
+                metrics.inc('gallery_cache_total', result='revalidated')
+                return gallery_info
+            #キャッシュが壊れていたので条件なしで取得し直す
+            response = http_get(gallery_js_url(gallery_id))
+            response.raise_for_status()
+        with self._lock:
+            self.miss_count += 1
+        metrics.inc('gallery_cache_total', result='miss')
+        return self._store(gallery_id, response.content, response)
+
+def test(gallery_num: int=20) -> None:
+    """スタブサーバーで、期限内はリクエストせず、期限切れ後は304で再検証されることを確認する"""
+    import email.utils
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import synthetic_gallery_js
+
+    expires_in = 3600.0
+    def fallback(path: str) -> tuple[int, bytes, dict[str, str]]:
+        gallery_id = int(os.path.basename(path).split('.')[0])
+        headers = {'Expires': email.utils.formatdate(time.time() + expires_in, usegmt=True), 'ETag': f'"{gallery_id}"'}
+        return (200, synthetic_gallery_js(gallery_id, 10).encode(), headers)
+
+    with StubServer(fallback=fallback) as server, tempfile.TemporaryDirectory() as cache_dir:
+        http_session.configure_transport(url_rewriter=server.rewrite_url)
+        try:
+            cache = GalleryCache(cache_dir)
+            for gallery_id in range(1, gallery_num + 1):
+                cache.gallery_info(gallery_id)
+            assert server.request_count == gallery_num
+            for gallery_id in range(1, gallery_num + 1):
+                assert cache.gallery_info(gallery_id).gallery_id == str(gallery_id)
+            assert server.request_count == gallery_num and cache.hit_count == gallery_num
+            offline_cache = GalleryCache(cache_dir, offline=True)
+            offline_cache.gallery_info(1)
+            #parse済みのものが読めなければ保存した生のjsからparseし直す
+            os.remove(offline_cache._path(2, '.pickle'))
+            assert offline_cache.gallery_info(2).gallery_id == '2'
+            try:
+                offline_cache.gallery_info(gallery_num + 1)
+                raise AssertionError('offline cache must not fetch')
+            except GalleryCacheMiss:
+                pass
+            #期限切れで保存されたものは、次回ETagで再検証される
+            expires_in = -1
+            cache.gallery_info(gallery_num + 1)
+            server.add_route(f'/ltn.gold-usergeneratedcontent.net/galleries/{gallery_num + 1}.js', b'', status=304, headers={'ETag': f'"{gallery_num + 1}"'})
+            cache.gallery_info(gallery_num + 1)
+            assert cache.revalidated_count == 1
+            small_cache = GalleryCache(cache_dir, max_bytes=cache.total_bytes // 2)
+            small_cache.gallery_info(gallery_num + 2)
+            assert small_cache.total_bytes <= small_cache.max_bytes
+            #メモリ上のLRUとディスクの内容が一致し、一時ファイルが残っていない
+            assert sorted(small_cache._lru) == sorted(small_cache._cached_ids())
+            assert small_cache.total_bytes == sum(small_cache._entry_size(gallery_id) for gallery_id in small_cache._lru)
+            assert not [name for name in os.listdir(cache_dir) if name.endswith('.tmp')]
+            print(f'requests: {server.request_count}, hit: {cache.hit_count}, revalidated: {cache.revalidated_count}, cached after eviction: {len(small_cache._cached_ids())}/{gallery_num + 2}')
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,206 @@
+import json
+import time
+import queue
+import multiprocessing
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Any
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from gallery_info_from_id import GalleryInfo, parse_gallery_js, parse_expires, gallery_expire_checker, gallery_js_url
+from http_session import http_get
+
+@dataclass
+class CrawlFailure:
+    gallery_id: int
+    status: int|None
+    error: str
+
+@dataclass
+class CrawlReport:
+    """crawl_gallery_infoの結果。404・期限切れ・失敗した作品idを記録する"""
+    requested: int = 0
+    parsed: int = 0
+    not_found: list[int] = field(default_factory=list)
+    expired: list[int] = field(default_factory=list)
+    failed: list[CrawlFailure] = field(default_factory=list)
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.finished - self.started, 1e-9)
+
+    @property
+    def galleries_per_sec(self) -> float:
+        return self.parsed / self.elapsed
+
+    def summary(self) -> str:
+        return (f'{self.requested} requested, {self.parsed} parsed in {self.elapsed:.2f}s ({self.galleries_per_sec:.1f} galleries/s), '
+                f'not found: {len(self.not_found)}, expired: {len(self.expired)}, failed: {len(self.failed)}')
+
+#parseワーカー(別プロセス)で実行するのでトップレベルに置く
+def _parse_worker(js_bytes: bytes, expires_at: float|None, columnar: bool, as_json: bool) -> GalleryInfo|str:
+    gallery_info = parse_gallery_js(js_bytes, columnar)
+    if as_json:
+        return json.dumps(gallery_info.to_dict(), ensure_ascii=False)
+    gallery_info.expires_at = expires_at
+    return gallery_info
+
+def _expires_at_from_response(headers: Any) -> float|None:
+    time_str_may_be_gmt = headers.get('Expires')
+    if not time_str_may_be_gmt:
+        return None
+    try:
+        return parse_expires(time_str_may_be_gmt)
+    except (ValueError, OverflowError):
+        return None
+
+def _crawl(gallery_ids: Iterable[int], fetch_workers: int, parse_workers: int|None, max_pending: int|None, include_expired: bool, columnar: bool, as_json: bool, report: CrawlReport) -> Iterator[tuple[int, GalleryInfo|str]]:
+    parse_workers = parse_workers or multiprocessing.cpu_count()
+    max_pending = max_pending or (fetch_workers + parse_workers) * 2
+    #(作品id, parseのFuture or None, 失敗時のCrawlFailure or 'not_found'/'expired')
+    results: queue.SimpleQueue[tuple[int, Future[GalleryInfo|str]|None, CrawlFailure|str|None]] = queue.SimpleQueue()
+    report.started = time.perf_counter()
+
+    #ワーカースレッドからforkしないようspawnで起動する
+    with ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='crawl-fetch') as fetch_executor, \
+            ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')) as parse_executor:
+
+        def fetch(gallery_id: int) -> None:
+            try:
+                response = http_get(gallery_js_url(gallery_id))
+                if response.status_code == 404:
+                    results.put((gallery_id, None, 'not_found'))
+                    return
+                response.raise_for_status()
+                expires_at = _expires_at_from_response(response.headers)
+                if expires_at is not None and expires_at <= time.time() and not include_expired:
+                    results.put((gallery_id, None, 'expired'))
+                    return
+                parse_future = parse_executor.submit(_parse_worker, response.content, expires_at, columnar, as_json)
+                parse_future.add_done_callback(lambda future: results.put((gallery_id, future, None)))
+            except Exception as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                results.put((gallery_id, None, CrawlFailure(gallery_id, status, repr(e))))
+
+        #取り出されていない結果がmax_pending件になったら、消費されるまで次の作品を取得しない
+        gallery_id_iter = iter(gallery_ids)
+        pending = 0
+        def fill() -> None:
+            nonlocal pending
+            while pending < max_pending:
+                gallery_id = next(gallery_id_iter, None)
+                if gallery_id is None:
+                    return
+                report.requested += 1
+                pending += 1
+                fetch_executor.submit(fetch, gallery_id)
+
+        try:
+            fill()
+            while pending:
+                gallery_id, parse_future, failure = results.get()
+                pending -= 1
+                fill()
+                if failure == 'not_found':
+                    report.not_found.append(gallery_id)
+                elif failure == 'expired':
+                    report.expired.append(gallery_id)
+                elif isinstance(failure, CrawlFailure):
+                    report.failed.append(failure)
+                elif parse_future is not None:
+                    try:
+                        parsed = parse_future.result()
+                    except Exception as e:
+                        report.failed.append(CrawlFailure(gallery_id, None, repr(e)))
+                        continue
+                    report.parsed += 1
+                    yield gallery_id, parsed
+        finally:
+            report.finished = time.perf_counter()
+            #途中で止めた場合は未取得の作品を捨てる
+            fetch_executor.shutdown(wait=True, cancel_futures=True)
+
+#多数の作品idの作品情報を、取得はスレッド・parseは別プロセスで並列に行う
+def crawl_gallery_info(gallery_ids: Iterable[int], fetch_workers: int=16, parse_workers: int|None=None, max_pending: int|None=None, include_expired: bool=False, columnar: bool=False, report: CrawlReport|None=None) -> Iterator[GalleryInfo]:
+    """作品情報を取得できたものから順にyieldする(順序は作品idの順とは限らない)
+
+    Args:
+        gallery_ids (Iterable[int]): 作品idのリスト(rangeなど遅延評価のものでもよい)
+        fetch_workers (int): {gallery_id}.jsを取得するスレッド数 Defaults to 16.
+        parse_workers (int|None): parseするプロセス数。指定しない場合はCPUコア数 Defaults to None.
+        max_pending (int|None): 取得・parse中と、取り出されていない結果の合計の上限。指定しない場合はワーカー数の合計の2倍 Defaults to None.
+        include_expired (bool): 取得時点でExpiresを過ぎている作品もyieldする Defaults to False.
+        columnar (bool): ファイル情報をFilesTable(列ごとの表)で保持する Defaults to False.
+        report (CrawlReport|None): 404・期限切れ・失敗を記録するCrawlReport Defaults to None.
+
+    Yields:
+        GalleryInfo: 作品情報(is_expireも設定済み)
+    """
+    report = report if report is not None else CrawlReport()
+    for gallery_id, gallery_info in _crawl(gallery_ids, fetch_workers, parse_workers, max_pending, include_expired, columnar, False, report):
+        gallery_info.is_expire = gallery_expire_checker(gallery_id, gallery_info.expires_at)
+        yield gallery_info
+
+#作品情報をJSON Lines(1行1作品)でファイルに書き出す
+def crawl_gallery_info_to_jsonl(gallery_ids: Iterable[int], jsonl_path: str, fetch_workers: int=16, parse_workers: int|None=None, max_pending: int|None=None, include_expired: bool=False) -> CrawlReport:
+    """crawl_gallery_infoと同じだが、parseワーカーがjsonの1行まで作成してファイルに追記する
+
+    Returns:
+        CrawlReport: 404・期限切れ・失敗した作品idとスループット
+    """
+    report = CrawlReport()
+    with open(jsonl_path, 'a', encoding='utf-8') as f:
+        for _, json_line in _crawl(gallery_ids, fetch_workers, parse_workers, max_pending, include_expired, False, True, report):
+            f.write(f'{json_line}\n')
+    return report
+
+def bench(gallery_num: int=1000, file_num: int=40, fetch_workers: int=16, latency: float=0.02) -> None:
+    """スタブサーバーが返す合成{gallery_id}.jsで、作品ごとのget_gallery_infoとcrawl_gallery_info(parseプロセス数別)を比較する"""
+    import os
+    import email.utils
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import synthetic_gallery_js
+    from hitomi_util import get_gallery_info
+
+    #50件に1件は404、77件に1件は期限切れのExpiresを返す
+    gallery_js = {gallery_id: synthetic_gallery_js(gallery_id, file_num).encode() for gallery_id in range(1, gallery_num + 1)}
+    def fallback(path: str) -> tuple[int, bytes, dict[str, str]]|None:
+        gallery_id = int(os.path.basename(path).split('.')[0])
+        if gallery_id % 50 == 0 or gallery_id not in gallery_js:
+            return None
+        expires_in = -60 if gallery_id % 77 == 0 else 3600
+        return (200, gallery_js[gallery_id], {'Expires': email.utils.formatdate(time.time() + expires_in, usegmt=True)})
+
+    gallery_ids = range(1, gallery_num + 1)
+    with StubServer(fallback=fallback, latency=latency) as server:
+        http_session.configure_transport(url_rewriter=server.rewrite_url, pool_maxsize=fetch_workers)
+        try:
+            start = time.perf_counter()
+            serial_num = 0
+            for gallery_id in gallery_ids:
+                try:
+                    get_gallery_info(gallery_id)
+                    serial_num += 1
+                except Exception:
+                    pass
+            elapsed = time.perf_counter() - start
+            print(f'get_gallery_info (serial): {serial_num} galleries in {elapsed:.2f}s ({serial_num / elapsed:.1f} galleries/s)')
+            for parse_workers in sorted({1, 2, os.cpu_count() or 1}):
+                report = CrawlReport()
+                for _ in crawl_gallery_info(gallery_ids, fetch_workers=fetch_workers, parse_workers=parse_workers, report=report):
+                    pass
+                print(f'crawl_gallery_info (parse_workers={parse_workers}): {report.summary()}')
+            with tempfile.TemporaryDirectory() as jsonl_dir:
+                jsonl_path = os.path.join(jsonl_dir, 'galleries.jsonl')
+                report = crawl_gallery_info_to_jsonl(gallery_ids, jsonl_path, fetch_workers=fetch_workers)
+                with open(jsonl_path, 'r', encoding='utf-8') as f:
+                    assert sum(1 for _ in f) == report.parsed
+                print(f'crawl_gallery_info_to_jsonl: {report.summary()}')
+            assert len(report.not_found) == gallery_num // 50 and report.expired
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,369 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from typing import Any, Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from gallery_info_from_id import GalleryInfo
+
+class QuerySyntaxError(Exception):
+    def __init__(self, query: str, reason: str) -> None:
+        super().__init__(self)
+        self.query = query
+        self.reason = reason
+
+    def __str__(self):
+        return f'Invalid query {self.query!r}: {self.reason}'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS galleries (gallery_id INTEGER PRIMARY KEY, title TEXT, japanese_title TEXT, gallery_dir TEXT);
+CREATE TABLE IF NOT EXISTS terms (term_id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE, name TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS terms_name ON terms (name);
+CREATE TABLE IF NOT EXISTS postings (term_id INTEGER NOT NULL, gallery_id INTEGER NOT NULL, PRIMARY KEY (term_id, gallery_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_gallery_id ON postings (gallery_id);
+'''
+
+#検索語の表記をそろえる(hitomiの検索と同じく小文字で空白は_)
+def normalize_term(term: str) -> str:
+    return term.strip().lower().replace(' ', '_')
+
+def _terms(language: str, type: str, artists: Iterable[str], groups: Iterable[str], parodies: Iterable[str], characters: Iterable[str], tags: Iterable[tuple[str, bool|None, bool|None]]) -> set[str]:
+    terms: set[str] = set()
+    if language:
+        terms.add(f'language:{normalize_term(language)}')
+    if type:
+        terms.add(f'type:{normalize_term(type)}')
+    for namespace, names in (('artist', artists), ('group', groups), ('series', parodies), ('character', characters)):
+        terms.update(f'{namespace}:{normalize_term(name)}' for name in names if name)
+    for tag, male, female in tags:
+        if not tag:
+            continue
+        #female/maleのどちらでもないタグはtag:
+        namespace = 'female' if female else 'male' if male else 'tag'
+        terms.add(f'{namespace}:{normalize_term(tag)}')
+    return terms
+
+#GalleryInfoから索引に登録する語(artist:x, female:x, language:x など)を作る
+def gallery_terms(gallery_info: GalleryInfo) -> set[str]:
+    return _terms(gallery_info.language, gallery_info.type,
+                  (artist.artist for artist in gallery_info.artists), (group.group for group in gallery_info.groups),
+                  (parody.parody for parody in gallery_info.parodies), (character.character for character in gallery_info.characters),
+                  ((tag.tag, tag.male, tag.female) for tag in gallery_info.tags))
+
+#GalleryInfo.to_jsonで保存したjsonから同じ語を作る(再構築ワーカーで実行するのでトップレベルに置く)
+def _index_entry_from_json(json_path: str) -> tuple[int, str, str, str, set[str]]|None:
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            gallery_info_dict: dict[str, Any] = json.load(f)
+        terms = _terms(gallery_info_dict.get('language') or '', gallery_info_dict.get('type') or '',
+                       (artist['artist'] for artist in gallery_info_dict.get('artists') or ()), (group['group'] for group in gallery_info_dict.get('groups') or ()),
+                       (parody['parody'] for parody in gallery_info_dict.get('parodies') or ()), (character['character'] for character in gallery_info_dict.get('characters') or ()),
+                       ((tag.get('tag'), tag.get('male'), tag.get('female')) for tag in gallery_info_dict.get('tags') or ()))
+        return (int(gallery_info_dict['gallery_id']), gallery_info_dict.get('title') or '', gallery_info_dict.get('japanese_title') or '', os.path.dirname(json_path), terms)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+#保存先ディレクトリから作品フォルダ({gallery_id:08}_タイトル)の{gallery_id:08}.jsonを列挙する
+def _gallery_json_paths(save_dir: str) -> list[str]:
+    json_paths: list[str] = []
+    with os.scandir(save_dir) as entries:
+        for entry in entries:
+            gallery_id_str = entry.name[:8]
+            if entry.name[8:9] == '_' and gallery_id_str.isdigit() and entry.is_dir():
+                json_path = os.path.join(entry.path, f'{gallery_id_str}.json')
+                if os.path.isfile(json_path):
+                    json_paths.append(json_path)
+    return json_paths
+
+_TOKEN_PATTERN = re.compile(r'\(|\)|[^\s()"]*"[^"]*"|[^\s()]+')
+
+#検索式の構文木 ('term', 'female:paizuri') / ('name', 'paizuri') / ('and', [...]) / ('or', [...]) / ('not', node)
+QueryNode = tuple[str, Any]
+
+class _QueryParser():
+    """
+    検索式を構文木に変換する。
+    語の並びはAND、OR、NOT(または先頭の-)、括弧が使える。名前空間のない語はすべての名前空間から探す
+    """
+    def __init__(self, query: str) -> None:
+        self.query = query
+        self.tokens = _TOKEN_PATTERN.findall(query)
+        self.position = 0
+
+    def parse(self) -> QueryNode:
+        if not self.tokens:
+            raise QuerySyntaxError(self.query, 'empty query')
+        node = self._or()
+        if self.position < len(self.tokens):
+            raise QuerySyntaxError(self.query, f'unexpected {self.tokens[self.position]!r}')
+        return node
+
+    def _peek(self) -> str|None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _or(self) -> QueryNode:
+        operands = [self._and()]
+        while self._peek() == 'OR':
+            self.position += 1
+            operands.append(self._and())
+        return ('or', operands) if len(operands) > 1 else operands[0]
+
+    def _and(self) -> QueryNode:
+        operands = [self._not()]
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND':
+                self.position += 1
+            operands.append(self._not())
+        return ('and', operands) if len(operands) > 1 else operands[0]
+
+    def _not(self) -> QueryNode:
+        token = self._peek()
+        if token == 'NOT':
+            self.position += 1
+            return ('not', self._not())
+        if token is not None and token.startswith('-') and len(token) > 1:
+            self.tokens[self.position] = token[1:]
+            return ('not', self._atom())
+        return self._atom()
+
+    def _atom(self) -> QueryNode:
+        token = self._peek()
+        if token is None:
+            raise QuerySyntaxError(self.query, 'unexpected end of query')
+        self.position += 1
+        if token == '(':
+            node = self._or()
+            if self._peek() != ')':
+                raise QuerySyntaxError(self.query, "missing ')'")
+            self.position += 1
+            return node
+        if token in (')', 'AND', 'OR'):
+            raise QuerySyntaxError(self.query, f'unexpected {token!r}')
+        term = normalize_term(token.replace('"', ''))
+        return ('term', term) if ':' in term else ('name', term)
+
+class _QueryCompiler():
+    """
+    構文木をSQLに変換する。
+    作品ごとの条件(postingsの主キーを引くEXISTS)と、候補を絞る起点(件数が最も少ない語のpostings)を組み合わせ、
+    NOTだけの式を除いて全作品を走査しない
+    """
+    def __init__(self, term_frequency: Callable[[QueryNode], int]) -> None:
+        self.term_frequency = term_frequency
+
+    def compile(self, node: QueryNode) -> tuple[str, list[str]]:
+        if node[0] in ('term', 'name'):
+            driver_sql, driver_params, _ = self._driver(node, estimate=False)
+            return f'SELECT DISTINCT gallery_id FROM ({driver_sql})', driver_params
+        driver = self._driver(node)
+        condition, condition_params = self._condition(node)
+        if driver is None:
+            return f'SELECT gallery_id FROM galleries AS g WHERE {condition}', condition_params
+        driver_sql, driver_params, _ = driver
+        return f'SELECT DISTINCT gallery_id FROM ({driver_sql}) AS g WHERE {condition}', driver_params + condition_params
+
+    def _condition(self, node: QueryNode) -> tuple[str, list[str]]:
+        kind, value = node
+        if kind == 'term':
+            return 'EXISTS (SELECT 1 FROM postings WHERE term_id = (SELECT term_id FROM terms WHERE term = ?) AND gallery_id = g.gallery_id)', [value]
+        if kind == 'name':
+            return 'EXISTS (SELECT 1 FROM postings WHERE term_id IN (SELECT term_id FROM terms WHERE name = ?) AND gallery_id = g.gallery_id)', [value]
+        if kind == 'not':
+            condition, params = self._condition(value)
+            return f'NOT {condition}', params
+        conditions = [self._condition(operand) for operand in value]
+        joined = f' {kind.upper()} '.join(condition for condition, _ in conditions)
+        return f'({joined})', [param for _, params in conditions for param in params]
+
+    #候補となる作品idのSQLと推定件数(NOTのように候補を絞れなければNone)
+    def _driver(self, node: QueryNode, estimate: bool=True) -> tuple[str, list[str], int]|None:
+        kind, value = node
+        if kind == 'term':
+            return 'SELECT gallery_id FROM postings WHERE term_id = (SELECT term_id FROM terms WHERE term = ?)', [value], self.term_frequency(node) if estimate else 0
+        if kind == 'name':
+            return 'SELECT gallery_id FROM postings WHERE term_id IN (SELECT term_id FROM terms WHERE name = ?)', [value], self.term_frequency(node) if estimate else 0
+        if kind == 'not':
+            return None
+        drivers = [self._driver(operand) for operand in value]
+        if kind == 'and':
+            candidates = [driver for driver in drivers if driver is not None]
+            return min(candidates, key=lambda driver: driver[2]) if candidates else None
+        if any(driver is None for driver in drivers):
+            return None
+        return (' UNION ALL '.join(driver_sql for driver_sql, _, _ in drivers), [param for _, params, _ in drivers for param in params], sum(frequency for _, _, frequency in drivers))
+
+class GalleryIndex():
+    """
+    保存した作品の作品情報をSQLiteの転置索引(語 -> 作品id)で検索する。
+    save_all_image_data_from_idなどにgallery_indexとして渡すと、作品フォルダを作成するたびに登録される
+    """
+    def __init__(self, index_path: str) -> None:
+        """
+        Args:
+            index_path (str): SQLiteのファイル(保存先ディレクトリの gallery_index.sqlite3 など)
+        """
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        #ダウンロードのワーカースレッドからも登録できるよう、接続はロックで保護して共有する
+        self._connection = sqlite3.connect(index_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+
+    @staticmethod
+    def path_from_save_dir(save_dir: str) -> str:
+        return os.path.join(save_dir, 'gallery_index.sqlite3')
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> 'GalleryIndex':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _add(self, gallery_id: int, title: str, japanese_title: str, gallery_dir: str|None, terms: set[str]) -> None:
+        cursor = self._connection.cursor()
+        cursor.execute('DELETE FROM postings WHERE gallery_id = ?', (gallery_id,))
+        cursor.execute('INSERT OR REPLACE INTO galleries (gallery_id, title, japanese_title, gallery_dir) VALUES (?, ?, ?, ?)', (gallery_id, title, japanese_title, gallery_dir))
+        cursor.executemany('INSERT OR IGNORE INTO terms (term, name) VALUES (?, ?)', ((term, term.partition(':')[2]) for term in terms))
+        cursor.executemany('INSERT OR IGNORE INTO postings (term_id, gallery_id) SELECT term_id, ? FROM terms WHERE term = ?', ((gallery_id, term) for term in terms))
+
+    def add(self, gallery_id: int, gallery_info: GalleryInfo, gallery_dir: str|None=None) -> None:
+        """作品を登録する(登録済みなら置き換える)"""
+        with self._lock, self._connection:
+            self._add(int(gallery_id), gallery_info.title, gallery_info.japanese_title, gallery_dir, gallery_terms(gallery_info))
+
+    def remove(self, gallery_id: int) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM postings WHERE gallery_id = ?', (int(gallery_id),))
+            self._connection.execute('DELETE FROM galleries WHERE gallery_id = ?', (int(gallery_id),))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM galleries').fetchone()[0]
+
+    def query(self, query: str) -> list[int]:
+        """検索式に一致する作品idを昇順で返す
+
+        Args:
+            query (str): 'female:paizuri AND language:japanese'、'artist:"kizuka kazuki" OR group:ikkizuka'、'maid -male:glasses' など
+
+        Raises:
+            QuerySyntaxError: 検索式の構文が正しくない
+
+        Returns:
+            list[int]: 作品id
+        """
+        node = _QueryParser(query).parse()
+        with self._lock:
+            sql, params = _QueryCompiler(self._term_frequency).compile(node)
+            return [row[0] for row in self._connection.execute(f'{sql} ORDER BY gallery_id', params)]
+
+    def _term_frequency(self, node: QueryNode) -> int:
+        kind, value = node
+        column = 'term' if kind == 'term' else 'name'
+        return self._connection.execute(f'SELECT COUNT(*) FROM postings WHERE term_id IN (SELECT term_id FROM terms WHERE {column} = ?)', (value,)).fetchone()[0]
+
+    def gallery_dir(self, gallery_id: int) -> str|None:
+        with self._lock:
+            row = self._connection.execute('SELECT gallery_dir FROM galleries WHERE gallery_id = ?', (int(gallery_id),)).fetchone()
+        return row[0] if row else None
+
+    def rebuild(self, save_dir: str, max_worker: int|None=None) -> int:
+        """保存先ディレクトリの作品フォルダを並列に読み込み、索引を作り直す
+
+        Args:
+            save_dir (str): 保存先ディレクトリ
+            max_worker (int|None): jsonを読み込むプロセス数。指定しない場合はCPUコア数 Defaults to None.
+
+        Returns:
+            int: 登録した作品数
+        """
+        json_paths = _gallery_json_paths(save_dir)
+        gallery_num = 0
+        with ProcessPoolExecutor(max_workers=max_worker) as executor, self._lock, self._connection:
+            self._connection.execute('DELETE FROM postings')
+            self._connection.execute('DELETE FROM galleries')
+            self._connection.execute('DELETE FROM terms')
+            for entry in executor.map(_index_entry_from_json, json_paths, chunksize=256):
+                if entry is not None:
+                    self._add(*entry)
+                    gallery_num += 1
+        return gallery_num
+
+def test(gallery_num: int=60) -> None:
+    """合成した作品を保存した作品フォルダから索引を再構築し、検索結果を全件走査の結果と比較する"""
+    import tempfile
+    from gallery_info_from_id import synthetic_gallery_js, parse_gallery_js
+    from hitomi_util import prepare_save_dir
+
+    gallery_infos = {gallery_id: parse_gallery_js(synthetic_gallery_js(gallery_id, 1)) for gallery_id in range(1, gallery_num + 1)}
+    with tempfile.TemporaryDirectory() as save_dir:
+        with GalleryIndex(GalleryIndex.path_from_save_dir(save_dir)) as index:
+            for gallery_id, gallery_info in gallery_infos.items():
+                prepare_save_dir(gallery_id, gallery_info, save_dir, gallery_index=index)
+            incremental = {query: index.query(query) for query in ('female:paizuri AND language:japanese', 'maid OR (female:glasses -female:paizuri)', 'NOT artist:artist1')}
+            assert index.rebuild(save_dir) == gallery_num
+            for query, gallery_ids in incremental.items():
+                assert index.query(query) == gallery_ids
+            terms = {gallery_id: gallery_terms(gallery_info) for gallery_id, gallery_info in gallery_infos.items()}
+            assert incremental['female:paizuri AND language:japanese'] == [gallery_id for gallery_id, t in terms.items() if 'female:paizuri' in t and 'language:japanese' in t]
+            assert incremental['maid OR (female:glasses -female:paizuri)'] == [gallery_id for gallery_id, t in terms.items() if 'female:maid' in t or ('female:glasses' in t and 'female:paizuri' not in t)]
+            assert incremental['NOT artist:artist1'] == [gallery_id for gallery_id, t in terms.items() if 'artist:artist1' not in t]
+            for query in ('', 'female:paizuri AND', '(maid', 'OR maid'):
+                try:
+                    index.query(query)
+                    raise AssertionError(f'{query!r} must be rejected')
+                except QuerySyntaxError:
+                    pass
+    print(f'{gallery_num} galleries: {", ".join(f"{query!r} -> {len(gallery_ids)}" for query, gallery_ids in incremental.items())}')
+
+def bench(gallery_num: int=100000, repeat: int=20) -> None:
+    """合成した10万作品の索引で、検索1回あたりの時間を計測する"""
+    import time
+    import random
+    import tempfile
+
+    rng = random.Random(0)
+    tags = [f'tag{i}' for i in range(300)]
+    with tempfile.TemporaryDirectory() as index_dir, GalleryIndex(os.path.join(index_dir, 'gallery_index.sqlite3')) as index:
+        start = time.perf_counter()
+        with index._connection:
+            for gallery_id in range(1, gallery_num + 1):
+                terms = {f'language:{rng.choice(("japanese", "english", "chinese"))}', f'artist:artist{rng.randrange(5000)}', f'type:{rng.choice(("doujinshi", "manga"))}'}
+                terms.update(f'{rng.choice(("female", "male", "tag"))}:{tag}' for tag in rng.sample(tags, 8))
+                index._add(gallery_id, f'Synthetic Gallery {gallery_id}', '', None, terms)
+        print(f'indexed {gallery_num} galleries in {time.perf_counter() - start:.2f}s')
+        for query in ('female:tag1 AND language:japanese', 'female:tag1 female:tag2 -male:tag3', '(artist:artist42 OR artist:artist43) AND NOT language:english', 'tag7'):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                gallery_ids = index.query(query)
+            print(f'{query!r}: {len(gallery_ids)} galleries in {(time.perf_counter() - start) / repeat * 1000:.1f}ms')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='保存した作品の作品情報の索引')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = subparsers.add_parser('rebuild', help='作品フォルダを並列に読み込んで索引を作り直す')
+    rebuild_parser.add_argument('save_dir')
+    rebuild_parser.add_argument('--workers', type=int, default=None)
+    query_parser = subparsers.add_parser('query', help='検索式に一致する作品idと作品フォルダを表示する')
+    query_parser.add_argument('save_dir')
+    query_parser.add_argument('query')
+    subparsers.add_parser('test')
+    subparsers.add_parser('bench')
+    args = parser.parse_args()
+    if args.command == 'rebuild':
+        with GalleryIndex(GalleryIndex.path_from_save_dir(args.save_dir)) as index:
+            print(f'indexed {index.rebuild(args.save_dir, args.workers)} galleries')
+    elif args.command == 'query':
+        with GalleryIndex(GalleryIndex.path_from_save_dir(args.save_dir)) as index:
+            for gallery_id in index.query(args.query):
+                print(gallery_id, index.gallery_dir(gallery_id))
+    elif args.command == 'test':
+        test()
+    else:
+        bench()
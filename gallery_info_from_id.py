@@ -1,10 +1,18 @@
 import json
+import random
 import warnings
 import requests
+import metrics
 from dateutil.parser import parse
 from dateutil.tz import tzutc
+from array import array
 from dataclasses import dataclass, asdict
-from typing import Callable, Any
+from typing import Callable, Any, Iterator, Sequence, overload
+from http_session import http_get
+try:
+    import orjson
+except ImportError: # orjsonは高速parserでのみ使う(なければ標準のjson)
+    orjson = None
 
 class GalleryJsIsExpire(Exception):
     def __init__(self, gallery_id: int) -> None:
@@ -14,27 +22,27 @@ class GalleryJsIsExpire(Exception):
     def __str__(self):
         return f'{self.gallery_id}.js is Expired'
 
-@dataclass
+@dataclass(slots=True)
 class ArtistInfo:
     artist: str
     url: str
 
-@dataclass
+@dataclass(slots=True)
 class GroupInfo:
     group: str
     url: str
 
-@dataclass
+@dataclass(slots=True)
 class ParodyInfo:
     parody: str
     url: str
 
-@dataclass
+@dataclass(slots=True)
 class CharacterInfo:
     character: str
     url: str
 
-@dataclass
+@dataclass(slots=True)
 class TagInfo:
     tag: str
     url: str
@@ -42,6 +50,8 @@ class TagInfo:
     female: bool|None = None
 
     def __init__(self, **kwargs: str|None):
+        self.male = None
+        self.female = None
         for key, value in kwargs.items():
             try:
                 if value is None:
@@ -59,10 +69,10 @@ class TagInfo:
                         case _:
                             warnings.warn(f'Ignored tag: {str({key: value})}')
             except TypeError as e:
-                print(f'Failed to init TagInfo\nInput: {kwargs}\nLast validated data: {str({key: value})}')
+                metrics.message('error', f'Failed to init TagInfo\nInput: {kwargs}\nLast validated data: {str({key: value})}')
                 raise e
 
-@dataclass
+@dataclass(slots=True)
 class FileInfo:
     name: str
     hash: str
@@ -72,6 +82,9 @@ class FileInfo:
     has_webp: bool = False
     has_jxl: bool = False
     def __init__(self, **kwargs: str|int|None):
+        self.has_avif = False
+        self.has_webp = False
+        self.has_jxl = False
         for key, value in kwargs.items():
             try:
                 if value is None:
@@ -99,10 +112,109 @@ class FileInfo:
                         case _:
                             warnings.warn(f'Ignored file_info: {str({key: value})}')
             except TypeError as e:
-                print(f'Failed to init FileInfo\nInput: {kwargs}\nLast validated data: {str({key: value})}')
+                metrics.message('error', f'Failed to init FileInfo\nInput: {kwargs}\nLast validated data: {str({key: value})}')
                 raise e
+
+    #キーの判定を行わずに値から直接作成する
+    @classmethod
+    def from_values(cls, name: str, hash: str, width: int, height: int, has_avif: bool=False, has_webp: bool=False, has_jxl: bool=False) -> 'FileInfo':
+        file_info = cls.__new__(cls)
+        file_info.name = name
+        file_info.hash = hash
+        file_info.width = width
+        file_info.height = height
+        file_info.has_avif = has_avif
+        file_info.has_webp = has_webp
+        file_info.has_jxl = has_jxl
+        return file_info
+
+_TAG_KEYS = frozenset(('tag', 'url', 'male', 'female'))
+_FILE_KEYS = frozenset(('name', 'hash', 'width', 'height', 'hasavif', 'haswebp', 'hasjxl'))
+#警告済みの未知のキー(種類, キー名)。大量にparseしても同じキーは1回だけ警告する
+_warned_keys: set[tuple[str, str]] = set()
+
+def _warn_unknown_keys(kind: str, item: dict[str, Any], known_keys: frozenset[str]) -> None:
+    for key, value in item.items():
+        if value is not None and key not in known_keys and (kind, key) not in _warned_keys:
+            _warned_keys.add((kind, key))
+            warnings.warn(f'Ignored {kind}: {str({key: value})} (further {key!r} keys are ignored silently)')
+
+_FLAG_AVIF = 1
+_FLAG_WEBP = 2
+_FLAG_JXL = 4
+
+#array('I')に格納できる幅・高さか(boolはintだが表には格納せず、FileInfoのリストで保持する)
+def _is_uint32(value: object) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 2**32
+
+class FilesTable(Sequence[FileInfo]):
+    """
+    作品のファイル情報を列ごとにまとめて保持する。
+    hashは32バイトずつ連結したbytes、width/heightはarray('I')、has_avif/has_webp/has_jxlはビットフラグのarray('B')。
+    要素にアクセスするとその都度FileInfoを作成して返す(返したFileInfoを変更しても表には反映されない)
+    """
+    __slots__ = ('names', 'hashes', 'widths', 'heights', 'flags')
+
+    def __init__(self, names: list[str], hashes: bytes, widths: array, heights: array, flags: array) -> None:
+        self.names = names
+        self.hashes = hashes
+        self.widths = widths
+        self.heights = heights
+        self.flags = flags
+
+    @classmethod
+    def from_files(cls, files: list[dict[str, str|int|bool]]) -> 'FilesTable':
+        """{gallery_id}.jsのfilesから作成する
+
+        Raises:
+            ValueError: 表に格納できないファイル情報(64桁の小文字16進でないhash、widthの欠落、32bit符号なし整数の範囲外のwidth・heightなど)
+        """
+        names: list[str] = []
+        hashes = bytearray()
+        widths = array('I')
+        heights = array('I')
+        flags = array('B')
+        for file in files:
+            name = file.get('name')
+            hash = file.get('hash')
+            width = file.get('width')
+            height = file.get('height')
+            if not isinstance(name, str) or not isinstance(hash, str) or len(hash) != 64 or hash != hash.lower() or not _is_uint32(width) or not _is_uint32(height):
+                raise ValueError(f'Cannot store file_info in FilesTable: {file}')
+            names.append(name)
+            hashes += bytes.fromhex(hash)
+            widths.append(width)
+            heights.append(height)
+            flags.append((_FLAG_AVIF if file.get('hasavif') == 1 else 0) | (_FLAG_WEBP if file.get('haswebp') == 1 else 0) | (_FLAG_JXL if file.get('hasjxl') == 1 else 0))
+            if not file.keys() <= _FILE_KEYS:
+                _warn_unknown_keys('file_info', file, _FILE_KEYS)
+        return cls(names, bytes(hashes), widths, heights, flags)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _file_info(self, index: int) -> FileInfo:
+        flag = self.flags[index]
+        return FileInfo.from_values(self.names[index], self.hashes[index*32:index*32+32].hex(), self.widths[index], self.heights[index], bool(flag & _FLAG_AVIF), bool(flag & _FLAG_WEBP), bool(flag & _FLAG_JXL))
+
+    @overload
+    def __getitem__(self, index: int) -> FileInfo: ...
+    @overload
+    def __getitem__(self, index: slice) -> list[FileInfo]: ...
+    def __getitem__(self, index: int|slice) -> FileInfo|list[FileInfo]:
+        if isinstance(index, slice):
+            return [self._file_info(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('FilesTable index out of range')
+        return self._file_info(index)
+
+    def __iter__(self) -> Iterator[FileInfo]:
+        for index in range(len(self.names)):
+            yield self._file_info(index)
         
-@dataclass
+@dataclass(slots=True)
 class GalleryInfo:
     gallery_id: int
     title: str
@@ -115,11 +227,12 @@ class GalleryInfo:
     parodies: list[ParodyInfo]
     characters: list[CharacterInfo]
     tags: list[TagInfo]
-    files_info: list[FileInfo]
+    files_info: list[FileInfo]|FilesTable
     related: list[int]
     is_expire: Callable[[float], None]|None
+    expires_at: float|None
     
-    def __init__(self, id: int, title: str, japanese_title: str, artists: list[dict[str, str]], groups: list[dict[str, str]], type: str, language: str, language_localname: str, parodys: list[dict[str, str]], characters: list[dict[str, str]], tags: list[dict[str, str]], files: list[dict[str, str|int|bool]], related: list[int], is_expire: Callable[[float], None]|None=None, **kwargs: Any):
+    def __init__(self, id: int, title: str, japanese_title: str, artists: list[dict[str, str]], groups: list[dict[str, str]], type: str, language: str, language_localname: str, parodys: list[dict[str, str]], characters: list[dict[str, str]], tags: list[dict[str, str]], files: list[dict[str, str|int|bool]], related: list[int], is_expire: Callable[[float], None]|None=None, expires_at: float|None=None, columnar: bool=False, **kwargs: Any):
         self.gallery_id = id
         self.title = title or ''
         self.japanese_title = japanese_title or ''
@@ -131,71 +244,265 @@ class GalleryInfo:
         self.parodies = [ParodyInfo(**parody) for parody in parodys] if parodys else []
         self.characters = [CharacterInfo(**character) for character in characters] if characters else []
         self.tags = [TagInfo(**tag) for tag in tags] if tags else []
-        self.files_info = [FileInfo(**file) for file in files] if files else []
+        self.files_info = []
+        if files and columnar:
+            #大量の作品情報を保持する場合は列ごとの表にする(格納できなければ従来のリスト)
+            try:
+                self.files_info = FilesTable.from_files(files)
+            except ValueError:
+                pass
+        if files and not self.files_info:
+            self.files_info = [FileInfo(**file) for file in files]
         self.related = related or []
         self.is_expire = is_expire
+        self.expires_at = expires_at
+    
+    #期限(unix時間)との比較のみ。Expiresヘッダのparseは取得時に一度だけ行う
+    def is_expired(self, current_unix_time: float) -> bool:
+        return self.expires_at is not None and current_unix_time >= self.expires_at
         
-    def to_json(self) -> str:
+    def to_dict(self) -> dict[str, Any]:
         gallery_info_dict = asdict(self)
         gallery_info_dict['is_expire'] = None
-        return json.dumps(gallery_info_dict, ensure_ascii=False, indent=4)
+        del gallery_info_dict['expires_at']
+        if isinstance(self.files_info, FilesTable):
+            gallery_info_dict['files_info'] = [asdict(file_info) for file_info in self.files_info]
+        return gallery_info_dict
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=4)
 
 #作品情報が記述された生のjsを取得してGalleryInfoにパース(is_expireはここでは定義しない)
-def extract_gallery_info_from_gallery_js(js_text: str):
+def extract_gallery_info_from_gallery_js(js_text: str, columnar: bool=False):
     json_string = js_text.replace('var galleryinfo = ', '').strip("'")
     gallery_info_json = json.loads(json_string)
-    gallery_info = GalleryInfo(**gallery_info_json)
+    gallery_info = GalleryInfo(**gallery_info_json, columnar=columnar)
+    return gallery_info
+
+def _load_gallery_json(js_text: str|bytes) -> dict[str, Any]:
+    #'var galleryinfo = 'を除くためのコピーをせず、最初の'{'から読む(bytesならorjsonでもコピーしない)
+    if isinstance(js_text, str):
+        start = js_text.find('{')
+        if orjson is not None:
+            #orjsonは位置を指定して読めないので、strの場合はjsonの部分をスライスしたコピーを1回作る
+            return orjson.loads(js_text[start:js_text.rindex('}') + 1])
+        return _json_decoder.raw_decode(js_text, start)[0]
+    start = js_text.find(b'{')
+    if orjson is not None:
+        return orjson.loads(memoryview(js_text)[start:js_text.rindex(b'}') + 1])
+    return _json_decoder.raw_decode(js_text.decode('utf-8'), start)[0]
+
+_json_decoder = json.JSONDecoder()
+
+def _tag_info(tag: dict[str, str|None]) -> TagInfo:
+    if not tag.keys() <= _TAG_KEYS:
+        _warn_unknown_keys('tag', tag, _TAG_KEYS)
+    tag_info = TagInfo.__new__(TagInfo)
+    tag_info.tag = tag.get('tag')
+    tag_info.url = tag.get('url')
+    male = tag.get('male')
+    female = tag.get('female')
+    tag_info.male = None if male is None else male == '1'
+    tag_info.female = None if female is None else female == '1'
+    return tag_info
+
+def _files_info(files: list[dict[str, str|int|None]]) -> list[FileInfo]:
+    new = FileInfo.__new__
+    files_info: list[FileInfo] = []
+    append = files_info.append
+    for file in files:
+        if not file.keys() <= _FILE_KEYS:
+            _warn_unknown_keys('file_info', file, _FILE_KEYS)
+        get = file.get
+        file_info = new(FileInfo)
+        file_info.name = get('name')
+        file_info.hash = get('hash')
+        file_info.width = get('width')
+        file_info.height = get('height')
+        file_info.has_avif = get('hasavif') == 1
+        file_info.has_webp = get('haswebp') == 1
+        file_info.has_jxl = get('hasjxl') == 1
+        append(file_info)
+    return files_info
+
+#高速版のparser。bytesなら生のjsのコピーを作らず(orjsonがあれば使う)、キーの判定を省いてdataclassを直接作る
+def parse_gallery_js(js_text: str|bytes, columnar: bool=False) -> GalleryInfo:
+    """{gallery_id}.jsをGalleryInfoにparseする(extract_gallery_info_from_gallery_jsの高速版)
+    未知のキーはキー名ごとに1回だけ警告する
+
+    Args:
+        js_text (str|bytes): 生のjs(response.contentをそのまま渡せる)。コピーせずにparseするのはbytesの場合だけで、strをorjsonで読む場合はjsonの部分を1回コピーする
+        columnar (bool): ファイル情報をFilesTable(列ごとの表)で保持する Defaults to False.
+
+    Returns:
+        GalleryInfo: 作品情報をまとめたdataclass(is_expire, expires_atは未設定)
+    """
+    gallery_info_json = _load_gallery_json(js_text)
+    get = gallery_info_json.get
+    gallery_info = GalleryInfo.__new__(GalleryInfo)
+    gallery_info.gallery_id = get('id')
+    gallery_info.title = get('title') or ''
+    gallery_info.japanese_title = get('japanese_title') or ''
+    gallery_info.artists = [ArtistInfo(artist.get('artist'), artist.get('url')) for artist in get('artists') or ()]
+    gallery_info.groups = [GroupInfo(group.get('group'), group.get('url')) for group in get('groups') or ()]
+    gallery_info.type = get('type') or ''
+    gallery_info.language = get('language') or ''
+    gallery_info.language_local_name = get('language_localname') or ''
+    gallery_info.parodies = [ParodyInfo(parody.get('parody'), parody.get('url')) for parody in get('parodys') or ()]
+    gallery_info.characters = [CharacterInfo(character.get('character'), character.get('url')) for character in get('characters') or ()]
+    gallery_info.tags = [_tag_info(tag) for tag in get('tags') or ()]
+    files = get('files') or ()
+    gallery_info.files_info = []
+    if files and columnar:
+        try:
+            gallery_info.files_info = FilesTable.from_files(files)
+        except ValueError:
+            pass
+    if files and not gallery_info.files_info:
+        gallery_info.files_info = _files_info(files)
+    gallery_info.related = get('related') or []
+    gallery_info.is_expire = None
+    gallery_info.expires_at = None
     return gallery_info
 
+#ExpiresヘッダをUTCのunix時間に変換
+def parse_expires(time_str_may_be_gmt: str) -> float:
+    parsed_datetime = parse(time_str_may_be_gmt)
+    utc_datetime = parsed_datetime.astimezone(tzutc())
+    return utc_datetime.timestamp()
+
+#期限切れならGalleryJsIsExpireをraiseする関数(responseを保持しないようunix時間だけを閉じ込める)
+def gallery_expire_checker(gallery_id: int, expires_at: float|None) -> Callable[[float], None]:
+    def is_expire(current_unix_time: float) -> None:
+        if expires_at is not None and current_unix_time >= expires_at:
+            raise GalleryJsIsExpire(gallery_id=gallery_id)
+    return is_expire
+
+def gallery_js_url(gallery_id: int) -> str:
+    return f"https://ltn.gold-usergeneratedcontent.net/galleries/{int(gallery_id)}.js"
+
 #作品idから作品情報を取得(is_expireを設定)
-def gallery_info_from_id(gallery_id: int, test_js_text: str|None=None) -> GalleryInfo:
+def gallery_info_from_id(gallery_id: int, test_js_text: str|None=None, columnar: bool=False) -> GalleryInfo:
     """作品idから作品情報を取得する
 
     Args:
         gallery_id (int): 作品id
         test_js_text (str | None, optional): 特定のjsを文字列として渡しテストを行う. Defaults to None.
+        columnar (bool): ファイル情報をFilesTable(列ごとの表)で保持する. Defaults to False.
 
     Raises:
         e: 作品情報の取得に失敗
-        e: gg.jsから期限切れとなるタイムスタンプのparseに失敗
+        e: {gallery_id}.jsから期限切れとなるタイムスタンプのparseに失敗
         GalleryJsIsExpire: 作品情報GalleryInfoの期限切れ
 
     Returns:
         GalleryInfo: 作品情報をまとめたdataclass
     """
+    expires_at: float|None = None
     if test_js_text is None:
-        gallery_url = f"https://ltn.gold-usergeneratedcontent.net/galleries/{int(gallery_id)}.js"
+        gallery_url = gallery_js_url(gallery_id)
         try:
-            response = requests.get(gallery_url)
+            response = http_get(gallery_url)
             response.raise_for_status()
         except requests.HTTPError as e:
-            print(f'Failed to fetch {str(gallery_id)}.js')
+            metrics.message('error', f'Failed to fetch {str(gallery_id)}.js')
             raise e
-        js_text = response.text
-    else:
-        js_text = test_js_text
-    
-    def is_expire(current_unix_time: float) -> None:
-        nonlocal response
+        #Content-Typeにcharsetがないとresponse.textは文字コードの推定(数十ms)を行うので、推定せずutf-8として読む(不正なバイトはresponse.textと同じく置換する)
+        js_text = response.content.decode(response.encoding or 'utf-8', errors='replace')
         try:
-            time_str_may_be_gmt = response.headers['Expires']
-            parsed_datetime = parse(time_str_may_be_gmt)
-            utc_datetime = parsed_datetime.astimezone(tzutc())
-            expire_unix_time = utc_datetime.timestamp()
+            expires_at = parse_expires(response.headers['Expires'])
         except Exception as e:
-            print('Failed to parse expire timestamp of gg.js')
+            metrics.message('error', f'Failed to parse expire timestamp of {str(gallery_id)}.js')
             raise e
-        if current_unix_time >= expire_unix_time:
-            raise GalleryJsIsExpire(gallery_id=gallery_id)
+    else:
+        js_text = test_js_text
     
-    gallery_info = extract_gallery_info_from_gallery_js(js_text)
-    gallery_info.is_expire = is_expire
+    gallery_info = extract_gallery_info_from_gallery_js(js_text, columnar)
+    gallery_info.expires_at = expires_at
+    gallery_info.is_expire = gallery_expire_checker(gallery_id, expires_at)
     return gallery_info
 
+#ベンチマーク・スタブサーバー用の合成した{gallery_id}.js
+def synthetic_gallery_js(gallery_id: int, file_num: int=40, seed: int|None=None) -> str:
+    rng = random.Random(gallery_id if seed is None else seed)
+    files = [{'hasavif': rng.randint(0, 1), 'haswebp': 1, 'hasjxl': 0, 'hash': f'{rng.getrandbits(256):064x}', 'name': f'{i+1:02}.png', 'width': rng.randint(1900, 2200), 'height': rng.randint(2900, 3100)} for i in range(file_num)]
+    tags = [{'tag': tag, 'url': f'/tag/female%3A{tag}-all.html', 'male': '', 'female': '1'} for tag in rng.sample(['blowjob', 'paizuri', 'twintails', 'nakadashi', 'glasses', 'maid'], 3)]
+    gallery_info_json = {
+        'id': str(gallery_id), 'title': f'Synthetic Gallery {gallery_id}', 'japanese_title': None, 'type': 'doujinshi',
+        'language': 'japanese', 'language_localname': '日本語',
+        'artists': [{'artist': f'artist{gallery_id % 97}', 'url': f'/artist/artist{gallery_id % 97}-all.html'}],
+        'groups': None, 'parodys': None, 'characters': None, 'tags': tags, 'files': files,
+        'related': [rng.randint(1, 3000000) for _ in range(5)],
+    }
+    return f'var galleryinfo = {json.dumps(gallery_info_json, ensure_ascii=False)}'
+
 def test(test_id: int=2388652):
     test_js_text = 'var galleryinfo = {"languages":[{"language_localname":"English","galleryid":2576988,"name":"english","url":"/galleries/2576988.html"},{"language_localname":"中文","url":"/galleries/2315413.html","galleryid":2315413,"name":"chinese"},{"language_localname":"日本語","galleryid":2312974,"name":"japanese","url":"/galleries/2312974.html"}],"files":[{"hasavif":1,"haswebp":1,"hasjxl":0,"hash":"ce52befd53c3f95d70109ca03780a73f3ea754f6d8a921842bf902c9d50f58b1","name":"01.png","width":2132,"height":3023},{"name":"02.png","haswebp":1,"hasjxl":0,"hash":"75ebdf52f1a01fe179dd7bc1a14489c966dbf327ed071cf9e743e3afc0847e42","hasavif":1,"width":2053,"single":1,"height":3028},{"haswebp":1,"hasjxl":0,"hash":"7c09615510373b2eb66d29402cb7ccd9499fab6456311419f161174e742a5f32","hasavif":1,"width":2034,"height":3031,"name":"03.png"},{"hasavif":1,"hasjxl":0,"hash":"8c0001b31e1182d39d436f5f87bcd8fbaad425c973e49a7b9ccb4afab4914f49","haswebp":1,"name":"04.png","height":3024,"width":2099},{"name":"05.png","width":2058,"height":3034,"hasavif":1,"haswebp":1,"hash":"643fb741de95b3b1415187b948f77c7cbfc09c602544932caab5485926cc8cfb","hasjxl":0},{"hasavif":1,"haswebp":1,"hash":"0342db2ec998fd717650f891ad7356eac599d3e8f405f7a468252216f157c232","hasjxl":0,"name":"06.png","width":2047,"height":3034},{"hasavif":1,"hash":"4a459a927630c3634ceeaeb26c4f2efb1af36a4afc103a098831b72e055bc618","hasjxl":0,"haswebp":1,"name":"07.png","height":3031,"width":2064},{"name":"08.png","height":3028,"width":2091,"hasavif":1,"hash":"6c12257da4eb7b7d27fb35f29f9ebb062576674c7aee2ecc69ddc7ba150b0f10","hasjxl":0,"haswebp":1},{"height":3028,"width":2050,"name":"09.png","hash":"f52a966c161a43d3f773cca9eee9223111b3d2110b80f7c189876e31e60118e1","hasjxl":0,"haswebp":1,"hasavif":1},{"name":"10.png","height":3031,"width":2072,"hasavif":1,"hasjxl":0,"hash":"0abbe0c893cbd2557217941873675e83bd10f4d3a99fe664d0b49c5ec6648cde","haswebp":1},{"hasjxl":0,"hash":"099aabe51dc362709bf881266b3d3ab46b640c20ff26d16627952408ca70294f","haswebp":1,"hasavif":1,"height":3031,"width":2034,"name":"11.png"},{"width":2067,"height":3026,"name":"12.png","haswebp":1,"hasjxl":0,"hash":"924b0e7f49d4a0cd70119855c34ededf3c218760de034a4dde31e7915939fc2f","hasavif":1},{"name":"13.png","width":2045,"height":3031,"hasavif":1,"haswebp":1,"hash":"e7b5697b6357993bb5265ce0a7a455f34868735331853ae4f44583b538c71723","hasjxl":0},{"height":3025,"width":2067,"name":"14.png","hasjxl":0,"hash":"06294d287d3792ede837b77651d114f19f360f19ef4ee2f53b243ab921b5911c","haswebp":1,"hasavif":1},{"height":3029,"width":2018,"name":"15.png","hash":"64a32919fd17f43a2614314961cc3dd3e564fadf7e776ec36c7ace0a1d1dfc07","hasjxl":0,"haswebp":1,"hasavif":1},{"hasavif":1,"hasjxl":0,"hash":"198fb64595b031c1cfd27c584bf299c4e1a866be9493c20fa602d04984757023","haswebp":1,"name":"16.png","height":3031,"width":2070},{"width":2031,"height":3030,"name":"17.png","haswebp":1,"hasjxl":0,"hash":"13d3f699fb353844dde92aa8ddb50b1da4158411763b9bbb953a8c5d17565f3c","hasavif":1},{"name":"18.png","width":2056,"height":3023,"hasavif":1,"haswebp":1,"hasjxl":0,"hash":"a21ab639472566215f3738a2b152c4a4ac95b15056d210005be7e9deee02aac6"},{"name":"19.png","height":3028,"width":2053,"hasavif":1,"hash":"068df9299d1cdadaaf412b43d12c95020406b9816542178a412a7916f16340ee","hasjxl":0,"haswebp":1},{"hasavif":1,"haswebp":1,"hasjxl":0,"hash":"96c919ab79aac7a420ec40571dcdbd0922285d74dfd264203a83fec5d7df52b6","name":"20.png","width":2064,"height":3031},{"hasjxl":0,"hash":"a7aac7d306daa35d36d6626648d1bb3e41e5d009cc5e9c6e4d52774c25176109","haswebp":1,"hasavif":1,"height":3036,"width":2039,"name":"21.png"},{"name":"22.png","height":3023,"width":2020,"hasavif":1,"hasjxl":0,"hash":"cade3cea3445a180513c24563bb022fb96ce4c153332b8a8cfeaf0d27c972de1","haswebp":1},{"width":2040,"height":3028,"name":"23.png","haswebp":1,"hasjxl":0,"hash":"f0bf44f45cbba1fc00c0c419b44a6995846b170021a18bcff85e82c516dbff36","hasavif":1},{"width":2037,"height":3028,"name":"24.png","haswebp":1,"hasjxl":0,"hash":"8047e65f9c3aa8f0f6b9c315c42931a4b8a34d025015ba354ca0feb9487b7c75","hasavif":1},{"name":"25.png","width":2036,"height":3023,"hasavif":1,"haswebp":1,"hash":"49c6404cf5a5a322ce013669261097e4521f9eff85e0e20f8fb55476e24d199e","hasjxl":0},{"hasavif":1,"haswebp":1,"hasjxl":0,"hash":"d1926a2ed30097668f4c062d3d0fefeab75b7a3e46a287b75baf21da6d0164c0","name":"26.png","width":2025,"height":3028},{"hasjxl":0,"hash":"7f156776db191f0368479230d9b017b34812eaad7f68c356286ec9ddb8fe2e4e","haswebp":1,"hasavif":1,"height":3031,"width":2040,"name":"27.png"},{"height":3018,"width":2023,"name":"28.png","hasjxl":0,"hash":"7d6616f23f56c356b056911bd995409bb928e340ceee48e02f07fe1deba0c41a","haswebp":1,"hasavif":1},{"hasavif":1,"haswebp":1,"hash":"6edef606d525d4e2df3ede317916f7899dfe44191995d4520ef5bf8f1a1d267b","hasjxl":0,"name":"29.png","width":2009,"height":3034},{"hash":"7bb4eba683e881558856766262dba7435a4cd1b37647ecb72d33c76c9d11b160","hasjxl":0,"haswebp":1,"hasavif":1,"height":3022,"width":2037,"name":"30.png"},{"height":3025,"width":2007,"name":"31.png","hash":"323d95db330fec9f7080156b1c39ca57b353023795be2c9f02b9c15e63207aa7","hasjxl":0,"haswebp":1,"hasavif":1},{"name":"32.png","width":2021,"height":3031,"hasavif":1,"haswebp":1,"hasjxl":0,"hash":"21a6bf51d6858d8122def5369a4765de3a15ccbc86fcdd30ea680fb712f0e7b6"},{"name":"33.png","height":3034,"width":2015,"hasavif":1,"hash":"a86b6bfcbc675d0c001bb4d0175726ff58c02ce64011fab8e9e51985a1100b29","hasjxl":0,"haswebp":1},{"hash":"815b870e9b94bfacc37d2223ef49fc3b72c024d0deee23972df742d5f995a3ff","hasjxl":0,"haswebp":1,"hasavif":1,"height":3029,"width":2029,"name":"34.png"},{"name":"35.png","height":3031,"width":2028,"hasavif":1,"hash":"cfa9706d49c692e5c05c9a56ce77e16c727e517d94314d95c18ae269bfcd9f53","hasjxl":0,"haswebp":1},{"name":"36.png","height":3028,"width":2040,"hasavif":1,"hasjxl":0,"hash":"e732edf85acd72f18425f9636d78494d12d8b073bbf7e2474f6438df3cb44df0","haswebp":1},{"name":"37.png","width":2017,"height":3025,"hasavif":1,"haswebp":1,"hasjxl":0,"hash":"49b9dd3778e66496202569485d491cf857f78159076da613de8cd4f00a6a4f8b"},{"haswebp":1,"hash":"e5c08a727584be39e77983b22414a106b66f3062a47ef51ad16ec5aa105fd22f","hasjxl":0,"hasavif":1,"width":2037,"height":3026,"name":"38.png"},{"hasavif":1,"haswebp":1,"hash":"8298bbde376356e1fb60d2d09dfbf7c6e90d4cfe24f8ad459535c0903b5335bf","hasjxl":0,"name":"39.png","width":2051,"height":3031},{"hasavif":1,"haswebp":1,"hash":"9b6c90275865613096a495389a85122cc0659c1fd714c57ab44079fcb75f6f8b","hasjxl":0,"name":"40.png","width":2045,"height":3001},{"haswebp":1,"hasjxl":0,"hash":"2ac0b09a24184408e5533ef69495c6e2313385a671407bc54586bd3f308b558d","hasavif":1,"width":1976,"height":2993,"name":"41.png"},{"haswebp":1,"hash":"9933ea69eaaf99783ab68af0611b8b6ddbaed3971dae510b71447bcb7b9217f6","hasjxl":0,"hasavif":1,"width":2112,"height":2997,"name":"42.png"}],"date":"2022-08-29 19:17:00-05","language":"japanese","videofilename":null,"artists":[{"url":"/artist/fue-all.html","artist":"fue"},{"url":"/artist/kizuka%20kazuki-all.html","artist":"kizuka kazuki"}],"japanese_title":"秩序バケーション","id":"2312974","scene_indexes":[],"title":"Chitsujo Vacation","groups":[{"url":"/group/ikkizuka-all.html","group":"ikkizuka"}],"type":"doujinshi","blocked":0,"characters":[{"url":"/character/gran-all.html","character":"gran"},{"character":"heles","url":"/character/heles-all.html"},{"character":"monika","url":"/character/monika-all.html"},{"url":"/character/monika%20weisswind-all.html","character":"monika weisswind"}],"galleryurl":"/doujinshi/秩序バケーション-日本語-417750-2312974.html","language_localname":"日本語","language_url":"/index-japanese.html","video":null,"related":[1553483,1552028,1592227,1450678,1425868],"tags":[{"url":"/tag/female%3Ablowjob-all.html","tag":"blowjob","male":"","female":"1"},{"tag":"c100","url":"/tag/c100-all.html"},{"female":"1","tag":"deepthroat","male":"","url":"/tag/female%3Adeepthroat-all.html"},{"male":"","tag":"fingering","url":"/tag/female%3Afingering-all.html","female":"1"},{"male":"","tag":"nakadashi","url":"/tag/female%3Anakadashi-all.html","female":"1"},{"male":"","tag":"paizuri","url":"/tag/female%3Apaizuri-all.html","female":"1"},{"url":"/tag/female%3Atwintails-all.html","male":"","tag":"twintails","female":"1"}],"parodys":[{"parody":"granblue fantasy","url":"/series/granblue%20fantasy-all.html"}],"datepublished":"2022-08-13"}'
     files_info = gallery_info_from_id(test_id, test_js_text)
     print(files_info)
+    columnar_files_info = gallery_info_from_id(test_id, test_js_text, columnar=True)
+    assert isinstance(columnar_files_info.files_info, FilesTable)
+    assert list(columnar_files_info.files_info) == files_info.files_info
+    assert columnar_files_info.files_info[-1] == files_info.files_info[-1] and columnar_files_info.files_info[1:3] == files_info.files_info[1:3]
+    assert columnar_files_info.to_json() == files_info.to_json()
+
+    assert parse_gallery_js(test_js_text) == extract_gallery_info_from_gallery_js(test_js_text)
+    assert parse_gallery_js(test_js_text.encode()) == extract_gallery_info_from_gallery_js(test_js_text)
+    _warned_keys.clear()
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        parse_gallery_js(test_js_text)
+        parse_gallery_js(test_js_text)
+    assert len(caught_warnings) == 1
+    assert parse_gallery_js(test_js_text, columnar=True).to_json() == files_info.to_json()
+    # 表に格納できないwidth・heightはFileInfoのリストで保持する
+    for width in (-1, 2**32, True):
+        out_of_range_js_text = test_js_text.replace('"width":2132', f'"width":{json.dumps(width)}')
+        for gallery_info in (gallery_info_from_id(test_id, out_of_range_js_text, columnar=True), parse_gallery_js(out_of_range_js_text, columnar=True)):
+            assert isinstance(gallery_info.files_info, list) and gallery_info.files_info[0].width == width
+
+def bench_parse(gallery_num: int=10000, file_num: int=40) -> None:
+    """1コアで{gallery_id}.jsを何件/秒parseできるかを、従来のparserと高速版で比較する"""
+    import time
+    corpus = [synthetic_gallery_js(gallery_id, file_num) for gallery_id in range(1, gallery_num + 1)]
+    byte_corpus = [js_text.encode() for js_text in corpus]
+    parsers: list[tuple[str, Callable[[Any], Any], list[Any]]] = [
+        ('json only (upper bound)', _load_gallery_json, corpus),
+        ('extract_gallery_info_from_gallery_js', extract_gallery_info_from_gallery_js, corpus),
+        (f'parse_gallery_js(str, {"orjson" if orjson else "json"})', parse_gallery_js, corpus),
+        (f'parse_gallery_js(bytes, {"orjson" if orjson else "json"})', parse_gallery_js, byte_corpus),
+        ('parse_gallery_js(columnar)', lambda js_text: parse_gallery_js(js_text, columnar=True), byte_corpus),
+    ]
+    for label, parser, inputs in parsers:
+        start = time.perf_counter()
+        for js_text in inputs:
+            parser(js_text)
+        elapsed = time.perf_counter() - start
+        print(f'{label}: {gallery_num} galleries x {file_num} files in {elapsed:.2f}s ({gallery_num / elapsed:.0f} galleries/s)')
+
+def bench(gallery_num: int=2000, file_num: int=40) -> None:
+    """合成した{gallery_id}.jsのコーパスで、FileInfoのリストとFilesTableのメモリ使用量・parse時間を比較する"""
+    import time
+    import tracemalloc
+    corpus = [synthetic_gallery_js(gallery_id, file_num) for gallery_id in range(1, gallery_num + 1)]
+    for columnar in (False, True):
+        start = time.perf_counter()
+        gallery_infos = [extract_gallery_info_from_gallery_js(js_text, columnar) for js_text in corpus]
+        elapsed = time.perf_counter() - start
+        del gallery_infos
+        #メモリ使用量はtracemallocのオーバーヘッドが時間に乗らないよう別に計測する
+        tracemalloc.start()
+        gallery_infos = [extract_gallery_info_from_gallery_js(js_text, columnar) for js_text in corpus]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for gallery_info in gallery_infos:
+            for file_info in gallery_info.files_info:
+                file_info.hash
+        iter_elapsed = time.perf_counter() - start
+        label = 'columnar' if columnar else 'list'
+        print(f'{label}: {gallery_num} galleries x {file_num} files, parse {elapsed:.2f}s, iterate {iter_elapsed:.2f}s, retained {current / 2**20:.1f} MiB (peak {peak / 2**20:.1f} MiB)')
+        del gallery_infos
     
 if __name__ == '__main__':
         test()
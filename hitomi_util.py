@@ -1,69 +1,240 @@
 import os
-from tqdm import tqdm
+import time
+import metrics
+from typing import Callable, Iterable
 from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 from gallery_info_from_id import gallery_info_from_id, GalleryInfo
-from url_from_file_info import url_from_file_info, parse_gg, GGJs
-from fetch_image_from_url import fetch_image_from_url
-#作品情報を取得
-def get_gallery_info(gallery_id: int) -> GalleryInfo:
+from gallery_cache import GalleryCache
+from url_from_file_info import urls_from_files_info, GGJs, GGJsProvider, default_gg_provider
+from fetch_image_from_url import fetch_image_from_url, fetch_image_to_file
+from download_manifest import DownloadManifest, is_gallery_complete
+from gallery_index import GalleryIndex
+from content_store import ContentStore, ContentStoreStats
+from rate_control import RateController
+from image_format import FormatNegotiator
+from gallery_archive import GalleryArchive, ARCHIVE_EXT, COMIC_INFO_NAME, comic_info_xml, is_archive_complete
+#作品情報を取得(cacheを渡すとExpiresまではディスクから読み込む)
+def get_gallery_info(gallery_id: int, cache: GalleryCache|None=None) -> GalleryInfo:
+    if cache is not None:
+        return cache.gallery_info(gallery_id)
     return gallery_info_from_id(gallery_id)
 
 #作品に含まれる画像urlのリストを取得
-def urls_form_id(gallery_id: int, gallery_info: GalleryInfo|None=None, gg: GGJs|None=None) -> list[str]:
+def urls_form_id(gallery_id: int, gallery_info: GalleryInfo|None=None, gg: GGJs|GGJsProvider|None=None) -> list[str]:
     if gallery_info is None:
         gallery_info = get_gallery_info(gallery_id)
     if gg is None:
-        gg = parse_gg()
-    urls: list[str] = []
-    for file_info in gallery_info.files_info:
-        urls.append(url_from_file_info(gallery_id, file_info, gg))
-    return urls
+        gg = default_gg_provider()
+    #url_from_file_infoと同じurlを作品全体でまとめて作成する
+    return urls_from_files_info(gallery_id, gallery_info.files_info, gg)
 
-#作品に含まれる画像をすべてダウンロード
-def save_all_image_data_from_id(gallery_id: int, gallery_info: GalleryInfo|None=None, gg: GGJs|None=None, save_dir: str|None=None, save_json: bool=True) -> None:
-    """作品に含まれる画像バイト列をすべてダウンロードする関数
-    Args:
-        gallery_id (int): 作品id
-        gallery_info (GalleryInfo|None): {gallery_id}.jsをparseしたGalleryInfo。固定すれば高速化できるが、期限切れになる可能性がある Defaults to None.
-        gg (GGJs|None): gg.jsをparseしたオブジェクト。固定すれば高速化できるが、期限切れになる可能性がある Defaults to None.
-        save_dir (str|None): 保存先ディレクトリ。指定しない場合はカレントディレクトリに保存される Defaults to None.
-    """
-    if gallery_info is None:
-        gallery_info = get_gallery_info(gallery_id)
-    if gg is None:
-        gg = parse_gg()
-    urls = urls_form_id(gallery_id, gallery_info, gg)
+#作品フォルダ・アーカイブの名前({gallery_id:08}_タイトル)
+def gallery_dir_name(gallery_id: int, gallery_info: GalleryInfo) -> str:
+    return f'{gallery_id:08}_{gallery_info.japanese_title.replace(' ', '') or gallery_info.title.replace(' ', '_')}'
+
+#作品の保存先ディレクトリを作成(save_jsonならGalleryInfoも保存、gallery_indexがあれば索引に登録)
+def prepare_save_dir(gallery_id: int, gallery_info: GalleryInfo, save_dir: str|None=None, save_json: bool=True, gallery_index: GalleryIndex|None=None) -> str:
     if save_dir is None:
         save_dir = os.getcwd()
     gallery_id_str_format = f'{gallery_id:08}'
     
-    save_dir = os.path.join(save_dir, f'{gallery_id_str_format}_{gallery_info.japanese_title.replace(' ', '') or gallery_info.title.replace(' ', '_')}')
+    save_dir = os.path.join(save_dir, gallery_dir_name(gallery_id, gallery_info))
     os.makedirs(save_dir, exist_ok=True)
     
     if save_json:
         json_path = os.path.join(save_dir, f'{gallery_id_str_format}.json')
         with open(json_path, 'w', encoding='utf-8') as f:
             f.write(gallery_info.to_json())
-    
-    def write_image_data(image_data: bytes, file_path: str) -> str:
-        with open(file_path, 'wb') as f:
-            f.write(image_data)
-        return file_path
+    if gallery_index is not None:
+        gallery_index.add(gallery_id, gallery_info, save_dir)
+    return save_dir
+
+#index番目の画像の保存先パス
+def image_save_path(save_dir: str, gallery_id: int, index: int, url: str) -> str:
+    return os.path.join(save_dir, f'{gallery_id:08}_{index:05}{os.path.splitext(url)[-1]}')
+
+#(画像形式, url, 保存先)のうち保存済みのものの保存先(ディレクトリを一度だけ走査したexisting_file_namesで判定)
+def find_saved_page(variant_paths: Iterable[tuple[str, str, str]], existing_file_names: set[str]) -> str|None:
+    return next((save_path for _, _, save_path in variant_paths if os.path.basename(save_path) in existing_file_names), None)
+
+def write_image_data(image_data: bytes, file_path: str) -> str:
+    started = time.perf_counter()
+    with open(file_path, 'wb') as f:
+        f.write(image_data)
+    metrics.observe('disk_write_seconds', time.perf_counter() - started)
+    return file_path
+
+#ページごとに試す順の(画像形式, url)。format_negotiatorがなければurls_form_idのurlのみ
+def page_variants_from_id(gallery_id: int, gallery_info: GalleryInfo, gg: GGJs|GGJsProvider, format_negotiator: FormatNegotiator|None=None) -> list[list[tuple[str, str]]]:
+    if format_negotiator is not None:
+        return format_negotiator.page_variants(gallery_id, gallery_info.files_info, gg)
+    return [[('', url)] for url in urls_form_id(gallery_id, gallery_info, gg)]
+
+#ページを(画像形式, url, 保存先)の順に取得して保存先を返す関数を作成(store・rate_controller・format_negotiatorを組み合わせる)
+def page_fetcher(gallery_id: int, gallery_info: GalleryInfo, verify_hash: bool=False, store: ContentStore|None=None, rate_controller: RateController|None=None, format_negotiator: FormatNegotiator|None=None, store_stats: ContentStoreStats|None=None) -> Callable[[int, list[tuple[str, str, str]]], str]:
+    fetch = rate_controller.fetch_image_to_file if rate_controller is not None else fetch_image_to_file
+    def fetch_page(index: int, variant_paths: list[tuple[str, str, str]]) -> str:
+        file_hash = gallery_info.files_info[index].hash
+        expected_hash = file_hash if verify_hash else None
+        page_fetch = fetch
+        if store is not None:
+            page_fetch = lambda gallery_id, url, save_path, expected_hash: store.fetch_to_file(gallery_id, url, save_path, file_hash, expected_hash, fetch, store_stats)
+        try:
+            if format_negotiator is not None:
+                return format_negotiator.fetch_to_file(gallery_id, variant_paths, expected_hash, page_fetch)
+            _, url, save_path = variant_paths[0]
+            return page_fetch(gallery_id, url, save_path, expected_hash)
+        except Exception as e:
+            #すべての形式・再試行で失敗した場合だけエラーとして報告する
+            metrics.message('error', f'Failed to fetch image data: {gallery_id} page {index}\n{e}')
+            raise e
+    return fetch_page
+
+#作品を1つのcbzに保存(ページ順に格納し、既存のアーカイブは格納済みのページを飛ばして追記する)
+def save_gallery_archive(gallery_id: int, gallery_info: GalleryInfo, page_variants: list[list[tuple[str, str]]], fetch_page: Callable[[int, list[tuple[str, str, str]]], str], save_dir: str, save_json: bool=True, gallery_index: GalleryIndex|None=None, max_worker: int=5, window: int|None=None) -> str:
+    os.makedirs(save_dir, exist_ok=True)
+    archive_path = os.path.join(save_dir, gallery_dir_name(gallery_id, gallery_info) + ARCHIVE_EXT)
+    if gallery_index is not None:
+        gallery_index.add(gallery_id, gallery_info, archive_path)
+    with GalleryArchive(archive_path) as archive:
+        archive.write_bytes(COMIC_INFO_NAME, comic_info_xml(gallery_id, gallery_info, len(page_variants)))
+        if save_json:
+            archive.write_bytes(f'{gallery_id:08}.json', gallery_info.to_json().encode('utf-8'))
+        #central directoryにあるページはリクエストしない
+        pending_pages: dict[int, list[tuple[str, str, str]]] = {}
+        for index, variants in enumerate(page_variants):
+            variant_paths = [(image_format, url, image_save_path(archive.pages_dir, gallery_id, index, url)) for image_format, url in variants]
+            if not any(os.path.basename(save_path) in archive.names for _, _, save_path in variant_paths):
+                pending_pages[index] = variant_paths
+        existing_file_names = set(os.listdir(archive.pages_dir))
+        with ThreadPoolExecutor(max_workers=max_worker) as executor, \
+                metrics.progress(f'ダウンロード中: {gallery_id}({gallery_info.japanese_title or gallery_info.title})', len(pending_pages)) as progress:
+            def submit(index: int) -> Future[str]:
+                variant_paths = pending_pages.pop(index)
+                #前回取得したが格納前に中断した一時ファイルはそのまま使う
+                saved_path = find_saved_page(variant_paths, existing_file_names)
+                if saved_path is not None:
+                    future: Future[str] = Future()
+                    future.set_result(saved_path)
+                    return future
+                return executor.submit(fetch_page, index, variant_paths)
+            archive.write_in_order(list(pending_pages), submit, window or max_worker * 4, lambda index, name: progress.update(1))
+    return archive_path
+
+#作品に含まれる画像をすべてダウンロード
+def save_all_image_data_from_id(gallery_id: int, gallery_info: GalleryInfo|None=None, gg: GGJs|GGJsProvider|None=None, save_dir: str|None=None, save_json: bool=True, stream: bool=True, verify_hash: bool=False, gallery_index: GalleryIndex|None=None, store: ContentStore|None=None, max_worker: int=5, rate_controller: RateController|None=None, format_negotiator: FormatNegotiator|None=None, archive: bool=False, archive_window: int|None=None) -> ContentStoreStats|None:
+    """作品に含まれる画像バイト列をすべてダウンロードする関数
+    保存済みのページはリクエストせず、中断された.partはRangeリクエストで続きから取得する。
+    完了したページは{gallery_id:08}.manifest.jsonに記録され、全ページ揃っていれば再実行時はネットワークにアクセスしない
+    Args:
+        gallery_id (int): 作品id
+        gallery_info (GalleryInfo|None): {gallery_id}.jsをparseしたGalleryInfo。固定すれば高速化できるが、期限切れになる可能性がある Defaults to None.
+        gg (GGJs|GGJsProvider|None): gg.jsをparseしたオブジェクト。GGJsを固定すると期限切れになる可能性があるが、GGJsProviderなら期限前に自動で取得し直す。指定しない場合は共有のGGJsProvider Defaults to None.
+        save_dir (str|None): 保存先ディレクトリ。指定しない場合はカレントディレクトリに保存される Defaults to None.
+        stream (bool): 画像をメモリに溜めずに一時ファイルへ書き込み、完了後にリネームする Defaults to True.
+        verify_hash (bool): stream時にSHA-256をFileInfo.hashと照合する(元画像をダウンロードする場合のみ一致する) Defaults to False.
+        gallery_index (GalleryIndex|None): 作品情報を登録する検索用の索引 Defaults to None.
+        store (ContentStore|None): 画像をhashごとに1回だけ保存するストア。保存済みのhashはリクエストせず作品フォルダにリンクする(streamとして扱う) Defaults to None.
+        max_worker (int): 画像ダウンロードのワーカー数(rate_controllerを指定した場合はその上限が優先) Defaults to 5.
+        rate_controller (RateController|None): 同時実行数とホストごとのレートを429/5xx・レイテンシに合わせて調整する(streamとして扱う) Defaults to None.
+        format_negotiator (FormatNegotiator|None): ページの画像形式をFormatPolicyの順に選び、失敗したら次の形式で取得し直す(streamとして扱う)。指定しない場合はavifがあればavif、なければwebp Defaults to None.
+        archive (bool): 作品フォルダの代わりに{gallery_id:08}_タイトル.cbzへページ順に格納する(ComicInfo.xmlとsave_jsonならjsonも格納)。再実行時はcentral directoryから格納済みのページを読み取る(streamとして扱う) Defaults to False.
+        archive_window (int|None): archive時に取得中・格納待ちにするページ数の上限。指定しない場合はmax_workerの4倍 Defaults to None.
+
+    Returns:
+        ContentStoreStats|None: storeを指定した場合、この実行で保存した実体と節約したリクエスト数・バイト数
+    """
+    save_root = save_dir if save_dir is not None else os.getcwd()
+    #store.statsは他の実行とも共有されるので、この実行の分は別に集計する
+    store_stats = ContentStoreStats() if store is not None else None
+    #manifest(archiveならcentral directory)どおりに全ページが揃っていれば、作品情報もgg.jsも取得せずに終了
+    if is_archive_complete(save_root, gallery_id) if archive else is_gallery_complete(save_root, gallery_id):
+        return store_stats
+    if gallery_info is None:
+        gallery_info = get_gallery_info(gallery_id)
+    if gg is None:
+        gg = default_gg_provider()
+    page_variants = page_variants_from_id(gallery_id, gallery_info, gg, format_negotiator)
+    fetch_page = page_fetcher(gallery_id, gallery_info, verify_hash, store, rate_controller, format_negotiator, store_stats)
+    if rate_controller is not None:
+        #同時実行数はrate_controllerが調整するので、ワーカーはその上限まで用意する
+        max_worker = rate_controller.max_worker
+    if archive:
+        save_gallery_archive(gallery_id, gallery_info, page_variants, fetch_page, save_root, save_json, gallery_index, max_worker, archive_window)
+        return store_stats
+    save_dir = prepare_save_dir(gallery_id, gallery_info, save_root, save_json, gallery_index)
+    manifest = DownloadManifest.load(save_dir, gallery_id) or DownloadManifest(gallery_id=gallery_id, page_num=len(page_variants))
+    manifest.page_num = len(page_variants)
+    #ディレクトリを一度だけ走査し、保存済みのページはリクエストしない
+    existing_file_names = set(os.listdir(save_dir))
             
-    max_worker = 5
     with ThreadPoolExecutor(max_workers=max_worker) as executor:
-        futures: list[Future[bytes]] = []
-        for url in urls:
-            futures.append(executor.submit(fetch_image_from_url, gallery_id, url))
-        for future in tqdm(as_completed(futures), total=len(futures), desc=f'ダウンロード中: {gallery_id}({gallery_info.japanese_title or gallery_info.title})'):
-            index = futures.index(future)
-            save_path = os.path.join(save_dir, f'{gallery_id_str_format}_{index:05}{os.path.splitext(urls[index])[-1]}')
-            if os.path.exists(save_path):
-                #print(f'File already exists: {save_path}')
-                future.cancel()
+        #完了したfutureは辞書から外し、画像データを保持し続けないようにする
+        futures: dict[Future[bytes|str], tuple[int, str]] = {}
+        for index, variants in enumerate(page_variants):
+            variant_paths = [(image_format, url, image_save_path(save_dir, gallery_id, index, url)) for image_format, url in variants]
+            #いずれかの形式で保存済みならリクエストしない
+            saved_path = find_saved_page(variant_paths, existing_file_names)
+            if saved_path is not None:
+                if index not in manifest.pages:
+                    manifest.record(index, os.path.basename(saved_path), os.path.getsize(saved_path), gallery_info.files_info[index].hash)
                 continue
-            image_data = future.result()
-            write_image_data(image_data, save_path)
+            _, url, save_path = variant_paths[0]
+            if stream or store is not None or rate_controller is not None or format_negotiator is not None:
+                futures[executor.submit(fetch_page, index, variant_paths)] = (index, save_path)
+            else:
+                futures[executor.submit(fetch_image_from_url, gallery_id, url)] = (index, save_path)
+        try:
+            with metrics.progress(f'ダウンロード中: {gallery_id}({gallery_info.japanese_title or gallery_info.title})', len(futures)) as progress:
+                for future in as_completed(futures):
+                    index, save_path = futures.pop(future)
+                    image_data = future.result()
+                    if isinstance(image_data, bytes):
+                        write_image_data(image_data, save_path)
+                    else:
+                        #format_negotiatorが次の形式で取得した場合は保存先の拡張子が変わる
+                        save_path = image_data
+                    manifest.record(index, os.path.basename(save_path), os.path.getsize(save_path), gallery_info.files_info[index].hash)
+                    progress.update()
+        finally:
+            manifest.save(save_dir)
+    return store_stats
+
+
+def profile_urls_form_id(file_num: int=5000, top_num: int=8) -> None:
+    """5000ファイルの合成作品でurls_form_idをプロファイルし、毎回Expiresをparseしていた変更前と比較する"""
+    import cProfile
+    import pstats
+    import email.utils
+    from dateutil.parser import parse
+    from dateutil.tz import tzutc
+    from gallery_info_from_id import synthetic_gallery_js
+    from url_from_file_info import parse_gg, url_from_file_info, synthetic_gg_js
+
+    gallery_info = gallery_info_from_id(1, synthetic_gallery_js(1, file_num))
+    gg = parse_gg(synthetic_gg_js())
+    expires_header = email.utils.formatdate(time.time() + 3600, usegmt=True)
+    gg.expires_at = parse(expires_header).astimezone(tzutc()).timestamp()
+
+    # 変更前の期限確認(URLごとにExpiresヘッダをparseする)
+    class LegacyGGJs(GGJs):
+        def is_expired(self, current_unix_time: float) -> bool:
+            return current_unix_time >= parse(expires_header).astimezone(tzutc()).timestamp()
+    legacy_gg = LegacyGGJs(b_value=gg.b_value, s_func=gg.s_func, m_func=gg.m_func, expires_at=gg.expires_at)
+
+    for label, target_gg in (('before', legacy_gg), ('after', gg)):
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        if label == 'before':
+            # 変更前のurls_form_id(ファイルごとにurl_from_file_infoで期限確認する)
+            [url_from_file_info(1, file_info, target_gg) for file_info in gallery_info.files_info]
+        else:
+            urls_form_id(1, gallery_info, target_gg)
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        print(f'--- {label}: {file_num} urls in {elapsed:.3f}s ({file_num / elapsed:.0f} urls/s)')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top_num)
 
 
 def test(test_gallery_id: int=2388652):
@@ -0,0 +1,189 @@
+import time
+import threading
+import requests
+import metrics
+from dataclasses import dataclass, field, replace
+from typing import Callable, Any
+from urllib.parse import urlsplit
+from urllib3.util import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.adapters import HTTPAdapter
+
+@dataclass(frozen=True)
+class TransportConfig:
+    """
+    全fetcherで共有するHTTP通信の設定。
+    pool_maxsizeはホスト(a1./w1./ltn. など)ごとに保持するkeep-alive接続数で、ダウンロードのワーカー数以上にしておく
+    """
+    pool_connections: int = 16
+    pool_maxsize: int = 16
+    retry_num: int = 5
+    backoff_factor: float = 1
+    status_forcelist: tuple[int, ...] = (502, 503, 504)
+    timeout: tuple[float, float] = (10, 30)
+    # ローカルのスタブサーバーなどへ向け先を差し替える関数(テスト・ベンチマーク用)
+    url_rewriter: Callable[[str], str]|None = field(default=None, compare=False)
+
+_config = TransportConfig()
+_lock = threading.Lock()
+_local = threading.local()
+_adapters: dict[int, HTTPAdapter] = {}
+_generation = 0
+
+def configure_transport(**kwargs: Any) -> TransportConfig:
+    """共有トランスポートの設定を変更する。既存の接続プールは破棄される
+
+    Args:
+        **kwargs: TransportConfigのフィールド
+
+    Returns:
+        TransportConfig: 変更後の設定
+    """
+    global _config, _generation
+    with _lock:
+        _config = replace(_config, **kwargs)
+        for adapter in _adapters.values():
+            adapter.close()
+        _adapters.clear()
+        _generation += 1
+        return _config
+
+def get_config() -> TransportConfig:
+    return _config
+
+def close_transport() -> None:
+    """共有の接続プールをすべて閉じる"""
+    configure_transport()
+
+class _TimedHTTPConnection(HTTPConnection):
+    """新規接続のDNS解決+TCP接続の時間をmetricsに通知する"""
+    def _new_conn(self) -> Any:
+        if not metrics.enabled():
+            return super()._new_conn()
+        started = time.perf_counter()
+        sock = super()._new_conn()
+        metrics.observe('http_connect_seconds', time.perf_counter() - started, host=self.host)
+        return sock
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    """新規接続のDNS解決+TCP接続と、TLSハンドシェイクの時間をmetricsに通知する"""
+    _connect_seconds = 0.0
+
+    def _new_conn(self) -> Any:
+        if not metrics.enabled():
+            return super()._new_conn()
+        started = time.perf_counter()
+        sock = super()._new_conn()
+        self._connect_seconds = time.perf_counter() - started
+        metrics.observe('http_connect_seconds', self._connect_seconds, host=self.host)
+        return sock
+
+    def connect(self) -> None:
+        if not metrics.enabled():
+            return super().connect()
+        started = time.perf_counter()
+        super().connect()
+        metrics.observe('http_tls_seconds', time.perf_counter() - started - self._connect_seconds, host=self.host)
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """接続の確立にかかった時間を計測する接続プールを使うadapter"""
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+def _adapter_for(retry_num: int) -> HTTPAdapter:
+    # 接続プールはadapterが持つので、同じリトライ方針のスレッド間でadapterを共有する
+    with _lock:
+        adapter = _adapters.get(retry_num)
+        if adapter is None:
+            retry = Retry(total=retry_num, backoff_factor=_config.backoff_factor, status_forcelist=list(_config.status_forcelist))
+            adapter = _TimedHTTPAdapter(pool_connections=_config.pool_connections, pool_maxsize=_config.pool_maxsize, max_retries=retry)
+            _adapters[retry_num] = adapter
+        return adapter
+
+def get_session(retry_num: int|None=None) -> requests.Session:
+    """スレッドごとのSessionを返す。接続プールとリトライ方針は全スレッドで共有される
+
+    Args:
+        retry_num (int|None): リトライ回数。指定しない場合はTransportConfig.retry_num Defaults to None.
+    """
+    if retry_num is None:
+        retry_num = _config.retry_num
+    sessions: dict[int, requests.Session]|None = getattr(_local, 'sessions', None)
+    if sessions is None or getattr(_local, 'generation', None) != _generation:
+        sessions = {}
+        _local.sessions = sessions
+        _local.generation = _generation
+    session = sessions.get(retry_num)
+    if session is None:
+        adapter = _adapter_for(retry_num)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        sessions[retry_num] = session
+    return session
+
+def rewrite_url(url: str) -> str:
+    url_rewriter = _config.url_rewriter
+    return url_rewriter(url) if url_rewriter else url
+
+def http_get(url: str, headers: dict[str, str]|None=None, retry_num: int|None=None, **kwargs: Any) -> requests.Response:
+    """共有の接続プールを使ってGETする
+
+    Args:
+        url (str): 取得するurl
+        headers (dict[str, str]|None): リクエストヘッダ Defaults to None.
+        retry_num (int|None): リトライ回数。指定しない場合はTransportConfig.retry_num Defaults to None.
+        **kwargs: requests.Session.getにそのまま渡す引数
+
+    Returns:
+        requests.Response: レスポンス
+    """
+    kwargs.setdefault('timeout', _config.timeout)
+    if not metrics.enabled():
+        return get_session(retry_num).get(rewrite_url(url), headers=headers, **kwargs)
+    host = urlsplit(url).netloc
+    started = time.perf_counter()
+    try:
+        response = get_session(retry_num).get(rewrite_url(url), headers=headers, **kwargs)
+    except requests.RequestException as e:
+        metrics.inc('http_errors_total', host=host, error=type(e).__name__)
+        raise e
+    metrics.observe('http_request_seconds', time.perf_counter() - started, host=host)
+    #Response.elapsedは送信からレスポンスヘッダのparseまで(urllib3の再試行を含む)
+    metrics.observe('http_ttfb_seconds', response.elapsed.total_seconds(), host=host)
+    metrics.inc('http_requests_total', host=host, status=str(response.status_code))
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        metrics.inc('http_retries_total', len(retries.history), host=host)
+    return response
+
+def test(request_num: int=50, max_worker: int=5) -> None:
+    """ローカルのスタブサーバーで、ダウンロード全体の新規TCP接続数がワーカー数以下になることを確認する"""
+    from concurrent.futures import ThreadPoolExecutor
+    from stub_server import StubServer
+    from fetch_image_from_url import fetch_image_from_url
+    # __main__として実行された場合もfetcherと同じモジュールの設定を変更する
+    import http_session
+
+    with StubServer() as server:
+        server.add_route('/a1.gold-usergeneratedcontent.net/test.webp', b'\0' * 1024)
+        http_session.configure_transport(url_rewriter=server.rewrite_url)
+        try:
+            with ThreadPoolExecutor(max_workers=max_worker) as executor:
+                image_data_list = list(executor.map(lambda _: fetch_image_from_url(1, 'https://a1.gold-usergeneratedcontent.net/test.webp'), range(request_num)))
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+        assert all(len(image_data) == 1024 for image_data in image_data_list)
+        print(f'requests: {server.request_count}, new tcp connections: {server.connection_count}')
+        assert server.connection_count <= max_worker
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,205 @@
+import os
+import threading
+import requests
+import metrics
+from dataclasses import dataclass, field
+from typing import Callable, Sequence
+from gallery_info_from_id import FileInfo
+from url_from_file_info import GGJs, GGJsProvider, resolve_gg, url_from_file_info, urls_from_files_info
+from fetch_image_from_url import fetch_image_to_file, ImageHashMismatch
+
+FORMATS = ('avif', 'webp', 'jxl', 'original')
+# 元画像(FileInfo.nameの拡張子)のディレクトリ。avif/webp以外のdirと同じくurl_from_hashで組み立てる
+ORIGINAL_DIR = 'images'
+
+@dataclass(frozen=True)
+class FormatPolicy:
+    """
+    ページごとに試す画像形式の順。FileInfoが持たない形式(has_avif/has_jxlが0)は飛ばす。
+    webpはurl_from_file_infoと同じく常にあるものとして扱い、元画像もFileInfo.nameの拡張子で常に試せる
+    """
+    preference: tuple[str, ...] = ('avif', 'webp')
+    # 取得に失敗した(404など)ら次の形式を試す
+    fallback: bool = True
+
+    def __post_init__(self) -> None:
+        unknown = [image_format for image_format in self.preference if image_format not in FORMATS]
+        if unknown or not self.preference:
+            raise ValueError(f'invalid format preference: {self.preference} (choose from {FORMATS})')
+
+    @classmethod
+    def named(cls, name: str) -> 'FormatPolicy':
+        try:
+            return FORMAT_POLICIES[name]
+        except KeyError:
+            raise ValueError(f'unknown format policy: {name} (choose from {tuple(FORMAT_POLICIES)})') from None
+
+    def candidates(self, file_info: FileInfo) -> list[str]:
+        available = [image_format for image_format in self.preference if is_available(file_info, image_format)]
+        #FileInfoにない形式しか指定されていなければ、最初の形式を試す(取得できなければそのページは失敗)
+        available = available or [self.preference[0]]
+        return available if self.fallback else available[:1]
+
+FORMAT_POLICIES: dict[str, FormatPolicy] = {
+    # 変更前のurl_from_file_infoと同じ(avifがあればavif、なければwebp)
+    'default': FormatPolicy(('avif', 'webp')),
+    # 通信量を抑える。一般にavif < webp < jxl < 元画像
+    'smallest': FormatPolicy(('avif', 'webp', 'jxl', 'original')),
+    # 保存用。元画像のみで、失敗しても別の形式に置き換えない
+    'original': FormatPolicy(('original',), fallback=False),
+    # jxlがあればjxl、なければ小さい順
+    'jxl': FormatPolicy(('jxl', 'avif', 'webp', 'original')),
+}
+
+def is_available(file_info: FileInfo, image_format: str) -> bool:
+    if image_format == 'avif':
+        return bool(file_info.has_avif)
+    if image_format == 'jxl':
+        return bool(file_info.has_jxl)
+    return True
+
+#画像形式ごとのurl(元画像はFileInfo.nameの拡張子)
+def format_url(gallery_id: int, file_info: FileInfo, gg: GGJs|GGJsProvider|None, image_format: str) -> str:
+    if image_format == 'original':
+        return url_from_file_info(gallery_id, file_info, gg, ORIGINAL_DIR, file_info.name.split('.')[-1])
+    return url_from_file_info(gallery_id, file_info, gg, image_format)
+
+@dataclass
+class FormatStats:
+    """画像形式ごとの保存数・バイト数と、失敗して次の形式に切り替えた回数"""
+    files: dict[str, int] = field(default_factory=dict)
+    bytes: dict[str, int] = field(default_factory=dict)
+    failures: dict[str, int] = field(default_factory=dict)
+    fallbacks: int = 0
+
+    def summary(self) -> str:
+        per_format = ', '.join(f'{image_format}: {self.files[image_format]} files ({self.bytes[image_format] / 2**20:.1f} MB)' for image_format in FORMATS if image_format in self.files)
+        return f'{per_format or "no files"}, fallbacks: {self.fallbacks}'
+
+class FormatNegotiator():
+    """
+    FormatPolicyの順にページの画像形式を選び、取得に失敗したら次の形式で取得し直す。
+    save_all_image_data_from_idやdownload_galleriesにformat_negotiatorとして渡すと、ページのurlと保存先はこれで決まる
+    """
+    def __init__(self, policy: FormatPolicy|str|None=None) -> None:
+        """
+        Args:
+            policy (FormatPolicy|str|None): 形式の優先順位。文字列ならFORMAT_POLICIESの名前 Defaults to None ('default').
+        """
+        self.policy = FormatPolicy.named(policy or 'default') if policy is None or isinstance(policy, str) else policy
+        self.stats = FormatStats()
+        self._lock = threading.Lock()
+
+    def page_variants(self, gallery_id: int, files_info: Sequence[FileInfo], gg: GGJs|GGJsProvider|None=None) -> list[list[tuple[str, str]]]:
+        """ページごとに、試す順の(画像形式, url)のリストを作成する
+        avif/webp/jxlは作品全体でまとめて作成し(urls_from_files_info)、元画像だけファイルごとの拡張子で作成する
+        """
+        gg = resolve_gg(gg)
+        formats = [image_format for image_format in self.policy.preference if image_format != 'original']
+        format_urls = {image_format: urls_from_files_info(gallery_id, files_info, gg, image_format) for image_format in formats}
+        variants_list: list[list[tuple[str, str]]] = []
+        for index, file_info in enumerate(files_info):
+            variants = []
+            for image_format in self.policy.candidates(file_info):
+                url = format_urls[image_format][index] if image_format in format_urls else format_url(gallery_id, file_info, gg, image_format)
+                variants.append((image_format, url))
+            variants_list.append(variants)
+        return variants_list
+
+    def _count(self, counter: dict[str, int], image_format: str, value: int=1) -> None:
+        with self._lock:
+            counter[image_format] = counter.get(image_format, 0) + value
+
+    def fetch_to_file(self, gallery_id: int, variants: Sequence[tuple[str, str, str]], file_hash: str|None=None, fetch: Callable[[int, str, str, str|None], str]=fetch_image_to_file) -> str:
+        """(画像形式, url, 保存先)を順に試し、最初に取得できたものの保存先を返す
+
+        Args:
+            gallery_id (int): 作品id
+            variants (Sequence[tuple[str, str, str]]): 試す順の(画像形式, url, 保存先)
+            file_hash (str|None): 指定すると元画像の場合のみSHA-256を照合する Defaults to None.
+            fetch (Callable): 取得する関数(RateController.fetch_image_to_fileなど) Defaults to fetch_image_to_file.
+
+        Raises:
+            Exception: すべての形式で失敗した場合は最後の形式のエラー
+
+        Returns:
+            str: 保存先
+        """
+        for attempt, (image_format, url, save_path) in enumerate(variants):
+            try:
+                fetch(gallery_id, url, save_path, file_hash if image_format == 'original' else None)
+            except (requests.RequestException, ImageHashMismatch) as e:
+                self._count(self.stats.failures, image_format)
+                if attempt == len(variants) - 1:
+                    raise e
+                with self._lock:
+                    self.stats.fallbacks += 1
+                metrics.inc('format_fallback_total', format=image_format)
+                continue
+            self._count(self.stats.files, image_format)
+            self._count(self.stats.bytes, image_format, os.path.getsize(save_path))
+            return save_path
+        raise ValueError(f'no image format to fetch for gallery {gallery_id}')
+
+def test(page_num: int=20) -> None:
+    """avifが404になるページはwebpで保存され、形式ごとのバイト数が記録されることを確認する"""
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id
+    # __main__として実行された場合もfetcherと同じモジュールに通知先を登録する
+    import metrics
+
+    gg = parse_gg(synthetic_gg_js())
+    gallery_id = 1
+    gallery_info = gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, page_num))
+    files_info = gallery_info.files_info
+    # 変更前のurl選択と一致すること
+    assert [variants[0][1] for variants in FormatNegotiator().page_variants(gallery_id, files_info, gg)] == urls_from_files_info(gallery_id, files_info, gg)
+    assert all(url.endswith('.png') and f'/{ORIGINAL_DIR}/' in url for (_, url), in FormatNegotiator('original').page_variants(gallery_id, files_info, gg))
+
+    # avifは半分のページで404、webpは2KiB、元画像は8KiB
+    missing_avif = {file_info.hash for file_info in files_info[::2]}
+    def fallback(path: str) -> tuple[int, bytes, dict[str, str]]|None:
+        file_hash, ext = os.path.splitext(os.path.basename(path))
+        if ext == '.avif':
+            return None if file_hash in missing_avif else (200, b'a' * 1024, {})
+        return (200, b'w' * 2048, {}) if ext == '.webp' else (200, b'o' * 8192, {})
+    with StubServer(fallback=fallback) as server, tempfile.TemporaryDirectory() as save_dir:
+        http_session.configure_transport(url_rewriter=server.rewrite_url)
+        try:
+            negotiator = FormatNegotiator('smallest')
+            messages: list[tuple[str, str]] = []
+            class MessageObserver(metrics.Observer):
+                def on_message(self, level: str, message: str) -> None:
+                    messages.append((level, message))
+            previous = metrics.set_observers(MessageObserver())
+            try:
+                save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, format_negotiator=negotiator)
+            finally:
+                metrics.set_observers(*previous)
+            # webpで取得できたavifの404はエラーとして報告しない
+            assert messages and all(level == 'debug' for level, _ in messages), messages
+            avif_num = sum(1 for file_info in files_info if file_info.has_avif and file_info.hash not in missing_avif)
+            assert negotiator.stats.files == {'avif': avif_num, 'webp': page_num - avif_num}, negotiator.stats
+            assert negotiator.stats.bytes['webp'] == (page_num - avif_num) * 2048
+            assert negotiator.stats.fallbacks == sum(1 for file_info in files_info if file_info.has_avif and file_info.hash in missing_avif)
+            print(negotiator.stats.summary())
+            # 再実行時は保存済みの形式を見つけてリクエストしない
+            server.reset_counts()
+            os.remove(next(entry.path for entry in os.scandir(next(os.scandir(save_dir)).path) if entry.name.endswith('.manifest.json')))
+            save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, format_negotiator=FormatNegotiator('smallest'))
+            assert server.request_count == 0, server.request_count
+
+            negotiator = FormatNegotiator('original')
+            with tempfile.TemporaryDirectory() as original_dir:
+                save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=original_dir, format_negotiator=negotiator)
+            assert negotiator.stats.files == {'original': page_num} and negotiator.stats.bytes == {'original': page_num * 8192}
+            print(negotiator.stats.summary())
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,387 @@
+"""
+ダウンロード処理の計測値・メッセージ・進捗を、登録したObserverへ通知する。
+既定ではConsoleObserver(メッセージをprint、進捗をtqdmで表示)だけが登録されている。
+計測値はon_metricを上書きした通知先(MetricsRegistryなど)がある場合だけ作られる。既定のConsoleObserverだけなら
+inc・observeは最初の判定だけで戻り、enabled()がFalseなので時間の計測も省かれる(メッセージ・進捗は表示される)
+
+通知される主な計測値(labelsはキーワード引数):
+    カウンタ
+        http_requests_total{host, status}       リクエスト数(ステータスごと)
+        http_errors_total{host, error}          接続エラー・タイムアウト・リトライ上限
+        http_retries_total{host}                urllib3が再試行した回数
+        gg_refresh_total                        GGJsProviderがgg.jsを取得し直した回数
+        gallery_cache_total{result}             GalleryCacheのhit/revalidated/miss
+        content_store_total{result}             ContentStoreのhit(リクエスト不要)/stored
+        rate_control_throttled_total{host}      RateControllerが429/5xxを受けた回数
+        format_fallback_total{format}           FormatNegotiatorが次の形式に切り替えた回数
+    ヒストグラム
+        http_connect_seconds{host}              DNS解決+TCP接続(新規接続のみ)
+        http_tls_seconds{host}                  TLSハンドシェイク(新規接続のみ)
+        http_ttfb_seconds{host}                 送信からレスポンスヘッダ受信まで
+        http_request_seconds{host}              http_get全体(streamでなければ本文の受信まで)
+        image_transfer_seconds{host}            stream時の本文の受信・書き込み
+        image_size_bytes{host}                  画像のバイト数(_sumが合計の転送量)
+        disk_write_seconds                      画像のファイル書き込み
+"""
+import json
+import bisect
+import threading
+from tqdm import tqdm
+from typing import Any
+
+class Observer():
+    """
+    計測値・メッセージ・進捗を受け取るインターフェース。必要なメソッドだけ上書きしてadd_observerで登録する。
+    on_metricを上書きしていなければ計測値は通知されない(計測そのものを省く)。
+    複数のスレッドから同時に呼ばれる
+    """
+    def on_metric(self, kind: str, name: str, value: float, labels: dict[str, str]) -> None:
+        """kindは'counter'(valueだけ増やす)か'histogram'(valueを1件記録する)"""
+        pass
+
+    def on_message(self, level: str, message: str) -> None:
+        """levelは'debug'(形式のフォールバック・再試行する失敗など想定内のもの)か'warning'か'error'"""
+        pass
+
+    def on_progress_start(self, progress: 'Progress') -> None:
+        pass
+
+    def on_progress(self, progress: 'Progress', n: int) -> None:
+        """n件完了した(n=0ならtotalが変わっただけ)"""
+        pass
+
+    def on_progress_close(self, progress: 'Progress') -> None:
+        pass
+
+class Progress():
+    """metrics.progressが返す進捗。作成時に登録されていたObserverへ通知する"""
+    def __init__(self, desc: str, total: int|None, unit: str, observers: tuple[Observer, ...]) -> None:
+        self.desc = desc
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self._observers = observers
+        self._lock = threading.Lock()
+        for observer in observers:
+            observer.on_progress_start(self)
+
+    def __enter__(self) -> 'Progress':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def update(self, n: int=1) -> None:
+        if not self._observers:
+            return
+        with self._lock:
+            self.done += n
+        for observer in self._observers:
+            observer.on_progress(self, n)
+
+    def add_total(self, n: int) -> None:
+        """件数が後から分かる場合(download_galleriesで作品情報を取得するたび)に増やす"""
+        if not self._observers:
+            return
+        with self._lock:
+            self.total = (self.total or 0) + n
+        for observer in self._observers:
+            observer.on_progress(self, 0)
+
+    def close(self) -> None:
+        observers, self._observers = self._observers, ()
+        for observer in observers:
+            observer.on_progress_close(self)
+
+class ConsoleObserver(Observer):
+    """変更前と同じ表示(メッセージはprint、進捗はtqdm)。計測値は表示しない"""
+    def __init__(self) -> None:
+        self._bars: dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+    def on_message(self, level: str, message: str) -> None:
+        #想定内の失敗(debug)は表示しない
+        if level == 'debug':
+            return
+        print(message)
+
+    def on_progress_start(self, progress: Progress) -> None:
+        with self._lock:
+            self._bars[id(progress)] = tqdm(total=progress.total, desc=progress.desc, unit=progress.unit)
+
+    def on_progress(self, progress: Progress, n: int) -> None:
+        bar = self._bars.get(id(progress))
+        if bar is None:
+            return
+        if bar.total != progress.total:
+            bar.total = progress.total
+            bar.refresh()
+        if n:
+            bar.update(n)
+
+    def on_progress_close(self, progress: Progress) -> None:
+        with self._lock:
+            bar = self._bars.pop(id(progress), None)
+        if bar is not None:
+            bar.close()
+
+# 秒数のヒストグラム(名前が_secondsで終わるもの)とバイト数のヒストグラム(それ以外)のバケット上限
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = tuple(float(1024 * 4**i) for i in range(9))
+
+class Histogram():
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        # バケットごとの件数(累積ではない)。最後は+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Prometheusのle(以下)ごとの累積件数"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append(('+Inf' if bound == float('inf') else _format_value(bound), total))
+        return result
+
+LabelsKey = tuple[tuple[str, str], ...]
+
+class MetricsRegistry(Observer):
+    """
+    通知された計測値をカウンタ・ヒストグラムとして集計する。add_observerで登録し、
+    to_prometheus(Prometheusのテキスト形式)・to_json()で書き出す
+    """
+    def __init__(self) -> None:
+        self.counters: dict[str, dict[LabelsKey, float]] = {}
+        self.histograms: dict[str, dict[LabelsKey, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def on_metric(self, kind: str, name: str, value: float, labels: dict[str, str]) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if kind == 'counter':
+                series = self.counters.setdefault(name, {})
+                series[key] = series.get(key, 0.0) + value
+            else:
+                histograms = self.histograms.setdefault(name, {})
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = Histogram(LATENCY_BUCKETS if name.endswith('_seconds') else SIZE_BUCKETS)
+                histogram.observe(value)
+
+    def counter(self, name: str, **labels: str) -> float:
+        """labelsを指定しなければ全系列の合計"""
+        with self._lock:
+            series = self.counters.get(name, {})
+            return sum(value for key, value in series.items() if _matches(key, labels))
+
+    def histogram_count(self, name: str, **labels: str) -> int:
+        with self._lock:
+            return sum(histogram.count for key, histogram in self.histograms.get(name, {}).items() if _matches(key, labels))
+
+    def histogram_sum(self, name: str, **labels: str) -> float:
+        with self._lock:
+            return sum(histogram.sum for key, histogram in self.histograms.get(name, {}).items() if _matches(key, labels))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self, namespace: str='hitomi') -> str:
+        lines: list[str] = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                metric = f'{namespace}_{name}' if namespace else name
+                lines.append(f'# TYPE {metric} counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{metric}{_format_labels(key)} {_format_value(value)}')
+            for name, histograms in sorted(self.histograms.items()):
+                metric = f'{namespace}_{name}' if namespace else name
+                lines.append(f'# TYPE {metric} histogram')
+                for key, histogram in sorted(histograms.items()):
+                    for bound, count in histogram.cumulative():
+                        lines.append(f'{metric}_bucket{_format_labels(key + (("le", bound),))} {count}')
+                    lines.append(f'{metric}_sum{_format_labels(key)} {_format_value(histogram.sum)}')
+                    lines.append(f'{metric}_count{_format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                'counters': {name: [{'labels': dict(key), 'value': value} for key, value in sorted(series.items())] for name, series in sorted(self.counters.items())},
+                'histograms': {name: [{'labels': dict(key), 'count': histogram.count, 'sum': histogram.sum, 'buckets': dict(histogram.cumulative())} for key, histogram in sorted(histograms.items())] for name, histograms in sorted(self.histograms.items())},
+            }
+
+    def to_json(self, indent: int|None=None) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=indent)
+
+def _matches(key: LabelsKey, labels: dict[str, str]) -> bool:
+    return all(item in key for item in labels.items())
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+def _format_labels(key: LabelsKey) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape_label(value)}"' for label, value in key) + '}'
+
+#ラベルの値の\と"と改行をエスケープする
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# 通知先。登録・解除のたびにタプルを作り直すので、通知側はロックを取らずに読む
+_observers: tuple[Observer, ...] = ()
+# 通知先のうち計測値を受け取るもの(on_metricを上書きしたもの)
+_metric_observers: tuple[Observer, ...] = ()
+_lock = threading.Lock()
+
+def _set(new_observers: tuple[Observer, ...]) -> None:
+    global _observers, _metric_observers
+    _observers = new_observers
+    _metric_observers = tuple(observer for observer in new_observers if type(observer).on_metric is not Observer.on_metric)
+
+_set((ConsoleObserver(),))
+
+def observers() -> tuple[Observer, ...]:
+    return _observers
+
+def set_observers(*new_observers: Observer) -> tuple[Observer, ...]:
+    """通知先を置き換え、変更前の通知先を返す。引数なしなら計測・表示をすべて止める"""
+    with _lock:
+        previous = _observers
+        _set(tuple(new_observers))
+        return previous
+
+def add_observer(observer: Observer) -> Observer:
+    with _lock:
+        if observer not in _observers:
+            _set(_observers + (observer,))
+    return observer
+
+def remove_observer(observer: Observer) -> None:
+    with _lock:
+        _set(tuple(registered for registered in _observers if registered is not observer))
+
+def enabled() -> bool:
+    """計測値を受け取る通知先があるか。計測値を作るのに手間がかかる場合は、これがFalseなら省略する"""
+    return bool(_metric_observers)
+
+def inc(name: str, value: float=1.0, **labels: str) -> None:
+    if not _metric_observers:
+        return
+    for observer in _metric_observers:
+        observer.on_metric('counter', name, value, labels)
+
+def observe(name: str, value: float, **labels: str) -> None:
+    if not _metric_observers:
+        return
+    for observer in _metric_observers:
+        observer.on_metric('histogram', name, value, labels)
+
+def message(level: str, text: str) -> None:
+    if not _observers:
+        return
+    for observer in _observers:
+        observer.on_message(level, text)
+
+def progress(desc: str, total: int|None=None, unit: str='it') -> Progress:
+    """進捗を作成する。withで使うか、終わったらcloseする"""
+    return Progress(desc, total, unit, _observers)
+
+def test(request_num: int=20) -> None:
+    """スタブサーバーへのリクエストで計測値が集計・書き出しされ、通知先がなければ何も記録されないことを確認する"""
+    import time
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from fetch_image_from_url import fetch_image_from_url, fetch_image_to_file
+    from rate_control import RateController, RateControlConfig
+    # __main__として実行された場合もfetcherと同じモジュールに通知先を登録する
+    import metrics
+
+    image_data = b'\0' * 100 * 1024
+    url = 'https://a1.gold-usergeneratedcontent.net/test.webp'
+    registry = metrics.MetricsRegistry()
+    messages: list[str] = []
+    class MessageObserver(metrics.Observer):
+        def on_message(self, level: str, message: str) -> None:
+            messages.append(f'{level}: {message}')
+    previous = metrics.set_observers(registry, MessageObserver())
+    fail_num = [2]
+    def fallback(path: str) -> tuple[int, bytes, dict[str, str]]|None:
+        #最初の2回は503にしてurllib3に再試行させる
+        if fail_num[0] > 0:
+            fail_num[0] -= 1
+            return (503, b'', {})
+        return (200, image_data, {}) if path.endswith('.webp') else None
+    backoff_factor = http_session.get_config().backoff_factor
+    try:
+        with StubServer(fallback=fallback) as server, tempfile.TemporaryDirectory() as save_dir:
+            http_session.configure_transport(url_rewriter=server.rewrite_url, backoff_factor=0)
+            try:
+                for index in range(request_num):
+                    fetch_image_to_file(1, url, f'{save_dir}/{index}.webp')
+                try:
+                    fetch_image_from_url(1, url.replace('.webp', '.avif'))
+                    raise AssertionError('expected 404')
+                except Exception as e:
+                    if isinstance(e, AssertionError):
+                        raise
+                assert registry.counter('http_requests_total', status='200') == request_num
+                assert registry.counter('http_requests_total', status='404') == 1
+                assert registry.counter('http_retries_total') == 2
+                assert registry.histogram_count('http_ttfb_seconds') == request_num + 1
+                assert 1 <= registry.histogram_count('http_connect_seconds') <= server.connection_count
+                assert registry.histogram_sum('image_size_bytes', host='a1.gold-usergeneratedcontent.net') == request_num * len(image_data)
+                assert registry.histogram_count('disk_write_seconds') > 0
+                assert messages == ['error: Failed to fetch image data'], messages
+                prometheus = registry.to_prometheus()
+                assert 'hitomi_http_requests_total{host="a1.gold-usergeneratedcontent.net",status="200"} 20' in prometheus
+                assert 'hitomi_http_ttfb_seconds_bucket{host="a1.gold-usergeneratedcontent.net",le="+Inf"} 21' in prometheus
+                assert json.loads(registry.to_json())['counters']['http_retries_total'][0]['value'] == 2
+
+                #計測値を受け取る通知先がなければ(既定のConsoleObserverとメッセージだけの通知先)計測しない
+                metrics.set_observers(metrics.ConsoleObserver(), MessageObserver())
+                assert not metrics.enabled()
+                registry.clear()
+                start = time.perf_counter()
+                for index in range(request_num):
+                    fetch_image_to_file(1, url, f'{save_dir}/{index}.webp')
+                disabled = time.perf_counter() - start
+                assert not registry.counters and not registry.histograms
+                metrics.set_observers(registry)
+                start = time.perf_counter()
+                for index in range(request_num):
+                    fetch_image_to_file(1, url, f'{save_dir}/{index}.webp')
+                recorded = time.perf_counter() - start
+            finally:
+                http_session.configure_transport(url_rewriter=None, backoff_factor=backoff_factor)
+        #RateControllerが再試行して取得できた429はエラーとして通知しない
+        messages.clear()
+        metrics.set_observers(registry, MessageObserver())
+        with StubServer(fallback=lambda path: (200, image_data, {}), error_rate=0.3, error_status=429) as server, tempfile.TemporaryDirectory() as save_dir:
+            http_session.configure_transport(url_rewriter=server.rewrite_url)
+            try:
+                rate_controller = RateController(RateControlConfig(backoff_base=0.001))
+                for index in range(request_num):
+                    rate_controller.fetch_image_to_file(1, url, f'{save_dir}/{index}.webp')
+                assert server.error_count > 0
+                assert all(message.startswith('debug: ') for message in messages), messages
+            finally:
+                http_session.configure_transport(url_rewriter=None)
+    finally:
+        metrics.set_observers(*previous)
+    print(prometheus.splitlines()[0], f'... ({len(prometheus.splitlines())} lines)')
+    print(f'{request_num} requests: disabled {disabled * 1000:.1f}ms, recorded {recorded * 1000:.1f}ms')
+
+if __name__ == '__main__':
+    test()
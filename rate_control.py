@@ -0,0 +1,327 @@
+import os
+import time
+import email.utils
+import threading
+import requests
+import metrics
+from collections import deque
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+from fetch_image_from_url import fetch_image_to_file
+
+@dataclass(frozen=True)
+class RateControlConfig:
+    """
+    RateControllerの設定。max_concurrencyとmax_host_rateは上限で、状況が良くてもこれを超えない
+    """
+    initial_concurrency: int = 4
+    min_concurrency: int = 1
+    max_concurrency: int = 32
+    # 1ホストあたりの毎秒のリクエスト数の上限(Noneなら制限しない)。制限されるまではホストごとのレートを設けない
+    max_host_rate: float|None = None
+    min_host_rate: float = 1.0
+    # 制限されたホストのレートを1成功ごとに増やす量(req/s)
+    host_rate_increase: float = 0.5
+    # 429/5xx・レイテンシの急増で同時実行数・ホストのレートに掛ける値
+    decrease_factor: float = 0.5
+    # 平均レイテンシが最小レイテンシのこの倍を超えたら急増とみなす
+    latency_spike_factor: float = 4.0
+    # スループットがこの割合以上改善していれば同時実行数を増やす
+    improvement_threshold: float = 0.05
+    max_retries: int = 8
+    backoff_base: float = 0.5
+    max_backoff: float = 60.0
+    throttle_statuses: tuple[int, ...] = (429, 500, 502, 503, 504)
+
+class AdaptiveConcurrency():
+    """
+    同時実行数をAIMDで調整するセマフォ。
+    同時実行数の2倍の完了を1区間として、スループットが改善していれば増やし(最初に減らすまでは2倍、以降は1ずつ)、
+    429/5xx・レイテンシの急増で減らす(減らした直後の区間では重ねて減らさない)
+    """
+    def __init__(self, config: RateControlConfig) -> None:
+        self.config = config
+        self.limit = float(config.initial_concurrency)
+        self.in_flight = 0
+        self.decrease_count = 0
+        self._condition = threading.Condition()
+        self._min_latency = float('inf')
+        self._window_started = time.monotonic()
+        self._window_done = 0
+        self._window_latency = 0.0
+        self._last_throughput = 0.0
+        self._decreased_in_window = False
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float|None) -> None:
+        """latencyは成功したリクエストの所要時間(失敗ならNone)"""
+        with self._condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self._record(latency)
+            self._condition.notify_all()
+
+    def _record(self, latency: float) -> None:
+        self._min_latency = min(self._min_latency, latency)
+        self._window_done += 1
+        self._window_latency += latency
+        if self._window_done < max(int(self.limit), 1) * 2:
+            return
+        now = time.monotonic()
+        throughput = self._window_done / max(now - self._window_started, 1e-9)
+        average_latency = self._window_latency / self._window_done
+        if average_latency > self._min_latency * self.config.latency_spike_factor:
+            self._decrease()
+        elif not self._decreased_in_window and throughput > self._last_throughput * (1 + self.config.improvement_threshold):
+            increased = self.limit * 2 if self.decrease_count == 0 else self.limit + 1
+            self.limit = min(float(self.config.max_concurrency), increased)
+        self._last_throughput = throughput
+        self._window_started = now
+        self._window_done = 0
+        self._window_latency = 0.0
+        self._decreased_in_window = False
+
+    def _decrease(self, share: float=1.0) -> None:
+        if self._decreased_in_window:
+            return
+        self._decreased_in_window = True
+        self.decrease_count += 1
+        self.limit = max(float(self.config.min_concurrency), self.limit * (1 - (1 - self.config.decrease_factor) * share))
+
+    def on_throttle(self, share: float=1.0) -> None:
+        """shareは制限してきたホストが占める割合。1ホストの429で全ホスト分の同時実行数を半分にしないよう、その割合だけ減らす"""
+        with self._condition:
+            self._decrease(share)
+
+class HostTokenBucket():
+    """
+    ホスト(a1./a2./w1. など)ごとのトークンバケット。
+    制限されるまではレートを設けず、429/5xxを受けると直近1秒のリクエスト数を基準にレートを下げ、成功ごとに少しずつ戻す。
+    同時に送っていたリクエストがまとめて429になることが多いので、レートを下げるのは1秒に1回までにする
+    """
+    def __init__(self, config: RateControlConfig) -> None:
+        self.config = config
+        self.rate: float|None = config.max_host_rate
+        self.tokens = 1.0
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._decreased_at = float('-inf')
+        self._recent: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0 and self.rate is not None:
+                    self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+                if wait <= 0:
+                    if self.rate is not None:
+                        self.tokens -= 1
+                    self._recent.append(now)
+                    while self._recent and self._recent[0] < now - 1.0:
+                        self._recent.popleft()
+                    return
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self.rate is not None:
+                upper = self.config.max_host_rate if self.config.max_host_rate is not None else float('inf')
+                self.rate = min(upper, self.rate + self.config.host_rate_increase)
+
+    def on_throttle(self, retry_after: float|None) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased_at >= 1.0:
+                self._decreased_at = now
+                recent_rate = float(len(self._recent)) if self._recent else self.config.min_host_rate
+                self.rate = max(self.config.min_host_rate, (self.rate if self.rate is not None else recent_rate) * self.config.decrease_factor)
+                self.tokens = min(self.tokens, 0.0)
+                self._updated = now
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+#Retry-Afterヘッダ(秒数またはHTTP-date)を秒数に変換
+def parse_retry_after(value: str|None) -> float|None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+@dataclass
+class RateControlStats:
+    requests: int = 0
+    succeeded: int = 0
+    throttled: int = 0
+    failed: int = 0
+
+class RateController():
+    """
+    画像取得の同時実行数とホストごとのレートを、サーバーの応答に合わせて調整する。
+    save_all_image_data_from_idやdownload_galleriesにrate_controllerとして渡すと、画像の取得はすべてこれを通る
+    """
+    def __init__(self, config: RateControlConfig|None=None) -> None:
+        self.config = config or RateControlConfig()
+        self.concurrency = AdaptiveConcurrency(self.config)
+        self.stats = RateControlStats()
+        self._buckets: dict[str, HostTokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def max_worker(self) -> int:
+        return self.config.max_concurrency
+
+    def bucket(self, url: str) -> HostTokenBucket:
+        host = urlsplit(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = HostTokenBucket(self.config)
+            return bucket
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            setattr(self.stats, field, getattr(self.stats, field) + 1)
+
+    def fetch_image_to_file(self, gallery_id: int, url: str, file_path: str, expected_hash: str|None=None) -> str:
+        """fetch_image_to_fileと同じ引数で、同時実行数・ホストのレートを守って取得する
+        429/5xx・タイムアウトは同時実行数とホストのレートを下げ、Retry-Afterがあればその間ホストへのリクエストを止めてから再試行する
+        """
+        bucket = self.bucket(url)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self.concurrency.acquire()
+            self._count('requests')
+            started = time.monotonic()
+            latency: float|None = None
+            try:
+                #再試行はここで行うので、http_session側ではリトライしない
+                result = fetch_image_to_file(gallery_id, url, file_path, expected_hash, retry_num=0)
+                latency = time.monotonic() - started
+                bucket.on_success()
+                self._count('succeeded')
+                return result
+            except (requests.HTTPError, requests.exceptions.RetryError, requests.ConnectionError, requests.Timeout) as e:
+                response = getattr(e, 'response', None)
+                status = response.status_code if response is not None else None
+                if status is not None and status not in self.config.throttle_statuses:
+                    self._count('failed')
+                    raise e
+                retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+                self._count('throttled')
+                metrics.inc('rate_control_throttled_total', host=urlsplit(url).netloc)
+                self.concurrency.on_throttle(1 / len(self._buckets))
+                bucket.on_throttle(retry_after)
+                if attempt >= self.config.max_retries:
+                    self._count('failed')
+                    raise e
+            finally:
+                self.concurrency.release(latency)
+            #Retry-Afterの間はbucket.acquireで待つ
+            if retry_after is None:
+                time.sleep(min(self.config.max_backoff, self.config.backoff_base * (2 ** attempt)))
+            attempt += 1
+
+def test(page_num: int=60, host_capacity: int=2, retry_after: int=1) -> None:
+    """429とRetry-Afterを返すスタブサーバーで、全ページが保存され、同時実行数が下がり、Retry-Afterの間はホストへのリクエストを止めることを確認する"""
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id
+
+    # Retry-Afterの間はacquireで待つ
+    bucket = HostTokenBucket(RateControlConfig())
+    bucket.on_throttle(0.2)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.2 - 1e-3
+
+    image_data = b'\0' * 1024
+    gallery_id = 1
+    gallery_info = gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, page_num))
+    gg = parse_gg(synthetic_gg_js())
+    config = RateControlConfig(initial_concurrency=16, max_concurrency=16, backoff_base=0.01)
+    rate_controller = RateController(config)
+    #同時実行数の最小値を記録する
+    min_limit = rate_controller.concurrency.limit
+    done = threading.Event()
+    def watch_limit() -> None:
+        nonlocal min_limit
+        while not done.wait(0.005):
+            min_limit = min(min_limit, rate_controller.concurrency.limit)
+    watcher = threading.Thread(target=watch_limit, daemon=True)
+    with StubServer(fallback=lambda path: (200, image_data, {}), latency=0.02, throttle_concurrency=host_capacity, retry_after=retry_after) as server, tempfile.TemporaryDirectory() as save_dir:
+        http_session.configure_transport(url_rewriter=server.rewrite_url, pool_maxsize=16)
+        watcher.start()
+        try:
+            save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, rate_controller=rate_controller)
+        finally:
+            done.set()
+            watcher.join()
+            http_session.configure_transport(url_rewriter=None)
+        gallery_dir = next(os.scandir(save_dir)).path
+        saved = [name for name in os.listdir(gallery_dir) if name.endswith('.webp') or name.endswith('.avif')]
+    assert len(saved) == page_num, len(saved)
+    assert server.throttled_count > 0 and rate_controller.stats.throttled > 0, rate_controller.stats
+    assert rate_controller.stats.failed == 0 and rate_controller.stats.succeeded == page_num, rate_controller.stats
+    assert min_limit < config.max_concurrency, min_limit
+    # 429のRetry-Afterでホストへのリクエストを止めた
+    assert any(bucket.paused_until > 0 for bucket in rate_controller._buckets.values())
+    print(f'{page_num} pages saved, {rate_controller.stats}, min concurrency {min_limit:.0f}/{config.max_concurrency}')
+
+def bench(image_num: int=2000, image_size: int=16*1024, latency: float=0.05, host_capacity: int=6, retry_after: int|None=None) -> None:
+    """ホストごとに同時host_capacity件を超えると429を返すスタブサーバーで、固定ワーカー数とRateControllerを比較する"""
+    import tempfile
+    import http_session
+    from stub_server import StubServer
+    from gallery_info_from_id import gallery_info_from_id, synthetic_gallery_js
+    from url_from_file_info import parse_gg, synthetic_gg_js
+    from hitomi_util import save_all_image_data_from_id, urls_form_id
+
+    image_data = b'\0' * image_size
+    gallery_id = 1
+    gallery_info = gallery_info_from_id(gallery_id, synthetic_gallery_js(gallery_id, image_num))
+    gg = parse_gg(synthetic_gg_js())
+    host_num = len({urlsplit(url).netloc for url in urls_form_id(gallery_id, gallery_info, gg)})
+    with StubServer(fallback=lambda path: (200, image_data, {}), latency=latency, throttle_concurrency=host_capacity, retry_after=retry_after) as server:
+        #スタブサーバーの同時処理数の上限まで使えるよう接続プールを広げる
+        http_session.configure_transport(url_rewriter=server.rewrite_url, pool_maxsize=64)
+        try:
+            for label, max_worker, rate_controller in (('fixed 5', 5, None), ('fixed 32', 32, None), ('adaptive', 5, RateController(RateControlConfig(max_concurrency=32)))):
+                server.reset_counts()
+                with tempfile.TemporaryDirectory() as save_dir:
+                    start = time.perf_counter()
+                    error = ''
+                    try:
+                        save_all_image_data_from_id(gallery_id, gallery_info, gg, save_dir=save_dir, max_worker=max_worker, rate_controller=rate_controller)
+                    except (requests.HTTPError, requests.exceptions.RetryError) as e:
+                        error = f', aborted: {e.response.status_code if e.response is not None else type(e).__name__}'
+                    elapsed = time.perf_counter() - start
+                    saved = sum(1 for name in os.listdir(next(os.scandir(save_dir)).path) if not name.endswith('.json') and not name.endswith('.part'))
+                adaptive = f', final concurrency {rate_controller.concurrency.limit:.0f}, {rate_controller.stats}' if rate_controller is not None else ''
+                print(f'{label}: {saved}/{image_num} images in {elapsed:.2f}s ({saved / elapsed:.1f} images/s), 429: {server.throttled_count}{error}{adaptive}')
+        finally:
+            http_session.configure_transport(url_rewriter=None)
+    print(f'(stub capacity: {host_capacity} concurrent requests x {host_num} hosts)')
+
+if __name__ == '__main__':
+    test()
+    bench()
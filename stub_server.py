@@ -0,0 +1,182 @@
+import re
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Any
+from urllib.parse import urlsplit
+
+# (ステータス, 本文, 追加ヘッダ)
+StubResponse = tuple[int, bytes, dict[str, str]]
+
+class _CountingHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stub: 'StubServer', *args: Any, **kwargs: Any) -> None:
+        self.stub = stub
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        # 1回のprocess_requestが1本の新規TCP接続に対応する
+        with self.stub.lock:
+            self.stub.connection_count += 1
+        super().process_request(request, client_address)
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # keep-aliveを有効にするためHTTP/1.1で応答する
+    protocol_version = 'HTTP/1.1'
+    # ヘッダと本文を別々に書き込むので、Nagleと遅延ACKで応答が40ms遅れないようにする
+    disable_nagle_algorithm = True
+    server: _CountingHTTPServer
+
+    def do_GET(self) -> None:
+        stub = self.server.stub
+        with stub.lock:
+            stub.request_count += 1
+        path = urlsplit(self.path).path
+        #ホスト(rewrite_url後のパスの先頭)ごとの同時処理数がthrottle_concurrencyを超えたら429を返す
+        host = path.split('/', 2)[1] if path.count('/') >= 2 else ''
+        with stub.lock:
+            in_flight = stub.in_flight.get(host, 0) + 1
+            stub.in_flight[host] = in_flight
+        try:
+            if stub.throttle_concurrency is not None and in_flight > stub.throttle_concurrency:
+                with stub.lock:
+                    stub.throttled_count += 1
+                headers = {'Retry-After': str(stub.retry_after)} if stub.retry_after is not None else {}
+                self._send(429, b'Too Many Requests', headers)
+                return
+            if stub.error_rate and stub.should_fail():
+                self._send(stub.error_status, b'Service Unavailable', {})
+                return
+            if stub.latency:
+                time.sleep(stub.latency)
+            self._respond(stub, path)
+        finally:
+            with stub.lock:
+                stub.in_flight[host] -= 1
+
+    def _respond(self, stub: 'StubServer', path: str) -> None:
+        response = stub.routes.get(path)
+        if response is None and stub.fallback is not None:
+            response = stub.fallback(path)
+        if response is None:
+            response = (404, b'Not Found', {})
+        status, body, headers = response
+        range_match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if status == 200 and range_match:
+            start = int(range_match.group(1))
+            if start >= len(body):
+                status, body, headers = 416, b'', {}
+            else:
+                status, body, headers = 206, body[start:], {**headers, 'Content-Range': f'bytes {start}-{len(body)-1}/{len(body)}'}
+        if status in (200, 206) and stub.drop_rate and stub.should_drop():
+            #Content-Lengthは全体のまま本文の半分で接続を切る
+            self._send(status, body, headers, truncate_at=len(body) // 2)
+            self.close_connection = True
+            return
+        self._send(status, body, headers)
+
+    def _send(self, status: int, body: bytes, headers: dict[str, str], truncate_at: int|None=None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if truncate_at is not None:
+            body = body[:truncate_at]
+        bandwidth = self.server.stub.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        #帯域を制限する場合は64KiBずつ、その転送時間だけ待ってから書き込む
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            time.sleep(len(chunk) / bandwidth)
+            self.wfile.write(chunk)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+class StubServer():
+    """
+    テスト・ベンチマーク用のローカルHTTPサーバー。
+    rewrite_urlで https://{host}/{path} を http://127.0.0.1:{port}/{host}/{path} に差し替えて使う
+    """
+    def __init__(self, fallback: Callable[[str], StubResponse|None]|None=None, latency: float=0.0, throttle_concurrency: int|None=None, retry_after: int|None=None, bandwidth: float|None=None, error_rate: float=0.0, error_status: int=503, drop_rate: float=0.0, seed: int=0) -> None:
+        self.routes: dict[str, StubResponse] = {}
+        self.fallback = fallback
+        # 各リクエストへの応答を遅らせる秒数
+        self.latency = latency
+        # ホストごとの同時処理数の上限(超えた分は429)と、429に付けるRetry-Afterの秒数(整数)
+        self.throttle_concurrency = throttle_concurrency
+        self.retry_after = retry_after
+        # 1応答あたりの転送速度(bytes/s)。Noneなら制限しない
+        self.bandwidth = bandwidth
+        # この割合のリクエストにerror_statusを返す(seedで再現できる)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # この割合の応答は本文の途中で接続を切る(受信途中の切断と続きからの取得のテスト用)
+        self.drop_rate = drop_rate
+        self._rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connection_count = 0
+        self.request_count = 0
+        self.throttled_count = 0
+        self.error_count = 0
+        self.dropped_count = 0
+        self.in_flight: dict[str, int] = {}
+        self._server = _CountingHTTPServer(self, ('127.0.0.1', 0), _StubHandler)
+        self._thread: threading.Thread|None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add_route(self, path: str, body: bytes, status: int=200, headers: dict[str, str]|None=None) -> None:
+        self.routes[path] = (status, body, headers or {})
+
+    def rewrite_url(self, url: str) -> str:
+        parts = urlsplit(url)
+        return f'{self.base_url}/{parts.netloc}{parts.path}'
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.error_count += 1
+            return failed
+
+    def should_drop(self) -> bool:
+        with self.lock:
+            dropped = self._rng.random() < self.drop_rate
+            if dropped:
+                self.dropped_count += 1
+            return dropped
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.connection_count = 0
+            self.request_count = 0
+            self.throttled_count = 0
+            self.error_count = 0
+            self.dropped_count = 0
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'StubServer':
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
@@ -1,10 +1,13 @@
 import re
+import math
+import random
 import time
+import threading
 import requests
-from typing import Callable
-from dateutil.parser import parse
-from dateutil.tz import tzutc
-from gallery_info_from_id import FileInfo
+import metrics
+from typing import Callable, Iterable, Sequence
+from gallery_info_from_id import FileInfo, parse_expires
+from http_session import http_get
 
 class GGJsIsExpire(Exception):
     def __str__(self):
@@ -15,26 +18,49 @@ class GGJs():
     画像データのurl取得に必要なgg.jsをparseしたもの。
     取得したgg.jsはサーバーから提示されたExpireで期限切れとなる
     """
-    def __init__(self, b_value: str, s_func: Callable[[str], str], m_func: Callable[[int], int], is_expire: Callable[[float], None]) -> None:
+    def __init__(self, b_value: str, s_func: Callable[[str], str], m_func: Callable[[int], int], m_cases: frozenset[int]=frozenset(), m_default: int=0, m_assigned: int=0, expires_at: float=math.inf) -> None:
         self.b_value = b_value
         self.s_func = s_func
         self.m_func = m_func
-        self.is_expire = is_expire
+        # m関数の判定表(gg.jsから一度だけ抽出した不変の値)
+        self.m_cases = m_cases
+        self.m_default = m_default
+        self.m_assigned = m_assigned
+        # 期限のunix時間(Expiresヘッダのparseは取得時に一度だけ行う)
+        self.expires_at = expires_at
+
+    def is_expired(self, current_unix_time: float) -> bool:
+        return current_unix_time >= self.expires_at
+
+    def is_expire(self, current_unix_time: float) -> None:
+        """
+        期限切れならエラーをraise(期限はexpires_atだけで判定する)
+        """
+        if self.is_expired(current_unix_time):
+            raise GGJsIsExpire()
 
 # gg.jsオブジェクトのパース関数
-def parse_gg() -> GGJs:
+def parse_gg(test_js_text: str|None=None) -> GGJs:
     """
     画像データのurl取得に必要なgg.jsをparseする関数。
     取得したgg.jsはサーバーから提示されたExpireで期限切れとなる
+
+    Args:
+        test_js_text (str | None, optional): 特定のgg.jsを文字列として渡しテストを行う. Defaults to None.
     """
-    gg_url = 'https://ltn.gold-usergeneratedcontent.net/gg.js'
-    try:
-        response = requests.get(gg_url)
-        response.raise_for_status() #<---- ここで止まる
-    except requests.HTTPError as e:
-        print(f'Failed to fetch gg.js\n{e}')
-        raise e
-    js_code = response.text
+    response: requests.Response|None = None
+    if test_js_text is None:
+        gg_url = 'https://ltn.gold-usergeneratedcontent.net/gg.js'
+        try:
+            response = http_get(gg_url)
+            response.raise_for_status() #<---- ここで止まる
+        except requests.HTTPError as e:
+            metrics.message('error', f'Failed to fetch gg.js\n{e}')
+            raise e
+        #response.textと同じくcharsetに従うが、charsetがない場合は文字コードを推定せずutf-8として読む
+        js_code = response.content.decode(response.encoding or 'utf-8', errors='replace')
+    else:
+        js_code = test_js_text
     
     # b の抽出
     b_match = re.search(r"b:\s*'([^']+)'", js_code)
@@ -43,55 +69,141 @@ def parse_gg() -> GGJs:
     b_value = b_match.group(1)
     
     # s 関数の定義
+    s_pattern = re.compile(r'(..)(.)$')
     def gg_s(h: str) -> str:
-        m = re.search(r'(..)(.)$', h)
+        m = s_pattern.search(h)
         if m:
             return str(int(m.group(2) + m.group(1), 16))
         else:
             raise ValueError("Invalid hash format")    
     
+    # m 関数に必要な値はここで一度だけ抽出する(画像ごとにgg.js全体を走査しない)
+    # m のケースの抽出
+    m_cases = frozenset(int(case) for case in re.findall(r"case (\d+):", js_code))
+    
+    # m関数に必要なoの抽出
+    initial_o_match = re.search(r"var o = (\d+);", js_code)
+    if initial_o_match is None:
+        raise ValueError('initial o value not found in gg.js')
+    m_default = int(initial_o_match.group(1))
+    
+    assigned_o_match = re.search(r"case \d+:\s*(?:case \d+:\s*)*o = (\d+);", js_code)
+    if assigned_o_match is None:
+        raise ValueError('assigned o value not found in gg.js')
+    m_assigned = int(assigned_o_match.group(1))
+    
     # m 関数の定義
     def gg_m(g: int) -> int:
-        # m のケースの抽出
-        m_cases = re.findall(r"case (\d+):", js_code)
-        m_cases = [int(case) for case in m_cases]
-        
-        # m関数に必要なoの抽出
-        initial_o_match = re.search(r"var o = (\d+);", js_code)
-        initial_o_value = int(initial_o_match.group(1)) if initial_o_match else None
-        if initial_o_value is None:
-            raise ValueError('initial o value not found in gg.js')
-        
-        assigned_o_match = re.search(r"case \d+:\s*(?:case \d+:\s*)*o = (\d+);", js_code)
-        assigned_o_value = int(assigned_o_match.group(1)) if assigned_o_match else None
-        if assigned_o_value is None:
-            raise ValueError('assigned o value not found in gg.js')
-        o = initial_o_value
-        if (g in m_cases):
-            o = assigned_o_value
-        return o
+        return m_assigned if g in m_cases else m_default
     
-    # gg オブジェクトの期限unix時間を取得、比較
-    def is_expire(current_unix_time: float) -> None:
-        """
-        期限切れならエラーをraise 
-        """
+    # gg オブジェクトの期限unix時間を取得(テスト用のgg.jsは期限切れにならない)
+    expires_at = math.inf
+    if response is not None:
         try:
-            time_str_may_be_gmt = response.headers['Expires']
-            parsed_datetime = parse(time_str_may_be_gmt)
-            utc_datetime = parsed_datetime.astimezone(tzutc())
-            expire_unix_time = utc_datetime.timestamp()
+            expires_at = parse_expires(response.headers['Expires'])
         except Exception as e:
-            print('Failed to parse expire timestamp of gg.js')
+            metrics.message('error', 'Failed to parse expire timestamp of gg.js')
             raise e
-        if current_unix_time >= expire_unix_time:
-            raise GGJsIsExpire()
     
     # gg オブジェクトの作成
-    gg_js = GGJs(b_value=b_value, s_func=gg_s, m_func=gg_m, is_expire=is_expire)
+    gg_js = GGJs(b_value=b_value, s_func=gg_s, m_func=gg_m, m_cases=m_cases, m_default=m_default, m_assigned=m_assigned, expires_at=expires_at)
     
     return gg_js
 
+class GGJsProvider():
+    """
+    常に期限内のGGJsを返すスレッドセーフな提供元。
+    Expiresのrefresh_margin秒前になると取得し直す。取得は1スレッドだけが行い(single-flight)、
+    その間、他のスレッドは期限内なら古いGGJsを、期限切れなら取得完了を待って新しいGGJsを受け取る
+    """
+    def __init__(self, fetch: Callable[[], GGJs]|None=None, refresh_margin: float=60.0, gg: GGJs|None=None, refresh_fraction: float=0.5, failure_cooldown: float=10.0) -> None:
+        """
+        Args:
+            fetch (Callable[[], GGJs]|None): gg.jsを取得する関数。指定しない場合はparse_gg Defaults to None.
+            refresh_margin (float): Expiresの何秒前から取得し直すか Defaults to 60.0.
+            gg (GGJs|None): 最初に使うGGJs Defaults to None.
+            refresh_fraction (float): 有効期間が短い場合、refresh_marginを有効期間のこの割合までに抑える Defaults to 0.5.
+            failure_cooldown (float): 先行取得に失敗した後、期限内のGGJsがあれば取得し直さない秒数 Defaults to 10.0.
+        """
+        self._fetch = fetch or parse_gg
+        self.refresh_margin = refresh_margin
+        self.refresh_fraction = refresh_fraction
+        self.failure_cooldown = failure_cooldown
+        #(GGJs, 取得し直すunix時間)を1つのtupleで持ち、ロックなしでも組み合わせが食い違わないようにする
+        self._state: tuple[GGJs|None, float] = (gg, self._refresh_at(gg, time.time()) if gg is not None else -math.inf)
+        self._refreshing = False
+        self._condition = threading.Condition()
+        self.refresh_count = 0
+
+    @staticmethod
+    def _is_valid(gg: GGJs|None, unix_time: float) -> bool:
+        return gg is not None and not gg.is_expired(unix_time)
+
+    def _refresh_at(self, gg: GGJs, fetched_at: float) -> float:
+        #Expiresまでがrefresh_marginより短くても、取得直後から毎回取得し直さないようにする
+        margin = min(self.refresh_margin, max(gg.expires_at - fetched_at, 0.0) * self.refresh_fraction)
+        return gg.expires_at - margin
+
+    def get(self) -> GGJs:
+        gg, refresh_at = self._state
+        now = time.time()
+        if gg is not None and now < refresh_at:
+            return gg
+        with self._condition:
+            while True:
+                gg, refresh_at = self._state
+                if gg is not None and now < refresh_at:
+                    return gg
+                if not self._refreshing:
+                    self._refreshing = True
+                    break
+                #他のスレッドが取得中。期限内なら古いものを使い、期限切れなら完了を待つ
+                if self._is_valid(gg, now):
+                    return gg # type: ignore
+                self._condition.wait()
+                now = time.time()
+        try:
+            new_gg = self._fetch()
+        except Exception as e:
+            failed_at = time.time()
+            keep_current = self._is_valid(gg, failed_at)
+            with self._condition:
+                if keep_current:
+                    #failure_cooldownの間は取得し直さない(期限を過ぎたら待たずに取得する)
+                    self._state = (gg, min(failed_at + self.failure_cooldown, gg.expires_at)) # type: ignore
+                self._refreshing = False
+                self._condition.notify_all()
+            #先行取得に失敗しただけなら期限内のものを使い続ける
+            if keep_current:
+                metrics.message('warning', f'Failed to refresh gg.js, keep using current one\n{e}')
+                return gg # type: ignore
+            raise e
+        with self._condition:
+            self._state = (new_gg, self._refresh_at(new_gg, time.time()))
+            self.refresh_count += 1
+            self._refreshing = False
+            self._condition.notify_all()
+        metrics.inc('gg_refresh_total')
+        return new_gg
+
+_default_gg_provider: GGJsProvider|None = None
+_default_gg_provider_lock = threading.Lock()
+
+#ggを指定しない場合に全体で共有するGGJsProvider
+def default_gg_provider() -> GGJsProvider:
+    global _default_gg_provider
+    with _default_gg_provider_lock:
+        if _default_gg_provider is None:
+            _default_gg_provider = GGJsProvider()
+        return _default_gg_provider
+
+def resolve_gg(gg: 'GGJs|GGJsProvider|None') -> GGJs:
+    if gg is None:
+        gg = default_gg_provider()
+    if isinstance(gg, GGJsProvider):
+        return gg.get()
+    return gg
+
 # 定数の定義
 domain2 = 'gold-usergeneratedcontent.net'
 
@@ -136,19 +248,236 @@ def url_from_url(url: str, gg: GGJs, dir: str, base: str|None) -> str:
     subdomain = subdomain_from_url(url, gg, dir, base)
     return re.sub(r'//..?\.(?:gold-usergeneratedcontent\.net|hitomi\.la)/', f'//{subdomain}.{domain2}/', url)
 
-def url_from_file_info(gallery_id: int, file_info: FileInfo, gg: GGJs|None=None,  dir: str|None=None, ext: str|None=None, base: str|None=None) -> str:
-    if gg is None:
-        gg = parse_gg()
+def url_from_file_info(gallery_id: int, file_info: FileInfo, gg: GGJs|GGJsProvider|None=None,  dir: str|None=None, ext: str|None=None, base: str|None=None) -> str:
+    #GGJsProvider(省略時は共有のもの)からは常に期限内のGGJsを受け取る
+    gg = resolve_gg(gg)
     if dir is None:
         dir = "avif" if file_info.has_avif else "webp"
 
     if base == 'tn':
         url_by_url_from_url = url_from_url(f'https://a.{domain2}/{dir}/{full_path_from_hash(file_info.hash, gg)}.{ext}', gg, base, dir)
         #gg.js の期限確認
-        gg.is_expire(time.time())
+        if gg.is_expired(time.time()):
+            raise GGJsIsExpire()
         return url_by_url_from_url
     
     url_by_url_from_url = url_from_url(url=url_from_hash(gallery_id=gallery_id, file_info=file_info, gg=gg, dir=dir, ext=ext), gg=gg, base=base, dir=dir)
     #gg.js の期限確認
+    if gg.is_expired(time.time()):
+        raise GGJsIsExpire()
+    return url_by_url_from_url
+
+_hex_chars = '0123456789abcdef'
+_long_hex_pattern = re.compile(r'[0-9a-f]{61}')
+
+def _subdomain_from_g(m_value: int, dir: str|None, base: str|None) -> str:
+    # subdomain_from_urlと同じ規則を、URLを正規表現で探さずにm(g)の値から組み立てる
+    if base:
+        return chr(97 + m_value) + base
+    retval = ''
+    if dir == 'webp':
+        retval = 'w'
+    elif dir == 'avif':
+        retval = 'a'
+    return retval + str(1 + m_value)
+
+def _urls_from_files_info(gallery_id: int, files_info: Iterable[FileInfo], gg: GGJs, variants: Sequence[tuple[str|None, str|None, str|None]]) -> list[list[str]]:
+    # variantsは(dir, ext, base)の組
+    # gg.jsのs関数・m関数はハッシュ末尾3文字(最大4096通り)だけで決まるので、末尾ごとに一度だけ計算する
+    b_value = gg.b_value
+    s_func = gg.s_func
+    m_func = gg.m_func
+    tail_cache: dict[str, tuple[str, int]] = {}
+    # variantごと、dirごとのサブドメイン(m(g)の値から決まる)
+    subdomain_caches: list[dict[str, dict[int, str]]] = [{} for _ in variants]
+    # b_valueやdirにハッシュと誤認される16進の並びがある場合は、ファイルごとの関数に任せる
+    can_derive = not any(_long_hex_pattern.search(f'{b_value}/{dir or ""}') for dir, _, _ in variants)
+    urls_list: list[list[str]] = [[] for _ in variants]
+    jobs = list(zip(urls_list, variants, subdomain_caches))
+    for file_info in files_info:
+        hash = file_info.hash
+        if not can_derive or len(hash) != 64 or hash.strip(_hex_chars):
+            for urls, (dir, ext, base) in zip(urls_list, variants):
+                urls.append(url_from_file_info(gallery_id, file_info, gg, dir, ext, base))
+            continue
+        tail = hash[61:]
+        cached = tail_cache.get(tail)
+        if cached is None:
+            cached = tail_cache[tail] = (b_value + s_func(hash) + '/', m_func(int(hash[63] + hash[61:63], 16)))
+        path_prefix, m_value = cached
+        for urls, (dir, ext, base), subdomain_cache in jobs:
+            file_dir = dir if dir is not None else ('avif' if file_info.has_avif else 'webp')
+            subdomains = subdomain_cache.get(file_dir)
+            if subdomains is None:
+                subdomains = subdomain_cache[file_dir] = {}
+            subdomain = subdomains.get(m_value)
+            if subdomain is None:
+                # url_from_file_infoと同じく、サムネイル(base='tn')ではdirとbaseを入れ替えてサブドメインを求める
+                subdomain = subdomains[m_value] = _subdomain_from_g(m_value, base, file_dir) if base == 'tn' else _subdomain_from_g(m_value, file_dir, base)
+            if base == 'tn':
+                urls.append(f'https://{subdomain}.{domain2}/{file_dir}/{path_prefix}{hash}.{ext}')
+            elif file_dir == 'webp' or file_dir == 'avif':
+                urls.append(f'https://{subdomain}.{domain2}/{path_prefix}{hash}.{file_dir if ext is None else ext}')
+            else:
+                file_ext = ext if ext is not None else (file_dir if file_dir else file_info.name.split('.')[-1])
+                urls.append(f'https://{subdomain}.{domain2}/{file_dir}/{path_prefix}{hash}.{file_ext}')
+    #gg.js の期限確認(まとめて一度だけ)
+    if gg.is_expired(time.time()):
+        raise GGJsIsExpire()
+    return urls_list
+
+def urls_from_files_info(gallery_id: int, files_info: Iterable[FileInfo], gg: GGJs|GGJsProvider|None=None, dir: str|None=None, ext: str|None=None, base: str|None=None) -> list[str]:
+    """url_from_file_infoを作品全体に対して一度に行う。結果はurl_from_file_infoと完全に一致する
+    組み立てたURLを正規表現で探し直さず、FileInfo.hashの末尾3文字から直接サブドメインを求め、期限確認はまとめて一度だけ行う
+
+    Args:
+        gallery_id (int): 作品id
+        files_info (Iterable[FileInfo]): 作品のファイル情報
+        gg (GGJs|GGJsProvider|None): gg.jsをparseしたオブジェクト。指定しない場合は共有のGGJsProvider Defaults to None.
+        dir (str|None): url_from_file_infoのdir。指定しない場合はファイルごとにavif/webp Defaults to None.
+        ext (str|None): url_from_file_infoのext Defaults to None.
+        base (str|None): url_from_file_infoのbase(サムネイルは'tn') Defaults to None.
+
+    Raises:
+        GGJsIsExpire: gg.jsの期限切れ
+
+    Returns:
+        list[str]: files_infoと同じ順のurl
+    """
+    return _urls_from_files_info(gallery_id, files_info, resolve_gg(gg), [(dir, ext, base)])[0]
+
+#作品全体のページのurlとサムネイルのurlを一度の走査で作成
+def page_and_thumbnail_urls_from_files_info(gallery_id: int, files_info: Iterable[FileInfo], gg: GGJs|GGJsProvider|None=None, thumbnail_dir: str='webpbigtn', thumbnail_ext: str='webp') -> tuple[list[str], list[str]]:
+    page_urls, thumbnail_urls = _urls_from_files_info(gallery_id, files_info, resolve_gg(gg), [(None, None, None), (thumbnail_dir, thumbnail_ext, 'tn')])
+    return page_urls, thumbnail_urls
+
+# ベンチマーク用の合成gg.js(実物と同じ形式)
+def synthetic_gg_js(case_num: int=2000, b_value: str='1746000000/', seed: int=0) -> str:
+    rng = random.Random(seed)
+    cases = '\n'.join(f'case {g}:' for g in sorted(rng.sample(range(4096), case_num)))
+    return (
+        "'use strict';\n"
+        "gg = {\n"
+        "m: function(g) {\n"
+        "var o = 0;\n"
+        "switch (g) {\n"
+        f"{cases}\n"
+        "o = 1; break;\n"
+        "}\n"
+        "return o;\n"
+        "},\n"
+        "s: function(h) { var m = /(..)(.)$/.exec(h); return parseInt(m[2]+m[1], 16).toString(10); },\n"
+        f"b: '{b_value}'\n"
+        "};\n"
+    )
+
+def synthetic_files_info(file_num: int, seed: int=0) -> list[FileInfo]:
+    rng = random.Random(seed)
+    return [FileInfo(name=f'{i:05}.png', hash=f'{rng.getrandbits(256):064x}', width=2000, height=3000, hasavif=rng.randint(0, 1), haswebp=1, hasjxl=0) for i in range(file_num)]
+
+def bench(file_num: int=10000) -> None:
+    """合成した10k枚のギャラリーでURL生成速度(urls/s)を比較する"""
+    js_code = synthetic_gg_js()
+    gg = parse_gg(js_code)
+    files_info = synthetic_files_info(file_num)
+
+    # 変更前のm関数(呼び出し毎にgg.js全体を正規表現で走査する)
+    def legacy_gg_m(g: int) -> int:
+        m_cases = [int(case) for case in re.findall(r"case (\d+):", js_code)]
+        initial_o_match = re.search(r"var o = (\d+);", js_code)
+        assigned_o_match = re.search(r"case \d+:\s*(?:case \d+:\s*)*o = (\d+);", js_code)
+        assert initial_o_match and assigned_o_match
+        return int(assigned_o_match.group(1)) if g in m_cases else int(initial_o_match.group(1))
+    legacy_gg = GGJs(b_value=gg.b_value, s_func=gg.s_func, m_func=legacy_gg_m, expires_at=gg.expires_at)
+
+    results: dict[str, float] = {}
+    for label, target_gg in (('before', legacy_gg), ('after', gg)):
+        start = time.perf_counter()
+        urls = [url_from_file_info(1, file_info, target_gg) for file_info in files_info]
+        elapsed = time.perf_counter() - start
+        results[label] = len(urls) / elapsed
+        print(f'{label}: {len(urls)} urls in {elapsed:.3f}s ({results[label]:.0f} urls/s)')
+    print(f'speedup: x{results["after"] / results["before"]:.1f}')
+
+    # 作品全体をまとめて作成する場合
+    start = time.perf_counter()
+    urls = urls_from_files_info(1, files_info, gg)
+    elapsed = time.perf_counter() - start
+    results['batch'] = len(urls) / elapsed
+    print(f'batch: {len(urls)} urls in {elapsed:.3f}s ({results["batch"]:.0f} urls/s), x{results["batch"] / results["after"]:.1f} vs url_from_file_info')
+
+def test(thread_num: int=32) -> None:
+    """GGJsProviderが期限切れ時に多数のスレッドから呼ばれても、gg.jsを1回だけ取得することを確認する"""
+    from concurrent.futures import ThreadPoolExecutor
+    js_code = synthetic_gg_js()
+    fetch_count = 0
+    def fetch() -> GGJs:
+        nonlocal fetch_count
+        fetch_count += 1
+        time.sleep(0.1)
+        gg = parse_gg(js_code)
+        gg.expires_at = time.time() + 3600
+        return gg
+    # is_expireはexpires_atを書き換えるとそれに従う
+    gg = fetch()
     gg.is_expire(time.time())
-    return url_by_url_from_url
\ No newline at end of file
+    gg.expires_at = time.time() - 1
+    try:
+        gg.is_expire(time.time())
+        raise AssertionError('is_expire must follow expires_at')
+    except GGJsIsExpire:
+        pass
+    fetch_count = 0
+    provider = GGJsProvider(fetch=fetch)
+    files_info = synthetic_files_info(thread_num)
+    with ThreadPoolExecutor(max_workers=thread_num) as executor:
+        urls = list(executor.map(lambda file_info: url_from_file_info(1, file_info, provider), files_info))
+    assert urls == [url_from_file_info(1, file_info, parse_gg(js_code)) for file_info in files_info]
+    assert fetch_count == 1, fetch_count
+    print(f'{thread_num} threads, gg.js fetched {fetch_count} times')
+
+    # Expiresまでがrefresh_marginより短いgg.jsでも、取得のたびに取得し直さないこと
+    fetch_count = 0
+    def short_fetch() -> GGJs:
+        nonlocal fetch_count
+        fetch_count += 1
+        gg = parse_gg(js_code)
+        gg.expires_at = time.time() + 30
+        return gg
+    provider = GGJsProvider(fetch=short_fetch)
+    for _ in range(100):
+        provider.get()
+    assert fetch_count == 1, fetch_count
+
+    # 先行取得に失敗した後はfailure_cooldownの間、期限内のものを使い取得し直さない
+    fail_count = 0
+    def failing_fetch() -> GGJs:
+        nonlocal fail_count
+        fail_count += 1
+        raise requests.ConnectionError('gg.js is unreachable')
+    current_gg = parse_gg(js_code)
+    current_gg.expires_at = time.time() + 30
+    provider = GGJsProvider(fetch=failing_fetch, gg=current_gg, refresh_margin=3600, refresh_fraction=1.0)
+    for _ in range(100):
+        assert provider.get() is current_gg
+    assert fail_count == 1, fail_count
+    print('short Expires and refresh failures do not cause a fetch per get()')
+
+    # urls_from_files_infoがurl_from_file_infoと完全に一致すること
+    gg = parse_gg(js_code)
+    files_info = synthetic_files_info(500, seed=1)
+    files_info[0].hash = files_info[0].hash.upper()
+    files_info[1].hash = files_info[1].hash[:40]
+    for dir in [None, 'webp', 'avif', 'jxl', '', 'webpbigtn']:
+        for ext in [None, 'webp', 'png', '']:
+            for base in [None, 'tn', 'x', '']:
+                expected = [url_from_file_info(1, file_info, gg, dir, ext, base) for file_info in files_info]
+                assert urls_from_files_info(1, files_info, gg, dir, ext, base) == expected, (dir, ext, base)
+    page_urls, thumbnail_urls = page_and_thumbnail_urls_from_files_info(1, files_info, gg)
+    assert page_urls == [url_from_file_info(1, file_info, gg) for file_info in files_info]
+    assert thumbnail_urls == [url_from_file_info(1, file_info, gg, 'webpbigtn', 'webp', 'tn') for file_info in files_info]
+    print('urls_from_files_info matches url_from_file_info')
+
+if __name__ == '__main__':
+    test()
+    bench()